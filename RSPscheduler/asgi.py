@@ -0,0 +1,234 @@
+"""
+ASGI config for RSPscheduler project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+for any ASGI 3 server, e.g.
+
+    uvicorn RSPscheduler.asgi:application
+
+Open schedule pages follow the changes to their appointments through a stream
+of server-sent events, app.schedule_events, at /app/schedule/<pk>/events. A
+page holds its stream open for as long as it is shown, which would tie up a
+whole WSGI worker each; here every stream is a coroutine, so one process keeps
+thousands of them open while they wait. One poller reads the latest event
+number of every schedule being watched with a single cache lookup every
+SCHEDULE_EVENTS_POLL_INTERVAL seconds, fetches the new events of those that
+moved on and hands them to each of their streams.
+
+Only the event streams are served here. Django 2.1 has no ASGI handler, so
+every other request stays on the WSGI application (RSPscheduler.wsgi, run by
+gunicorn) and the reverse proxy in front sends /app/schedule/<pk>/events here;
+see the README. Both servers must share the "schedules" cache, where the event
+logs are kept.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from urllib.parse import parse_qs
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http import HttpRequest
+from django.http.cookie import parse_cookie
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'RSPscheduler.settings')
+
+django.setup(set_prefix=False)
+
+# The app's models can only be imported once Django is set up
+from app.models import Schedule
+from app.schedule_events import get_events, get_latest, get_latest_many
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PATH = re.compile(r'^/app/schedule/(?P<pk>\d+)/events$')
+POLL_INTERVAL = settings.SCHEDULE_EVENTS_POLL_INTERVAL    # seconds between checks of the event logs
+KEEPALIVE_INTERVAL = 15     # seconds between comments keeping idle streams open through proxies
+RETRY_MS = 5000             # how long browsers wait before reconnecting a dropped stream
+
+# The cache and database lookups of the streams run here, they are short and
+# the poller makes one at a time however many streams are open
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ASGI_THREADS', 4)))
+
+
+def run_sync(function, *args):
+    return asyncio.get_event_loop().run_in_executor(executor, function, *args)
+
+
+def authorise(cookies, schedule_id):
+    """Returns the HTTP status for streaming a schedule's events to whoever sent cookies.
+
+    The same check as the schedule page: a logged in staff member, and a schedule that exists.
+    """
+    close_old_connections()
+    try:
+        request = HttpRequest()
+        request.COOKIES = cookies
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore(
+            cookies.get(settings.SESSION_COOKIE_NAME))
+        user = get_user(request)
+        if not (user.is_active and user.is_staff):
+            return 403
+        if not Schedule.objects.filter(pk=schedule_id).exists():
+            return 404
+        return 200
+    finally:
+        close_old_connections()
+
+def format_event(number, event):
+    return f'id: {number}\nevent: {event["type"]}\ndata: {json.dumps(event)}\n\n'.encode()
+
+
+class Hub:
+    """Polls the event logs of every schedule being watched at once, and hands new events to their streams"""
+
+    def __init__(self):
+        self.queues = {}    # schedule id -> the queue of each stream watching it
+        self.latest = {}    # schedule id -> the number of the last event handed out
+        self.poller = None  # the task polling the logs, while any are watched
+
+    def subscribe(self, schedule_id, latest):
+        queue = asyncio.Queue()
+        if schedule_id not in self.queues:
+            self.queues[schedule_id] = set()
+            self.latest[schedule_id] = latest
+        self.queues[schedule_id].add(queue)
+        if self.poller is None:
+            self.poller = asyncio.ensure_future(self.poll())
+        return queue
+
+    def unsubscribe(self, schedule_id, queue):
+        queues = self.queues.get(schedule_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.queues[schedule_id]
+            del self.latest[schedule_id]
+
+    async def poll(self):
+        """Puts (previous, latest, events) on the queues of each schedule whose log moves past its latest"""
+        try:
+            while self.queues:
+                await asyncio.sleep(POLL_INTERVAL)
+                try:
+                    numbers = await run_sync(get_latest_many, list(self.queues))
+                except Exception:
+                    # The cache being unreachable for a moment shouldn't end every stream
+                    logger.exception('Polling the event logs of %s schedules failed', len(self.queues))
+                    continue
+                for schedule_id, number in numbers.items():
+                    previous = self.latest.get(schedule_id)
+                    if previous is None or number == previous:
+                        continue
+                    try:
+                        latest, events = await run_sync(get_events, schedule_id, previous)
+                    except Exception:
+                        logger.exception('Polling the events of schedule %s failed', schedule_id)
+                        continue
+                    # Its streams may have gone, or been replaced, while the events were fetched
+                    if self.latest.get(schedule_id) != previous:
+                        continue
+                    self.latest[schedule_id] = latest
+                    for queue in self.queues[schedule_id]:
+                        queue.put_nowait((previous, latest, events))
+        finally:
+            # Nothing is awaited between the loop's last check and here, so no stream
+            # can have subscribed in between without a poller
+            self.poller = None
+
+hub = Hub()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def send_response(send, status, body=b''):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def stream_events(scope, receive, send, schedule_id):
+    """Streams the events of a schedule, from the one after Last-Event-ID or ?after= on"""
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+    status = await run_sync(authorise, parse_cookie(headers.get('cookie', '')), schedule_id)
+    if status != 200:
+        await send_response(send, status)
+        return
+    # Browsers reconnecting send the last event they had, pages start from the one they were rendered with
+    after = headers.get('last-event-id') or parse_qs(scope['query_string'].decode('latin-1')).get('after', [''])[0]
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),     # nginx would hold the events back otherwise
+        ]})
+    await send({'type': 'http.response.body', 'body': f'retry: {RETRY_MS}\n\n'.encode(), 'more_body': True})
+
+    if after.isdigit():
+        latest, events = await run_sync(get_events, schedule_id, int(after))
+    else:
+        latest, events = await run_sync(get_latest, schedule_id), []
+    queue = hub.subscribe(schedule_id, latest)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        while not disconnected.done():
+            if events is None:
+                # Too far behind, the page has to start again
+                await send({'type': 'http.response.body', 'body': format_event(latest, {'type': 'reload'})})
+                return
+            if events:
+                body = b''.join(format_event(number, event) for number, event in events)
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+                events = []
+
+            changed = asyncio.ensure_future(queue.get())
+            done, pending = await asyncio.wait({changed, disconnected}, timeout=KEEPALIVE_INTERVAL,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if changed not in done:
+                changed.cancel()
+                if not disconnected.done():
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+            previous, new_latest, new_events = changed.result()
+            if new_latest <= latest:
+                continue
+            if previous == latest:
+                latest, events = new_latest, new_events
+            else:
+                # This stream started between two polls, so it fetches what it hasn't seen itself
+                latest, events = await run_sync(get_events, schedule_id, latest)
+    finally:
+        hub.unsubscribe(schedule_id, queue)
+        disconnected.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http':
+        match = EVENTS_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await stream_events(scope, receive, send, int(match.group('pk')))
+        else:
+            # Everything else is for the WSGI application, the proxy shouldn't have sent it here
+            await send_response(send, 404, b'Not Found')
+    else:
+        raise ValueError(f'Unsupported ASGI scope type {scope["type"]}')
@@ -48,6 +48,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.instrumentation.InstrumentationMiddleware',     # after authentication, so staff can ask for profiles
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -56,7 +57,7 @@ ROOT_URLCONF = 'RSPscheduler.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'app.instrumentation.InstrumentedTemplates',     # DjangoTemplates, timed
         'DIRS': [
             os.path.join(BASE_DIR, 'templates'),
             ],
@@ -86,6 +87,51 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+
+# The "schedules" cache holds rendered schedule grids (see app/fragment_cache.py)
+# and the version counters invalidating them, as well as the schedule event log
+# (app/schedule_events.py), cached counts (app/counters.py) and schedule
+# generation jobs (app/solver.py), so every worker process has to see the same
+# one. SCHEDULE_CACHE picks its backend: database, the default, a table made by
+# migration 0012; redis, which connects to REDIS_URL or, if that isn't set,
+# uses an in-process stand-in for Redis; or locmem. locmem and the Redis
+# stand-in belong to one process, so manage.py check fails on them when there
+# are WEB_CONCURRENCY workers. Event and version numbers are handed out with
+# incr, so manage.py check also fails on a backend whose incr isn't atomic,
+# like Django's own database and file caches.
+SCHEDULE_CACHES = {
+    'database': {
+        'BACKEND': 'app.cache_backends.DatabaseCache',
+        'LOCATION': 'schedule_cache',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'schedules',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'redis': {
+        'BACKEND': 'app.cache_backends.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', ''),
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'schedules': SCHEDULE_CACHES[os.environ.get('SCHEDULE_CACHE', 'database')],
+}
+
+# Worker processes the web server runs, gunicorn reads the same variable
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Seconds between checks of the event logs of the schedules open in RSPscheduler/asgi.py
+SCHEDULE_EVENTS_POLL_INTERVAL = float(os.environ.get('SCHEDULE_EVENTS_POLL_INTERVAL', 2))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -123,6 +169,37 @@ LOGIN_REDIRECT_URL = '/'
 
 LOGOUT_REDIRECT_URL = '/'
 
+# Number of processes used to generate schedules, defaults to one per CPU
+SCHEDULE_SOLVER_WORKERS = int(os.environ.get('SCHEDULE_SOLVER_WORKERS', 0)) or None
+
+# Request instrumentation (see app/instrumentation.py)
+# Fraction of requests profiled with cProfile
+INSTRUMENTATION_PROFILE_RATE = float(os.environ.get('INSTRUMENTATION_PROFILE_RATE', 0))
+# Lets staff have a request profiled by sending "X-Profile: 1"
+INSTRUMENTATION_PROFILE_HEADER = bool(os.environ.get('INSTRUMENTATION_PROFILE_HEADER', ''))
+INSTRUMENTATION_PROFILE_DIR = os.environ.get('INSTRUMENTATION_PROFILE_DIR', os.path.join(BASE_DIR, '.cache', 'profiles'))
+# Requests slower than this many milliseconds are logged as warnings
+INSTRUMENTATION_SLOW_MS = int(os.environ.get('INSTRUMENTATION_SLOW_MS', 1000))
+# A statement run this many times in one request is logged as a likely N+1
+INSTRUMENTATION_DUPLICATE_QUERIES = int(os.environ.get('INSTRUMENTATION_DUPLICATE_QUERIES', 5))
+# Lets Prometheus read /metrics with "Authorization: Bearer <token>", staff can always read it
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'app.instrumentation': {
+            'handlers': ['console'],
+            'level': os.environ.get('INSTRUMENTATION_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # Heroku: Update database configuration from $DATABASE_URL.
 import dj_database_url
 db_from_env = dj_database_url.config(conn_max_age=500)
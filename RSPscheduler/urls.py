@@ -27,9 +27,12 @@ from django.views.generic import RedirectView
 from django.conf import settings
 from django.conf.urls.static import static
 
+from app.instrumentation import MetricsView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('app/', include('app.urls')),
     path('', RedirectView.as_view(url='/app/', permanent=False)),   # permanent option causes browser to cache a 301 Moved Permanently
     path('accounts/', include('django.contrib.auth.urls')),
+    path('metrics', MetricsView, name='metrics'),   # for Prometheus, see app/instrumentation.py
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
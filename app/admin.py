@@ -1,26 +1,187 @@
+from django import forms
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.db import transaction
+from django.db.models import BooleanField, Case, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.template.response import TemplateResponse
+from django.utils import timezone
 
 # Register your models here.
-from app.models import Student, Service, ServiceInstance, Schedule
+from app.models import Resource, Student, Service, ServiceInstance, Schedule
+from app import roster
+from app.allocation import refresh_schedules, refresh_services
+from app.conflicts import find_overlaps, get_timed
+from app.fragment_cache import invalidate_schedule, invalidate_teacher
+from app.schedule_events import publish_reload
+
+# The changelists page through large tables, so they skip counting every row
+# for the "show all" link, and the columns worked out per row are annotated
+# so the database computes them for the page in the same query. Foreign keys
+# to big tables are picked with autocomplete widgets rather than a dropdown
+# of the whole table in every inline row. Actions change every selected row
+# with one UPDATE, then refresh and invalidate what depends on them, as the
+# signal handlers (app.signals) would have for rows saved one at a time.
+LIST_PER_PAGE = 50
+
+
+def invalidate_schedules(schedule_ids):
+    """Invalidates the cached pages of the given schedules and their teachers', and reloads the open ones"""
+    schedule_ids = set(schedule_ids) - {None}
+    for schedule_id, teacher_id in Schedule.objects.filter(pk__in=schedule_ids).values_list('pk', 'teacher_id'):
+        invalidate_schedule(schedule_id)
+        invalidate_teacher(teacher_id)
+        publish_reload(schedule_id)
+
+def describe(serviceinstance):
+    service = serviceinstance.service
+    return '{student} for {subject} on {day} from {start} to {end}'.format(
+        student=service.student if service else 'an appointment', subject=service.subject if service else 'a service',
+        day=serviceinstance.day, start=serviceinstance.time_start.strftime("%I:%M"),
+        end=serviceinstance.time_end.strftime("%I:%M"))
+
+def get_move_conflicts(serviceinstances, schedule):
+    """Returns the Conflicts that moving serviceinstances to schedule would make, with two queries"""
+    moving = list(get_timed(serviceinstances))
+    pks = {serviceinstance.pk for serviceinstance in moving}
+    staying = get_timed(ServiceInstance.objects.filter(scheduled_for=schedule).exclude(pk__in=pks))
+    return [conflict for conflict in find_overlaps(moving + list(staying))
+            if conflict.first.pk in pks or conflict.second.pk in pks]
+
+def mark_services_satisfied(services):
+    """Sets satisfied on services with one UPDATE, returning how many there were"""
+    teacher_ids = set(services.order_by().values_list('student__teacher_id', flat=True).distinct())
+    # update() skips auto_now
+    count = services.update(satisfied=True, updated_at=timezone.now())
+    for teacher_id in teacher_ids - {None}:
+        invalidate_teacher(teacher_id)
+    return count
+
+
+@admin.register(Resource)
+class ResourceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'kind', 'capacity')
+    list_filter = ('kind',)
+    search_fields = ('name',)
+
+
+@admin.register(Schedule)
+class ScheduleAdmin(admin.ModelAdmin):
+    list_display = ('title', 'teacher', 'start_date', 'end_date', 'active')
+    list_select_related = ('teacher',)
+    list_filter = ('active',)
+    ordering = ('title', 'id')
+    list_per_page = LIST_PER_PAGE
+    show_full_result_count = False
+    search_fields = ('title',)
+    actions = ['deactivate']
+
+    def deactivate(self, request, queryset):
+        with transaction.atomic():
+            schedule_ids = set(queryset.filter(active=True).values_list('pk', flat=True))
+            Schedule.objects.filter(pk__in=schedule_ids).update(active=False, updated_at=timezone.now())
+            # Their appointments no longer count towards the services' minutes
+            refresh_schedules(schedule_ids)
+        invalidate_schedules(schedule_ids)
+        self.message_user(request, f'{len(schedule_ids)} schedules deactivated.')
+    deactivate.short_description = 'Deactivate selected schedules'
+
+
+class MoveToScheduleForm(forms.Form):
+    schedule = forms.ModelChoiceField(queryset=Schedule.objects.select_related('teacher').order_by('title', 'pk'))
+
+
+@admin.register(ServiceInstance)
+class ServiceInstanceAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'scheduled_for', 'resource')
+    list_select_related = ('service__student', 'scheduled_for', 'resource')
+    list_filter = ('day',)
+    ordering = ('-id',)
+    list_per_page = LIST_PER_PAGE
+    show_full_result_count = False
+    autocomplete_fields = ('service', 'scheduled_for', 'resource')
+    actions = ['move_to_schedule']
+
+    def move_to_schedule(self, request, queryset, form=None):
+        """Asks for a schedule, then moves the selected appointments to it unless they would overlap others there"""
+        if form is None:
+            form = MoveToScheduleForm(request.POST if 'apply' in request.POST else None)
+        if not form.is_bound or form.errors:
+            return TemplateResponse(request, 'admin/app/move_to_schedule.html', dict(
+                self.admin_site.each_context(request),
+                title='Move appointments to another schedule',
+                opts=self.model._meta,
+                form=form,
+                queryset=queryset,
+                action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+                ))
+        schedule = form.cleaned_data['schedule']
+        with transaction.atomic():
+            # The same check as the appointment form: nothing may overlap on the destination
+            conflicts = get_move_conflicts(queryset, schedule)
+            if conflicts:
+                form.add_error('schedule', [f'{describe(conflict.first)} would overlap {describe(conflict.second)}'
+                                            for conflict in conflicts[:5]])
+                return self.move_to_schedule(request, queryset, form=form)
+            pks = list(queryset.values_list('pk', flat=True))
+            schedule_ids = set(queryset.order_by().values_list('scheduled_for_id', flat=True).distinct()) | {schedule.pk}
+            service_ids = set(queryset.exclude(service=None).order_by().values_list('service_id', flat=True).distinct())
+            ServiceInstance.objects.filter(pk__in=pks).update(scheduled_for=schedule, updated_at=timezone.now())
+            refresh_services(service_ids)
+        invalidate_schedules(schedule_ids)
+        self.message_user(request, f'{len(pks)} appointments moved to {schedule.title}.')
+    move_to_schedule.short_description = 'Move selected appointments to another schedule'
 
-#admin.site.register(Student)
-#admin.site.register(Service)
-admin.site.register(ServiceInstance)
-admin.site.register(Schedule)
 
 class ServiceInstanceInline(admin.TabularInline):
     model = ServiceInstance
-    
+    extra = 1
+    autocomplete_fields = ('scheduled_for', 'resource')
+
 @admin.register(Service)
 class ServiceAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'total_time_req', 'allocated_time', 'shortfall', 'has_all_minutes', 'satisfied')
+    list_select_related = ('student',)
+    list_filter = ('subject', 'service_type', 'satisfied')
+    ordering = ('student__last_name', 'student__first_name', 'id')
+    list_per_page = LIST_PER_PAGE
+    show_full_result_count = False
+    search_fields = ('^student__last_name', '^student__first_name')
+    autocomplete_fields = ('student', 'resource')
     inlines = [ServiceInstanceInline]
+    actions = ['mark_satisfied']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            minutes_short=Greatest(F('total_time_req') - F('allocated_minutes'), Value(0)),
+            has_all_minutes=Case(When(allocated_minutes__gte=F('total_time_req'), then=Value(True)),
+                                 default=Value(False), output_field=BooleanField()))
+
+    def allocated_time(self, service):
+        return service.allocated_minutes
+    allocated_time.admin_order_field = 'allocated_minutes'
+
+    def shortfall(self, service):
+        return service.minutes_short
+    shortfall.admin_order_field = 'minutes_short'
+
+    # Whether the minutes are booked, while satisfied is the flag the action sets
+    def has_all_minutes(self, service):
+        return service.has_all_minutes
+    has_all_minutes.short_description = 'Has all minutes'
+    has_all_minutes.boolean = True
+    has_all_minutes.admin_order_field = 'has_all_minutes'
+
+    def mark_satisfied(self, request, queryset):
+        self.message_user(request, f'{mark_services_satisfied(queryset)} services marked satisfied.')
+    mark_satisfied.short_description = 'Mark selected services satisfied'
 
     fieldsets = (
         (None, {
             'fields': ('student',),
             }),
         ('Service details', {
-            'fields': ('subject', 'service_type', 'total_time_req', 'satisfied',)
+            'fields': ('subject', 'service_type', 'total_time_req', 'satisfied', 'resource',)
             }),
         )
 
@@ -28,9 +189,50 @@ class ServiceInline(admin.TabularInline):
     model = Service
     extra = 1
     max_num = 4
-    
+    fields = ('subject', 'service_type', 'total_time_req', 'satisfied', 'resource', 'allocated_minutes')
+    readonly_fields = ('allocated_minutes',)
+    autocomplete_fields = ('resource',)
+
+def sum_of_services(field):
+    """Returns a subquery adding up field over the services of each student"""
+    services = (Service.objects.filter(student=OuterRef('pk')).order_by()
+                .values('student').annotate(total=Sum(field)).values('total'))
+    return Coalesce(Subquery(services, output_field=IntegerField()), Value(0))
+
 @admin.register(Student)
 class StudentAdmin(admin.ModelAdmin):
-    list_display = ('last_name', 'middle_name', 'first_name')
+    list_display = ('last_name', 'middle_name', 'first_name', 'teacher', 'required_time', 'allocated_time', 'is_serviced')
+    list_select_related = ('teacher',)
+    list_filter = ('serviced',)
+    list_per_page = LIST_PER_PAGE
+    show_full_result_count = False
+    search_fields = ('last_name', 'first_name')
     inlines = [ServiceInline]
+    actions = ['mark_services_satisfied']
+
+    def get_queryset(self, request):
+        # Subqueries rather than a join and GROUP BY, so only the rows of the page are added up
+        return super().get_queryset(request).annotate(minutes_required=sum_of_services('total_time_req'),
+                                                      minutes_allocated=sum_of_services('allocated_minutes'))
+
+    def get_search_results(self, request, queryset, search_term):
+        # By name prefix, on the indexes of migration 0008
+        return roster.search(queryset, search_term), False
+
+    def required_time(self, student):
+        return student.minutes_required
+    required_time.admin_order_field = 'minutes_required'
+
+    def allocated_time(self, student):
+        return student.minutes_allocated
+    allocated_time.admin_order_field = 'minutes_allocated'
+
+    def is_serviced(self, student):
+        return student.is_serviced
+    is_serviced.boolean = True
+    is_serviced.admin_order_field = 'serviced'
 
+    def mark_services_satisfied(self, request, queryset):
+        services = Service.objects.filter(student__in=queryset.values('pk'))
+        self.message_user(request, f'{mark_services_satisfied(services)} services marked satisfied.')
+    mark_services_satisfied.short_description = "Mark selected students' services satisfied"
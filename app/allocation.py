@@ -0,0 +1,139 @@
+"""Keeps Service.allocated_minutes and Student.serviced up to date.
+
+A service's allocated minutes are the minutes of its appointments on active
+schedules, and a student is serviced when every one of their services has at
+least the minutes it requires. Both only change when an appointment is saved or
+deleted, a service's requirement changes, or a schedule is activated or
+deactivated, so they are stored on the rows and refreshed at those moments by
+the signal handlers in app.signals, and by code saving rows in bulk. Pages then
+read satisfaction straight from the columns.
+
+Refreshing never adds or subtracts: the affected services' minutes are summed
+again from their appointments, inside a transaction that locks the services'
+rows, and only rows whose value changed are written. A refresh that is missed
+or interrupted is put right by the next one touching the same service, and
+reconcile() checks and repairs every row.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from app.compliance import refresh_for_services, refresh_teachers
+from app.fragment_cache import invalidate_teacher
+from app.models import Service, ServiceInstance, Student, duration_expression
+
+RECONCILE_CHUNK = 1000  # rows compared at a time by reconcile()
+
+
+def get_allocated_times(services):
+    """Returns a dict mapping service id to the minutes scheduled for it on active schedules.
+
+    services may be a queryset (used as a subquery), a list of Service objects
+    or a list of ids. The minutes are added up by the database.
+    """
+    allocated_times = (ServiceInstance.objects
+                       .filter(service__in=services, scheduled_for__active=True)
+                       .order_by()
+                       .values('service_id')
+                       .annotate(allocated_time=Sum(duration_expression())))
+    return {row['service_id']: row['allocated_time'] for row in allocated_times}
+
+def update_changed(model, field, current, wanted):
+    """Writes wanted values of field where they differ from current, both dicts keyed by pk.
+
+    Rows are updated with one statement per distinct value. Returns the pks changed.
+    """
+    changes = defaultdict(list)
+    for pk, value in current.items():
+        if wanted.get(pk) != value:
+            changes[wanted.get(pk)].append(pk)
+    now = timezone.now()
+    for value, pks in changes.items():
+        # update() skips auto_now, but the API's ETags rely on updated_at
+        model.objects.filter(pk__in=pks).update(**{field: value, 'updated_at': now})
+    return [pk for pks in changes.values() for pk in pks]
+
+
+def refresh_students(student_ids):
+    """Recomputes serviced for the given students"""
+    student_ids = set(student_ids) - {None}
+    if not student_ids:
+        return
+    with transaction.atomic():
+        current = dict(Student.objects.select_for_update()
+                       .filter(pk__in=student_ids).values_list('pk', 'serviced'))
+        unserviced = set(Service.objects
+                         .filter(student_id__in=student_ids, allocated_minutes__lt=F('total_time_req'))
+                         .values_list('student_id', flat=True))
+        update_changed(Student, 'serviced', current, {pk: pk not in unserviced for pk in current})
+
+def refresh_services(service_ids):
+    """Recomputes allocated_minutes for the given services, then serviced for their students"""
+    service_ids = set(service_ids) - {None}
+    if not service_ids:
+        return
+    with transaction.atomic():
+        rows = list(Service.objects.select_for_update()
+                    .filter(pk__in=service_ids).values_list('pk', 'allocated_minutes', 'student_id'))
+        allocated_times = get_allocated_times([pk for pk, minutes, student_id in rows])
+        changed = update_changed(Service, 'allocated_minutes', {pk: minutes for pk, minutes, student_id in rows},
+                                 {pk: allocated_times.get(pk, 0) for pk, minutes, student_id in rows})
+        refresh_students(student_id for pk, minutes, student_id in rows)
+        # and the district summary of their teachers (app.compliance)
+        refresh_for_services(changed)
+
+def get_service_ids(schedule_ids):
+    """Returns the ids of the services with appointments on the given schedules"""
+    return set(ServiceInstance.objects
+               .filter(scheduled_for__in=schedule_ids).exclude(service=None)
+               .order_by().values_list('service_id', flat=True).distinct())
+
+def refresh_schedules(schedule_ids):
+    """Recomputes the services with appointments on the given schedules, e.g. when one is activated"""
+    schedule_ids = set(schedule_ids) - {None}
+    if schedule_ids:
+        refresh_services(get_service_ids(schedule_ids))
+
+
+def reconcile(repair=True):
+    """Compares every stored total with one worked out from scratch, repairing the ones that differ.
+
+    Returns (services, students): the pks of the rows that had drifted.
+    """
+    services, students = [], []
+    service_ids = list(Service.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(service_ids), RECONCILE_CHUNK):
+        chunk = service_ids[start:start + RECONCILE_CHUNK]
+        with transaction.atomic():
+            current = dict(Service.objects.select_for_update().filter(pk__in=chunk).values_list('pk', 'allocated_minutes'))
+            allocated_times = get_allocated_times(chunk)
+            wanted = {pk: allocated_times.get(pk, 0) for pk in current}
+            if repair:
+                services += update_changed(Service, 'allocated_minutes', current, wanted)
+            else:
+                services += [pk for pk in current if current[pk] != wanted[pk]]
+
+    student_ids = list(Student.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(student_ids), RECONCILE_CHUNK):
+        chunk = student_ids[start:start + RECONCILE_CHUNK]
+        with transaction.atomic():
+            current = dict(Student.objects.select_for_update().filter(pk__in=chunk).values_list('pk', 'serviced'))
+            unserviced = set(Service.objects
+                             .filter(student_id__in=chunk, allocated_minutes__lt=F('total_time_req'))
+                             .values_list('student_id', flat=True))
+            wanted = {pk: pk not in unserviced for pk in current}
+            if repair:
+                students += update_changed(Student, 'serviced', current, wanted)
+            else:
+                students += [pk for pk in current if current[pk] != wanted[pk]]
+
+    if repair and (services or students):
+        # The repairs were made with update(), so the pages showing them are invalidated here
+        teacher_ids = set(Student.objects.filter(pk__in=students).values_list('teacher_id', flat=True))
+        teacher_ids |= set(Service.objects.filter(pk__in=services).values_list('student__teacher_id', flat=True))
+        for teacher_id in teacher_ids - {None}:
+            invalidate_teacher(teacher_id)
+        refresh_teachers(teacher_ids)
+    return services, students
@@ -0,0 +1,265 @@
+"""Read-only JSON API, version 1.
+
+    /app/api/v1/<resource>/           a page of rows
+    /app/api/v1/<resource>/<id>       one row
+
+for the resources students, services, serviceinstances and schedules, limited
+to the logged-in teacher's caseload like the rest of the site.
+
+Lists are paged by keyset (see app.pagination): ?limit= sets the page size
+and each page links to the next with an opaque ?cursor=. ?fields=a,b returns
+only those fields. Some resources take filters, e.g. /services/?student=<id>
+or /schedules/?active=1.
+
+Every response carries an ETag and a Last-Modified header worked out from the
+row counts, highest ids and latest updated_at of the rows it was built from,
+so a client sending If-None-Match or If-Modified-Since gets a 304 without the
+rows being read. Deleting a row doesn't move Last-Modified, but it does change
+the ETag, so clients should prefer If-None-Match. Satisfaction is stored on the rows
+(see app.allocation), so a change to it moves updated_at like any other.
+"""
+import calendar
+import hashlib
+
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.http import Http404, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlencode
+
+from app.models import Schedule, Service, ServiceInstance, Student
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursor, paginate
+
+VERSION = 'v1'
+
+
+class BadRequest(Exception):
+    pass
+
+
+def format_time(time):
+    return time.strftime('%H:%M') if time else None
+
+def format_date(date):
+    return date.isoformat() if date else None
+
+
+class Resource:
+    """How one model is listed: its rows, their order, fields and filters"""
+    name = None
+    model = None
+    owner = None                    # lookup from the model to the teacher whose caseload a row is in
+    ordering = ('pk',)
+    fields = {}                     # field name -> function returning the value for an object
+    filters = {}                    # query parameter -> model field it filters on
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        missing = [attribute for attribute in ('name', 'model', 'owner') if getattr(cls, attribute) is None]
+        if missing:
+            raise TypeError(f'{cls.__name__} must set {", ".join(missing)}')
+
+    def get_queryset(self, user):
+        return self.model.objects.filter(**{self.owner: user})
+
+    def serialize(self, obj, fields):
+        return {name: self.fields[name](obj) for name in fields}
+
+
+class StudentResource(Resource):
+    name = 'students'
+    model = Student
+    owner = 'teacher'
+    ordering = ('last_name', 'first_name', 'id')
+    fields = {
+        'id': lambda student: str(student.pk),
+        'first_name': lambda student: student.first_name,
+        'middle_name': lambda student: student.middle_name,
+        'last_name': lambda student: student.last_name,
+        'teacher': lambda student: student.teacher_id,
+        'is_serviced': lambda student: student.is_serviced,
+        'updated_at': lambda student: student.updated_at.isoformat(),
+        }
+
+
+class ServiceResource(Resource):
+    name = 'services'
+    model = Service
+    owner = 'student__teacher'
+    ordering = ('id',)
+    fields = {
+        'id': lambda service: service.pk,
+        'student': lambda service: str(service.student_id) if service.student_id else None,
+        'subject': lambda service: service.subject,
+        'service_type': lambda service: service.service_type,
+        'total_time_req': lambda service: service.total_time_req,
+        'allocated_time': lambda service: service.allocated_time,
+        'is_satisfied': lambda service: service.is_satisfied,
+        'resource': lambda service: service.resource_id,
+        'updated_at': lambda service: service.updated_at.isoformat(),
+        }
+    filters = {'student': 'student'}
+
+
+class ServiceInstanceResource(Resource):
+    name = 'serviceinstances'
+    model = ServiceInstance
+    owner = 'scheduled_for__teacher'
+    ordering = ('id',)
+    fields = {
+        'id': lambda instance: instance.pk,
+        'service': lambda instance: instance.service_id,
+        'schedule': lambda instance: instance.scheduled_for_id,
+        'day': lambda instance: instance.day,
+        'time_start': lambda instance: format_time(instance.time_start),
+        'time_end': lambda instance: format_time(instance.time_end),
+        'minutes': lambda instance: instance.duration,
+        'resource': lambda instance: instance.resource_id,
+        'updated_at': lambda instance: instance.updated_at.isoformat(),
+        }
+    filters = {'schedule': 'scheduled_for', 'service': 'service', 'day': 'day', 'resource': 'resource'}
+
+
+class ScheduleResource(Resource):
+    name = 'schedules'
+    model = Schedule
+    owner = 'teacher'
+    ordering = ('id',)
+    fields = {
+        'id': lambda schedule: schedule.pk,
+        'title': lambda schedule: schedule.title,
+        'start_date': lambda schedule: format_date(schedule.start_date),
+        'end_date': lambda schedule: format_date(schedule.end_date),
+        'teacher': lambda schedule: schedule.teacher_id,
+        'active': lambda schedule: schedule.active,
+        'updated_at': lambda schedule: schedule.updated_at.isoformat(),
+        }
+    filters = {'active': 'active'}
+
+
+RESOURCES = {resource.name: resource for resource in
+             (StudentResource(), ServiceResource(), ServiceInstanceResource(), ScheduleResource())}
+
+
+def get_resource(name):
+    try:
+        return RESOURCES[name]
+    except KeyError:
+        raise Http404
+
+def get_fields(request, resource):
+    """Returns the fields asked for with ?fields=, all of them by default"""
+    requested = request.GET.get('fields')
+    if not requested:
+        return list(resource.fields)
+    fields = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in resource.fields]
+    if unknown:
+        raise BadRequest(f'unknown fields: {", ".join(unknown)}')
+    return fields
+
+def apply_filters(request, resource, queryset):
+    for parameter, field_name in resource.filters.items():
+        if parameter not in request.GET:
+            continue
+        field = resource.model._meta.get_field(field_name)
+        # Foreign keys are matched on the related model's primary key
+        target = field.target_field if field.is_relation else field
+        try:
+            value = target.to_python(request.GET[parameter])
+        except ValidationError:
+            raise BadRequest(f'{parameter} is not valid')
+        queryset = queryset.filter(**{field.attname: value})
+    return queryset
+
+def get_page_size(request):
+    try:
+        page_size = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise BadRequest('limit must be a number')
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise BadRequest(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    return page_size
+
+
+def get_validators(request, querysets):
+    """Returns an ETag and Last-Modified timestamp for a response built from querysets, with one query each"""
+    fingerprint = [VERSION, request.get_full_path(), str(request.user.pk)]
+    last_modified = None
+    for queryset in querysets:
+        aggregates = {'count': Count('pk'), 'last_modified': Max('updated_at')}
+        if queryset.model._meta.pk.get_internal_type() == 'AutoField':
+            # A row deleted and another added, or moved in through a related row without
+            # changing its own updated_at, leaves the count and latest time as they were.
+            # Students' ids are UUIDs, which have no MAX in PostgreSQL, but a student
+            # only joins a caseload by changing their own teacher, which moves updated_at
+            aggregates['last_id'] = Max('pk')
+        state = queryset.order_by().aggregate(**aggregates)
+        fingerprint.append(f'{state["count"]}:{state["last_modified"]}:{state.get("last_id")}')
+        if state['last_modified'] and (last_modified is None or state['last_modified'] > last_modified):
+            last_modified = state['last_modified']
+    etag = quote_etag(hashlib.sha1('|'.join(fingerprint).encode()).hexdigest())
+    return etag, calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+
+def conditional_json(request, querysets, build):
+    """Returns a 304 if the client's copy is current, otherwise the JSON data returned by build"""
+    etag, last_modified = get_validators(request, querysets)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = JsonResponse(build())
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # The rows can change at any time, so caches must check before reusing a response
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+@login_required
+def ResourceListView(request, resource):
+    """View function returning a page of a resource as JSON"""
+    resource = get_resource(resource)
+    try:
+        fields = get_fields(request, resource)
+        queryset = apply_filters(request, resource, resource.get_queryset(request.user))
+        page_size = get_page_size(request)
+    except BadRequest as problem:
+        return error(str(problem))
+    cursor = request.GET.get('cursor')
+
+    def build():
+        page = paginate(queryset, resource.ordering, cursor, page_size)
+        next_url = None
+        if page.next_cursor:
+            parameters = request.GET.copy()
+            parameters['cursor'] = page.next_cursor
+            next_url = request.build_absolute_uri(f'{request.path}?{urlencode(sorted(parameters.items()))}')
+        return {'data': [resource.serialize(obj, fields) for obj in page.items], 'next': next_url}
+
+    try:
+        return conditional_json(request, [queryset], build)
+    except InvalidCursor as problem:
+        return error(str(problem))
+
+@login_required
+def ResourceDetailView(request, resource, pk):
+    """View function returning one row of a resource as JSON"""
+    resource = get_resource(resource)
+    try:
+        fields = get_fields(request, resource)
+    except BadRequest as problem:
+        return error(str(problem))
+    try:
+        queryset = resource.get_queryset(request.user).filter(pk=pk)
+        obj = queryset.get()
+    except (resource.model.DoesNotExist, ValidationError, ValueError):
+        return error('not found', status=404)
+
+    def build():
+        return {'data': resource.serialize(obj, fields)}
+
+    return conditional_json(request, [queryset], build)
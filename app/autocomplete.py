@@ -0,0 +1,114 @@
+"""Search-as-you-type for the student, service and schedule fields of forms.
+
+A <select> of every student, service or schedule grows with the whole district,
+and so does every page showing one. Forms use AutocompleteSelect instead, which
+renders only the chosen option and points the page's script at a source:
+
+    /app/autocomplete/<source>?q=<text>
+
+returns the first LIMIT matches on the logged-in teacher's caseload as JSON,
+{"results": [{"id": ..., "text": ...}], "more": true or false}, which the
+script puts in the select. Students, and services by their student, are
+searched by name prefix on the roster's indexes (app.roster); schedules, of
+which a teacher has few, by title. An answer costs the same however many rows
+there are. Responses carry the API's validators (app.api) and may be reused
+for CACHE_SECONDS, so typing the same text again doesn't ask the server.
+"""
+from django import forms
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.urls import reverse_lazy
+
+from app import roster
+from app.api import conditional_json
+from app.models import Schedule, Service, Student
+
+LIMIT = 20
+CACHE_SECONDS = 60
+
+
+class Source:
+    """What one autocomplete endpoint searches, with get_queryset(user, query), and how it labels the results"""
+    name = None
+    ordering = ('pk',)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.name is None or not callable(getattr(cls, 'get_queryset', None)):
+            raise TypeError(f'{cls.__name__} must set name and define get_queryset(user, query)')
+
+    def label(self, obj):
+        return str(obj)
+
+
+class StudentSource(Source):
+    name = 'students'
+    ordering = roster.ORDERING
+
+    def get_queryset(self, user, query):
+        return roster.search(Student.objects.filter(teacher=user), query)
+
+
+class ServiceSource(Source):
+    name = 'services'
+    ordering = ('student__last_name', 'student__first_name', 'subject', 'service_type', 'id')
+
+    def get_queryset(self, user, query):
+        students = roster.search(Student.objects.filter(teacher=user), query)
+        return Service.objects.filter(student__in=students.values('pk')).select_related('student')
+
+    def label(self, service):
+        return f'{service.student}, {service.subject} {service.service_type}'
+
+
+class ScheduleSource(Source):
+    name = 'schedules'
+    ordering = ('title', 'id')
+
+    def get_queryset(self, user, query):
+        return Schedule.objects.filter(teacher=user, title__istartswith=query.strip())
+
+
+SOURCES = {source.name: source for source in (StudentSource(), ServiceSource(), ScheduleSource())}
+
+
+@login_required
+def AutocompleteView(request, source):
+    """View function returning the students, services or schedules matching ?q= as JSON"""
+    try:
+        source = SOURCES[source]
+    except KeyError:
+        raise Http404
+    queryset = source.get_queryset(request.user, request.GET.get('q', '')[:40])
+
+    def build():
+        rows = list(queryset.order_by(*source.ordering)[:LIMIT + 1])
+        return {'results': [{'id': str(obj.pk), 'text': source.label(obj)} for obj in rows[:LIMIT]],
+                'more': len(rows) > LIMIT}
+
+    response = conditional_json(request, [queryset], build)
+    response['Cache-Control'] = f'private, max-age={CACHE_SECONDS}'
+    return response
+
+
+class AutocompleteSelect(forms.Select):
+    """A select of a ModelChoiceField listing only the chosen option, the others are searched for"""
+
+    def __init__(self, source, attrs=None):
+        attrs = dict(attrs or {}, **{'data-autocomplete-url': reverse_lazy('autocomplete', args=[source])})
+        super().__init__(attrs)
+
+    def optgroups(self, name, value, attrs=None):
+        """Returns the empty choice and the chosen one, with one query for the chosen row"""
+        choices = []
+        if self.choices.field.empty_label is not None:
+            choices.append(('', self.choices.field.empty_label))
+        chosen = [pk for pk in value if pk not in ('', None)]
+        if chosen:
+            try:
+                choices += [self.choices.choice(obj) for obj in self.choices.queryset.filter(pk__in=chosen)]
+            except (ValueError, ValidationError):
+                pass    # a value that was posted back isn't a valid pk, the field reports it
+        return [(None, [self.create_option(name, choice_value, label, str(choice_value) in value, index, attrs=attrs)], index)
+                for index, (choice_value, label) in enumerate(choices)]
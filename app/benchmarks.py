@@ -0,0 +1,244 @@
+"""Query count, time and memory benchmarks for every page of the app.
+
+A dataset of a given number of students, each with two services and two
+appointments per service, is created in bulk for one teacher. Every URL in
+app.urls is then requested through the test client, logged in as that teacher,
+and the queries, wall time and peak memory allocated by each request are
+recorded. Caches are cleared before each request, so the figures are for a
+cold page.
+
+Query counts must not depend on how many rows there are; a page whose count
+grows with the dataset has an N+1. check() reports those, and pages going over
+their query budget or an optional time or memory budget. Results are plain
+dicts so they can be written out as JSON and compared between runs.
+
+Run with the benchmark management command, or from tests with small scales.
+"""
+import datetime
+import gc
+import platform
+import time
+import tracemalloc
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, reverse
+
+from app import urls as app_urls
+from app.api import RESOURCES
+from app.autocomplete import SOURCES
+from app.exports import FORMATS
+from app.grid import DAYS
+from app.models import Resource, Schedule, Service, ServiceInstance, Student
+
+SCALES = (10, 100, 1000, 10000)
+DEFAULT_QUERY_BUDGET = 6
+# Pages that need more queries than the default, still a fixed number however many rows there are
+QUERY_BUDGETS = {
+    'schedule-detail': 9,
+    'api-list': 9,
+    'api-detail': 9,
+    }
+# Settings to run benchmarks with: caches of their own, since they are cleared before every
+# request, and static files served without the manifest collectstatic would write
+SETTINGS = {
+    'CACHES': {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-default'},
+        'schedules': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-schedules'},
+        },
+    'STATICFILES_STORAGE': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    }
+
+
+class Dataset:
+    """A teacher with students, services, a room for the Pull-Outs, and an active and an inactive schedule full of appointments"""
+
+    def __init__(self, students, number=0):
+        self.scale = students
+        self.password = 'benchmark'
+        # number tells apart several datasets of the same size in one database
+        self.teacher = User.objects.create_user(f'benchmark{students}-{number}', password=self.password, is_staff=True)
+        self.schedule = Schedule.objects.create(title=f'Benchmark {students}', teacher=self.teacher, active=True,
+                                                start_date=datetime.date(2018, 9, 4), end_date=datetime.date(2019, 6, 14))
+        self.old_schedule = Schedule.objects.create(title=f'Old benchmark {students}', teacher=self.teacher)
+        self.room = Resource.objects.create(name=f'Benchmark room {students}-{number}', capacity=4)
+
+        new_students = [Student(first_name=f'First{number}', last_name=f'Last{number}', teacher=self.teacher)
+                        for number in range(students)]
+        Student.objects.bulk_create(new_students, batch_size=500)
+        new_services = []
+        for student in new_students:
+            new_services.append(Service(student=student, subject='MATH', service_type='Pull-Out', total_time_req=60, satisfied=False,
+                                        resource=self.room))
+            new_services.append(Service(student=student, subject='ELA', service_type='Push-In', total_time_req=30, satisfied=False))
+        Service.objects.bulk_create(new_services, batch_size=500)
+        # bulk_create only sets primary keys on PostgreSQL, fetch them back in the same order
+        services = list(Service.objects.filter(student__teacher=self.teacher).order_by('pk'))
+        new_instances = []
+        for number, service in enumerate(services):
+            start = 7 * 60 + (number % 32) * 15
+            for week_day in range(2):
+                new_instances.append(ServiceInstance(
+                    service=service, scheduled_for=self.schedule if week_day == 0 else self.old_schedule,
+                    day=DAYS[(number + week_day) % len(DAYS)],
+                    time_start=datetime.time(start // 60, start % 60),
+                    time_end=datetime.time((start + 30) // 60, (start + 30) % 60),
+                    resource_id=service.resource_id))
+        ServiceInstance.objects.bulk_create(new_instances, batch_size=500)
+
+        self.student = Student.objects.filter(teacher=self.teacher).first()
+        self.service = services[0]
+        self.serviceinstance = ServiceInstance.objects.filter(scheduled_for=self.schedule).first()
+
+    def get_url_kwargs(self):
+        """Returns, for each URL name that takes arguments, the argument sets to benchmark it with"""
+        student, service = {'pk': self.student.pk}, {'pk': self.service.pk}
+        schedule, serviceinstance = {'pk': self.schedule.pk}, {'pk': self.serviceinstance.pk}
+        detail_pks = {'students': self.student.pk, 'services': self.service.pk,
+                      'serviceinstances': self.serviceinstance.pk, 'schedules': self.schedule.pk}
+        return {
+            'student-detail': [student],
+            'update-student': [student],
+            'delete-student': [student],
+            'create-service': [student],
+            'schedule-detail': [schedule, dict(schedule, slot=15)],
+            'update-schedule': [schedule],
+            'delete-schedule': [schedule],
+            'generate-schedule': [schedule],
+            'schedule-conflicts': [schedule],
+            'preview-schedule': [schedule],
+            'clone-schedule': [schedule],
+            'repair-schedule': [schedule],
+            'create-serviceinstance': [schedule],
+            'export-schedule': [dict(schedule, format=format) for format in FORMATS],
+            'export-my-schedules': [{'format': format} for format in FORMATS],
+            'export-active-schedules': [{'format': format} for format in FORMATS],
+            'service-detail': [service],
+            'update-service': [service],
+            'delete-service': [service],
+            'serviceinstance-detail': [serviceinstance],
+            'update-serviceinstance': [serviceinstance],
+            'delete-serviceinstance': [serviceinstance],
+            'autocomplete': [{'source': name} for name in SOURCES],
+            'api-list': [{'resource': name} for name in RESOURCES],
+            'api-detail': [{'resource': name, 'pk': pk} for name, pk in detail_pks.items()],
+            }
+
+
+def iter_patterns(patterns):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from iter_patterns(pattern.url_patterns)
+        elif isinstance(pattern, URLPattern):
+            yield pattern
+
+def get_cases(dataset):
+    """Returns (label, URL name, URL) for every URL in app.urls.
+
+    The label names the case the same way at every scale, e.g. "export-schedule format=csv".
+    Raises LookupError for a URL the dataset has no arguments for.
+    """
+    url_kwargs = dataset.get_url_kwargs()
+    cases = []
+    for pattern in iter_patterns(app_urls.urlpatterns):
+        if pattern.pattern.converters and pattern.name not in url_kwargs:
+            raise LookupError(f'No benchmark arguments for the URL "{pattern.name}", add them to Dataset.get_url_kwargs')
+        for kwargs in url_kwargs.get(pattern.name, [{}]):
+            kwargs = dict(kwargs)
+            query = f'?slot={kwargs.pop("slot")}' if 'slot' in kwargs else ''
+            label = ' '.join([pattern.name] + [f'{key}={value}' for key, value in kwargs.items() if key != 'pk']) + query
+            cases.append((label, pattern.name, reverse(pattern.name, kwargs=kwargs) + query))
+    return cases
+
+
+def clear_caches():
+    for cache in caches.all():
+        cache.clear()
+
+def fetch(client, url):
+    response = client.get(url)
+    # Streamed responses do their work as they are read
+    if response.streaming:
+        for chunk in response.streaming_content:
+            pass
+    return response
+
+def measure(client, url, repeat=1):
+    """Returns the status, query count, best wall time in ms and peak allocated KB of GETting url"""
+    timings = []
+    for run in range(repeat):
+        clear_caches()
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = fetch(client, url)
+            timings.append((time.perf_counter() - started) * 1000)
+        queries = len(context.captured_queries)
+
+    # Memory is measured in a run of its own, tracing allocations slows everything down
+    clear_caches()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fetch(client, url)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'status': response.status_code, 'queries': queries, 'ms': round(min(timings), 2), 'peak_kb': peak // 1024}
+
+
+def run(scales=SCALES, repeat=1, progress=None):
+    """Benchmarks every URL at each scale and returns the results as a list of dicts.
+
+    Each dataset is created in a transaction that is rolled back afterwards, so
+    this should be run against a test database.
+    """
+    results = []
+    for scale in scales:
+        with transaction.atomic():
+            dataset = Dataset(scale)
+            client = Client()
+            client.login(username=dataset.teacher.username, password=dataset.password)
+            for label, name, url in get_cases(dataset):
+                result = dict(scale=scale, case=label, name=name, url=url, **measure(client, url, repeat))
+                results.append(result)
+                if progress:
+                    progress(result)
+            transaction.set_rollback(True)
+    return results
+
+def check(results, query_budgets=None, max_ms=None, max_peak_kb=None):
+    """Returns a list of messages describing every budget exceeded, empty if there are none"""
+    budgets = dict(QUERY_BUDGETS, **(query_budgets or {}))
+    failures = []
+    queries_by_case = {}
+    for result in results:
+        where = f'{result["case"]} with {result["scale"]} students'
+        if result['status'] >= 400:
+            failures.append(f'{where} returned {result["status"]}')
+        budget = budgets.get(result['name'], DEFAULT_QUERY_BUDGET)
+        if result['queries'] > budget:
+            failures.append(f'{where} made {result["queries"]} queries, the budget is {budget}')
+        if max_ms is not None and result['ms'] > max_ms:
+            failures.append(f'{where} took {result["ms"]} ms, the budget is {max_ms}')
+        if max_peak_kb is not None and result['peak_kb'] > max_peak_kb:
+            failures.append(f'{where} allocated {result["peak_kb"]} KB, the budget is {max_peak_kb}')
+        queries_by_case.setdefault(result['case'], []).append((result['scale'], result['queries']))
+    for case, counts in queries_by_case.items():
+        if len({queries for scale, queries in counts}) > 1:
+            counts = ', '.join(f'{queries} with {scale}' for scale, queries in sorted(counts))
+            failures.append(f'{case} makes more queries with more students: {counts}')
+    return failures
+
+def get_environment():
+    """Returns what the results were measured on, for comparing runs"""
+    return {
+        'time': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'machine': platform.machine(),
+        }
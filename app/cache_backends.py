@@ -0,0 +1,230 @@
+"""Django cache backends for Redis and the database, and an in-process stand-in for Redis.
+
+RedisCache talks to anything with the redis-py StrictRedis interface. By default
+it connects to LOCATION (a redis:// URL) with the redis package; if LOCATION is
+empty, or the CLIENT_CLASS option names LocalRedis, it uses LocalRedis instead,
+which keeps the data in this process. That lets the Redis code path be run and
+tested without a Redis server.
+
+DatabaseCache is Django's database cache with an atomic incr. Django's reads
+the value and writes it back, so two processes incrementing a counter at once
+can both get the same number, and the event logs (app.schedule_events) and
+version counters (app.fragment_cache) rely on every number being handed out
+once. It also reads several keys with one query.
+"""
+import base64
+import pickle
+import threading
+import time
+
+from django.core.cache.backends import db
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.db import connections, models, router, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+GET_MANY_BATCH_SIZE = 500   # keys DatabaseCache.get_many reads a query
+
+
+class LocalRedis:
+    """The part of the StrictRedis interface RedisCache uses, kept in memory"""
+
+    def __init__(self, *args, **kwargs):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls()
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._alive(key):
+                return None
+            self._data[key] = value
+            if ex is None:
+                self._expires.pop(key, None)
+            else:
+                self._expires[key] = time.time() + ex
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if self._alive(key):
+                    deleted += 1
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return deleted
+
+    def exists(self, key):
+        with self._lock:
+            return int(self._alive(key))
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if not self._alive(key):
+                return False
+            self._expires[key] = time.time() + seconds
+            return True
+
+    def persist(self, key):
+        with self._lock:
+            return self._expires.pop(key, None) is not None
+
+    def incrby(self, key, amount=1):
+        with self._lock:
+            value = int(self._data[key]) + amount if self._alive(key) else amount
+            self._data[key] = str(value).encode()
+            return value
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            return True
+
+
+class RedisCache(BaseCache):
+    """Cache backend storing pickled values in Redis, with integers kept as plain numbers so incr is atomic"""
+
+    def __init__(self, server, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        client_class = options.get('CLIENT_CLASS') or ('redis.StrictRedis' if server else 'app.cache_backends.LocalRedis')
+        if isinstance(client_class, str):
+            client_class = import_string(client_class)
+        self._client = client_class.from_url(server) if server else client_class()
+
+    def _encode(self, value):
+        # Integers are stored as text so Redis can increment them
+        if isinstance(value, int) and not isinstance(value, bool):
+            return str(value).encode()
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            return pickle.loads(value)
+
+    def _expiry(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        return None if timeout is None else max(int(timeout), 1)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self._client.set(key, self._encode(value), ex=self._expiry(timeout), nx=True))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        value = self._client.get(key)
+        return default if value is None else self._decode(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._client.set(key, self._encode(value), ex=self._expiry(timeout))
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        expiry = self._expiry(timeout)
+        if expiry is None:
+            self._client.persist(key)
+            return bool(self._client.exists(key))
+        return bool(self._client.expire(key, expiry))
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._client.delete(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self._client.exists(key))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        if not self._client.exists(key):
+            raise ValueError("Key '%s' not found" % key)
+        return self._client.incrby(key, delta)
+
+    def clear(self):
+        self._client.flushdb()
+
+
+class DatabaseCache(db.DatabaseCache):
+    """The database cache with incr made atomic, and get_many done with one query"""
+
+    def incr(self, key, delta=1, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        database = router.db_for_write(self.cache_model_class)
+        connection = connections[database]
+        quote_name = connection.ops.quote_name
+        with transaction.atomic(using=database), connection.cursor() as cursor:
+            # Writing the row first locks it, or on SQLite the whole database, so
+            # another incr waits here until this one commits and then reads its value
+            cursor.execute('UPDATE {table} SET {expires} = {expires} WHERE {cache_key} = %s'.format(
+                table=quote_name(self._table), expires=quote_name('expires'), cache_key=quote_name('cache_key')),
+                [made_key])
+            value = self.get(key, version=version) if cursor.rowcount else None
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            value += delta
+            # Only the value, so the key keeps its expiry
+            cursor.execute('UPDATE {table} SET {value} = %s WHERE {cache_key} = %s'.format(
+                table=quote_name(self._table), value=quote_name('value'), cache_key=quote_name('cache_key')),
+                [base64.b64encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).decode('latin1'), made_key])
+        return value
+
+    def get_many(self, keys, version=None):
+        made_keys = {self.make_key(key, version=version): key for key in keys}
+        for made_key in made_keys:
+            self.validate_key(made_key)
+        if not made_keys:
+            return {}
+        database = router.db_for_read(self.cache_model_class)
+        connection = connections[database]
+        quote_name = connection.ops.quote_name
+        rows = []
+        with connection.cursor() as cursor:
+            # In batches below SQLite's limit of 999 bound variables a statement
+            batch = list(made_keys)
+            for start in range(0, len(batch), GET_MANY_BATCH_SIZE):
+                keys = batch[start:start + GET_MANY_BATCH_SIZE]
+                cursor.execute('SELECT {cache_key}, {value}, {expires} FROM {table} WHERE {cache_key} IN ({keys})'.format(
+                    table=quote_name(self._table), cache_key=quote_name('cache_key'), value=quote_name('value'),
+                    expires=quote_name('expires'), keys=', '.join(['%s'] * len(keys))),
+                    keys)
+                rows += cursor.fetchall()
+        # Converted as DatabaseCache.get does. Expired rows are left for get or a cull to delete
+        expression = models.Expression(output_field=models.DateTimeField())
+        converters = connection.ops.get_db_converters(expression) + expression.get_db_converters(connection)
+        now = timezone.now()
+        found = {}
+        for made_key, value, expires in rows:
+            for converter in converters:
+                expires = converter(expires, expression, connection)
+            if expires >= now:
+                value = connection.ops.process_clob(value)
+                found[made_keys[made_key]] = pickle.loads(base64.b64decode(value.encode()))
+        return found
@@ -0,0 +1,43 @@
+"""System checks run by manage.py check and before every management command."""
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+
+from app.cache_backends import DatabaseCache, LocalRedis, RedisCache
+
+
+def is_process_local(cache):
+    """Returns whether a cache keeps its data in the memory of this process"""
+    backend = type(cache)
+    if backend.__module__ == 'django.core.cache.backends.locmem':
+        return True
+    return isinstance(cache, RedisCache) and isinstance(cache._client, LocalRedis)
+
+def has_atomic_incr(cache):
+    """Returns whether two processes, or threads, incrementing the same key of a cache always get different numbers"""
+    # locmem increments under a lock, within the one process it serves
+    return (isinstance(cache, (DatabaseCache, RedisCache))
+            or type(cache).__module__ == 'django.core.cache.backends.locmem')
+
+@checks.register(checks.Tags.caches)
+def check_schedule_cache(app_configs, **kwargs):
+    """Fails when several workers would each keep their own "schedules" cache, or when its incr isn't atomic.
+
+    A change saved through one worker would only move that worker's version
+    counters and event log, and the others would go on serving stale pages.
+    Two events published at once given the same number would overwrite one
+    another, and the pages would miss one of them.
+    """
+    cache = caches['schedules']
+    errors = []
+    if settings.WEB_CONCURRENCY > 1 and is_process_local(cache):
+        errors.append(checks.Error(
+            f'The "schedules" cache is kept in each process, but WEB_CONCURRENCY is {settings.WEB_CONCURRENCY}',
+            hint='Set SCHEDULE_CACHE to database or redis (with REDIS_URL), see RSPscheduler/settings.py',
+            id='app.E001'))
+    if not has_atomic_incr(cache):
+        errors.append(checks.Error(
+            f'The "schedules" cache backend {type(cache).__module__}.{type(cache).__name__} does not increment atomically',
+            hint='Set SCHEDULE_CACHE to database or redis, see RSPscheduler/settings.py',
+            id='app.E002'))
+    return errors
@@ -0,0 +1,100 @@
+"""Copies a schedule and its appointments, e.g. to start the next term from this one.
+
+Appointments are tied to days of the week rather than dates, so a copy keeps
+every day and time and only the schedule's dates change. The appointments are
+read with one query, their services with another, and the copies written with
+bulk_create, all in one transaction, so thousands of appointments take a
+fraction of a second and a failed copy leaves nothing behind.
+
+Along the way appointments can be
+
+* remapped: service_map sends the appointments of one service to another,
+  e.g. when a student's service was replaced by a new one
+* left out when the student has left: the service or its student has been
+  deleted, or the student is no longer on the teacher's caseload
+* left out when the service already has all its time without the schedule
+  being copied, from other active schedules
+"""
+from django.db import transaction
+
+from app.fragment_cache import invalidate_schedule
+from app.models import Schedule, Service, ServiceInstance
+from app.workload import ScheduleLoad
+
+# Rows per INSERT. SQLite before 3.32 allows 999 bound variables a statement, so
+# there bulk_create lowers it to 999 // the number of fields (142 appointments)
+BATCH_SIZE = 500
+
+
+class CloneError(Exception):
+    pass
+
+
+class CloneReport:
+    """The new schedule and what happened to the appointments of the old one"""
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.copied = 0
+        self.remapped = 0
+        self.skipped_departed = 0
+        self.skipped_satisfied = 0
+
+    def __str__(self):
+        return (f'{self.copied} appointments copied to "{self.schedule.title}" ({self.remapped} remapped), '
+                f'{self.skipped_departed} skipped for students who have left, '
+                f'{self.skipped_satisfied} skipped for services with all their time')
+
+
+def clone_schedule(source, title, start_date=None, end_date=None, teacher=None, service_map=None,
+                   skip_departed=True, skip_satisfied=False, activate=False):
+    """Copies source and its appointments to a new schedule and returns a CloneReport.
+
+    The copy belongs to teacher, by default the teacher of source, and is only
+    made the active schedule if activate is set. service_map maps service ids to
+    the ids of the services their appointments are copied to. Raises CloneError
+    if one of those services doesn't exist.
+    """
+    teacher = teacher if teacher is not None else source.teacher
+    teacher_id = teacher.pk if teacher is not None else None
+    service_map = service_map or {}
+    with transaction.atomic():
+        rows = list(ServiceInstance.objects.filter(scheduled_for=source).order_by('pk')
+                    .values_list('service_id', 'day', 'time_start', 'time_end', 'resource_id'))
+        service_ids = {service_map.get(service_id, service_id) for service_id, day, time_start, time_end, resource_id in rows}
+        services = {pk: (student_teacher_id, allocated_minutes, total_time_req)
+                    for pk, student_teacher_id, allocated_minutes, total_time_req in
+                    Service.objects.filter(pk__in=service_ids - {None})
+                    .values_list('pk', 'student__teacher_id', 'allocated_minutes', 'total_time_req')}
+        missing = sorted(set(service_map.values()) - set(services))
+        if missing:
+            raise CloneError(f'There is no service {", ".join(str(pk) for pk in missing)} to remap to')
+        # An active source's own minutes are part of allocated_minutes but won't be once it is replaced
+        source_minutes = ScheduleLoad.for_schedule(source).service_totals if skip_satisfied and source.active else {}
+
+        schedule = Schedule.objects.create(title=title, start_date=start_date, end_date=end_date, teacher=teacher,
+                                           day_start=source.day_start, day_end=source.day_end,
+                                           blocked_periods=source.blocked_periods)
+        report = CloneReport(schedule)
+        copies = []
+        for service_id, day, time_start, time_end, resource_id in rows:
+            if service_id in service_map:
+                service_id = service_map[service_id]
+                report.remapped += 1
+            service = services.get(service_id)
+            if skip_departed and (service is None or service[0] != teacher_id):
+                report.skipped_departed += 1
+                continue
+            if skip_satisfied and service is not None and service[1] - source_minutes.get(service_id, 0) >= service[2]:
+                report.skipped_satisfied += 1
+                continue
+            copies.append(ServiceInstance(service_id=service_id, day=day, time_start=time_start, time_end=time_end,
+                                          scheduled_for=schedule, resource_id=resource_id))
+        ServiceInstance.objects.bulk_create(copies, batch_size=BATCH_SIZE)
+        report.copied = len(copies)
+        if activate:
+            # Saving sends the signals that refresh the services' allocated minutes
+            schedule.activate()
+    # bulk_create doesn't send signals, so the new schedule's page is invalidated here
+    invalidate_schedule(schedule.pk)
+    return report
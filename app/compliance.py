@@ -0,0 +1,146 @@
+"""Keeps a district-wide summary of how far services are from their required minutes.
+
+Which students are under-served, by subject and service type, across every
+teacher, would mean reading every service of the district. Instead each
+teacher's services are summed into one ComplianceSummary row per subject and
+service type: how many services and students there are, how many of them are
+short of minutes, and the minutes required, allocated and missing. The report
+then adds up a few rows per teacher, however many students there are.
+
+A teacher's rows only change when one of their services changes its minutes,
+subject or type, or is added or removed, or a student moves between teachers.
+app.allocation refreshes the teachers of the services whose allocated minutes
+it changed, and the signal handlers in app.signals and the roster importer do
+the rest. Like app.allocation, refreshing never adds or subtracts: a teacher's
+rows are summed again from their services, with the teacher's row locked so
+two refreshes can't both insert, and only rows whose totals changed are
+written. rebuild(), run by the rebuild_compliance command, does every teacher.
+"""
+import csv
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from app.exports import Echo
+from app.models import ComplianceSummary, Service, Student
+
+# Totals of each row, all of which add up across teachers
+FIELDS = ('services', 'unsatisfied_services', 'students', 'underserved_students',
+          'required_minutes', 'allocated_minutes', 'missing_minutes')
+# Rows per INSERT, and read at a time by the export. SQLite before 3.32 allows 999
+# bound variables a statement, so there bulk_create lowers it to 999 // the number
+# of fields (90 summary rows)
+BATCH_SIZE = 500
+REBUILD_CHUNK = 100     # teachers refreshed at a time by rebuild()
+REPORT_ROWS = 100       # teachers' rows shown on the report, the export has them all
+
+CSV_HEADER = ('teacher', 'subject', 'service_type') + FIELDS
+
+
+def get_aggregates():
+    """Returns the aggregates over services making up each of FIELDS, using field names only"""
+    short = Q(allocated_minutes__lt=F('total_time_req'))
+    return {
+        'services': Count('pk'),
+        'unsatisfied_services': Count('pk', filter=short),
+        'students': Count('student', distinct=True),
+        'underserved_students': Count('student', distinct=True, filter=short),
+        'required_minutes': Sum('total_time_req'),
+        'allocated_minutes': Sum('allocated_minutes'),
+        'missing_minutes': Coalesce(Sum(F('total_time_req') - F('allocated_minutes'), filter=short), Value(0)),
+        }
+
+def summarise(services):
+    """Returns the query summing a queryset of services by teacher, subject and service type"""
+    # The aggregates are renamed, some FIELDS are also the names of Service fields
+    return (services.filter(student__teacher__isnull=False)
+            .order_by()
+            .values('student__teacher_id', 'subject', 'service_type')
+            .annotate(**{'total_' + name: aggregate for name, aggregate in get_aggregates().items()}))
+
+def get_totals(services):
+    """Yields ((teacher id, subject, service type), totals) for a queryset of services, summed by the database"""
+    for row in summarise(services):
+        yield ((row['student__teacher_id'], row['subject'], row['service_type']),
+               {name: row['total_' + name] or 0 for name in FIELDS})
+
+
+def refresh_teachers(teacher_ids):
+    """Sums the summary rows of the given teachers again, writing the ones that changed. Returns how many did"""
+    teacher_ids = sorted(set(teacher_ids) - {None})
+    if not teacher_ids:
+        return 0
+    with transaction.atomic():
+        list(User.objects.select_for_update().filter(pk__in=teacher_ids).values_list('pk'))
+        wanted = dict(get_totals(Service.objects.filter(student__teacher_id__in=teacher_ids)))
+        current = {(row.teacher_id, row.subject, row.service_type): row
+                   for row in ComplianceSummary.objects.filter(teacher_id__in=teacher_ids)}
+
+        stale = [row.pk for key, row in current.items() if key not in wanted]
+        ComplianceSummary.objects.filter(pk__in=stale).delete()
+        new = []
+        changed = 0
+        now = timezone.now()
+        for (teacher_id, subject, service_type), totals in wanted.items():
+            row = current.get((teacher_id, subject, service_type))
+            if row is None:
+                new.append(ComplianceSummary(teacher_id=teacher_id, subject=subject, service_type=service_type, **totals))
+            elif any(getattr(row, name) != value for name, value in totals.items()):
+                # update() skips auto_now
+                ComplianceSummary.objects.filter(pk=row.pk).update(updated_at=now, **totals)
+                changed += 1
+        ComplianceSummary.objects.bulk_create(new, batch_size=BATCH_SIZE)
+    return len(stale) + changed + len(new)
+
+def refresh_for_services(service_ids):
+    """Refreshes the summary rows of the teachers of the given services"""
+    refresh_teachers(Service.objects.filter(pk__in=service_ids).order_by()
+                     .values_list('student__teacher_id', flat=True).distinct())
+
+def rebuild():
+    """Sums every teacher's rows again from scratch. Returns how many rows were wrong"""
+    teacher_ids = set(Student.objects.order_by().values_list('teacher_id', flat=True).distinct())
+    teacher_ids |= set(ComplianceSummary.objects.order_by().values_list('teacher_id', flat=True).distinct())
+    teacher_ids = sorted(teacher_ids - {None})
+    return sum(refresh_teachers(teacher_ids[start:start + REBUILD_CHUNK])
+               for start in range(0, len(teacher_ids), REBUILD_CHUNK))
+
+
+def get_district_totals():
+    """Returns the totals of every teacher by subject and service type, and a grand total, with two queries"""
+    summaries = ComplianceSummary.objects.order_by()
+    aggregates = {'total_' + name: Sum(name) for name in FIELDS}
+    rows = summaries.values('subject', 'service_type').annotate(**aggregates).order_by('subject', 'service_type')
+    grand_total = summaries.aggregate(**aggregates)
+    return ([dict(subject=row['subject'], service_type=row['service_type'],
+                  **{name: row['total_' + name] or 0 for name in FIELDS}) for row in rows],
+            {name: grand_total['total_' + name] or 0 for name in FIELDS})
+
+def get_underserved():
+    """Returns the teachers' rows with students short of minutes, those missing the most minutes first"""
+    return (ComplianceSummary.objects
+            .filter(underserved_students__gt=0)
+            .select_related('teacher')
+            .order_by('-missing_minutes', 'teacher__username', 'subject', 'service_type'))
+
+
+def iter_csv(summaries):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for summary in summaries:
+        yield writer.writerow((summary.teacher.get_username(), summary.subject, summary.service_type) +
+                              tuple(getattr(summary, name) for name in FIELDS))
+
+def export_response():
+    """Returns a StreamingHttpResponse with every teacher's summary rows as a CSV file"""
+    summaries = (ComplianceSummary.objects
+                 .select_related('teacher')
+                 .order_by('teacher__username', 'subject', 'service_type')
+                 .iterator(chunk_size=BATCH_SIZE))
+    response = StreamingHttpResponse(iter_csv(summaries), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="compliance.csv"'
+    return response
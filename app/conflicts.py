@@ -0,0 +1,80 @@
+"""Finds service appointments that overlap.
+
+A teacher can't be in two appointments at once, so no two appointments of a
+schedule may overlap on the same day; when both are Pull-Outs for the same
+student the student is double-booked as well.
+
+find_conflict asks the database for one appointment overlapping a new one,
+which the (schedule, day, start) index narrows to the appointments of that day
+starting before the new one ends. get_conflicts lists every overlapping pair in
+a schedule with a sweep over the sorted appointments, which is O(n log n) plus
+the number of conflicts found rather than comparing every pair.
+"""
+import heapq
+from collections import defaultdict, namedtuple
+
+from app.models import ServiceInstance
+
+# Two overlapping appointments; kind is 'student' when a student is pulled out
+# twice at once and 'teacher' otherwise
+Conflict = namedtuple('Conflict', 'kind first second')
+
+
+def get_overlapping(schedule, day, time_start, time_end, exclude=None):
+    """Returns the appointments of schedule overlapping the given day and times, leaving out the one with pk exclude"""
+    serviceinstances = ServiceInstance.objects.filter(scheduled_for=schedule, day=day,
+                                                      time_start__lt=time_end, time_end__gt=time_start)
+    if exclude is not None:
+        serviceinstances = serviceinstances.exclude(pk=exclude)
+    return serviceinstances
+
+def find_conflict(schedule, day, time_start, time_end, exclude=None):
+    """Returns an appointment of schedule overlapping the given day and times, or None, with one query"""
+    # The first one is enough to tell the teacher what is in the way
+    return (get_overlapping(schedule, day, time_start, time_end, exclude=exclude)
+            .select_related('service__student').order_by('time_start', 'pk').first())
+
+def get_kind(first, second):
+    if (first.service and second.service and first.service.student_id is not None
+            and first.service.student_id == second.service.student_id
+            and first.service.service_type == second.service.service_type == 'Pull-Out'):
+        return 'student'
+    return 'teacher'
+
+def get_timed(serviceinstances):
+    """Returns the appointments of a queryset that are on the grid, ready for find_overlaps"""
+    return (serviceinstances
+            .exclude(time_start=None).exclude(time_end=None)
+            .with_minutes()
+            .select_related('service__student')
+            .order_by('day', 'time_start'))
+
+def get_conflicts(schedule):
+    """Returns every pair of overlapping appointments in a schedule as Conflicts, with one query"""
+    return find_overlaps(get_timed(ServiceInstance.objects.filter(scheduled_for=schedule)))
+
+def find_overlaps(serviceinstances):
+    """Returns every pair of overlapping appointments among serviceinstances, annotated with_minutes, as Conflicts.
+
+    The appointments of each day are swept in start order while a heap holds the
+    ones still running, so each appointment is only compared with those it
+    actually overlaps.
+    """
+    days = defaultdict(list)
+    for serviceinstance in sorted(serviceinstances, key=lambda serviceinstance: (serviceinstance.day,
+                                                                                serviceinstance.start_minute)):
+        days[serviceinstance.day].append(serviceinstance)
+
+    conflicts = []
+    for day, serviceinstances in days.items():
+        running = []    # heap of (end, position) of appointments that started and haven't ended
+        for position, serviceinstance in enumerate(serviceinstances):
+            start, end = serviceinstance.start_minute, serviceinstance.end_minute
+            while running and running[0][0] <= start:
+                heapq.heappop(running)
+            for running_end, other in running:
+                other = serviceinstances[other]
+                conflicts.append(Conflict(get_kind(other, serviceinstance), other, serviceinstance))
+            if end > start:
+                heapq.heappush(running, (end, position))
+    return conflicts
@@ -0,0 +1,138 @@
+"""Counts visits and other usage without writing to the database on every request.
+
+The home page used to count visits in the session, which with database
+sessions is an UPDATE on every load, and counted every student in the table.
+Instead, increment() adds to a counter in this process's memory, and the
+counts are written to UsageCount rows in one go once FLUSH_INTERVAL seconds
+have passed or FLUSH_THRESHOLD increments are waiting, whichever is first.
+Whether the interval has passed is checked at every increment and at the end
+of every request, and what is left is written when the process exits. A count
+that fails to be written is kept for the next flush; only a worker that is
+killed outright loses the visits it hadn't written. get_count() is the
+written count, cached in the "schedules" cache, plus what this process hasn't
+written yet, so it may lag behind the other workers' visits for up to
+FLUSH_INTERVAL, which is fine for a counter on a page.
+
+get_student_count() caches the number of a teacher's students under the
+teacher's version counter (app.fragment_cache), so the signal handlers in
+app.signals, and the bulk importers, invalidate it along with the teacher's
+schedule pages.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.core.signals import request_finished
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.dispatch import receiver
+
+from app.fragment_cache import get_cache, get_version
+from app.models import Student, UsageCount
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 60         # seconds between writes of the counts
+FLUSH_THRESHOLD = 1000      # increments waiting that bring the write forward
+COUNT_TIMEOUT = 5 * 60      # seconds a written count or a student count is cached
+
+
+class CounterBuffer:
+    """Increments of this process not written to the database yet"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pending = Counter()    # (name, key) -> amount
+        self.waiting = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, name, key, amount=1):
+        """Adds to a count, and returns whether it's time to flush"""
+        with self._lock:
+            self.pending[name, key] += amount
+            self.waiting += 1
+            return self.is_due()
+
+    def is_due(self):
+        return self.waiting >= FLUSH_THRESHOLD or time.monotonic() - self.last_flush >= FLUSH_INTERVAL
+
+    def get(self, name, key):
+        with self._lock:
+            return self.pending[name, key]
+
+    def take(self):
+        """Returns the pending amounts and starts afresh"""
+        with self._lock:
+            pending, self.pending = self.pending, Counter()
+            self.waiting = 0
+            self.last_flush = time.monotonic()
+            return pending
+
+    def put_back(self, pending):
+        with self._lock:
+            self.pending.update(pending)
+
+buffer = CounterBuffer()
+
+
+def get_count_key(name, key):
+    return f'count:{name}:{key}'
+
+def increment(name, key='', amount=1):
+    """Adds amount to the count of name for key, writing the counts if they're due"""
+    if buffer.add(name, str(key), amount):
+        flush()
+
+def get_count(name, key=''):
+    """Returns the count of name for key, including what this process hasn't written yet"""
+    key = str(key)
+
+    def load():
+        return UsageCount.objects.filter(name=name, key=key).values_list('count', flat=True).first() or 0
+    return get_cache().get_or_set(get_count_key(name, key), load, COUNT_TIMEOUT) + buffer.get(name, key)
+
+def flush():
+    """Writes the pending counts to the database, one UPDATE per count, in one transaction"""
+    pending = buffer.take()
+    if not pending:
+        return
+    try:
+        with transaction.atomic():
+            for (name, key), amount in pending.items():
+                if not UsageCount.objects.filter(name=name, key=key).update(count=F('count') + amount):
+                    try:
+                        with transaction.atomic():
+                            UsageCount.objects.create(name=name, key=key, count=amount)
+                    except IntegrityError:
+                        # Another worker wrote it first
+                        UsageCount.objects.filter(name=name, key=key).update(count=F('count') + amount)
+    except Exception:
+        logger.exception('Writing %s usage counts failed, keeping them for the next flush', len(pending))
+        buffer.put_back(pending)
+        return
+    cache = get_cache()
+    for (name, key), amount in pending.items():
+        try:
+            cache.incr(get_count_key(name, key), amount)
+        except ValueError:
+            pass    # not cached, it's read from the database next time
+
+@receiver(request_finished)
+def flush_if_due(**kwargs):
+    """Writes the counts at the end of a request once they're due, so a worker seeing no more increments still does"""
+    if buffer.waiting and buffer.is_due():
+        flush()
+
+@atexit.register
+def flush_at_exit():
+    """Writes what is left when the process exits"""
+    if buffer.waiting:
+        flush()
+
+
+def get_student_count(teacher_id):
+    """Returns how many students a teacher has, cached until one of them changes"""
+    key = f'students:{teacher_id}:{get_version("teacher", teacher_id)}'
+    return get_cache().get_or_set(key, lambda: Student.objects.filter(teacher_id=teacher_id).count(), COUNT_TIMEOUT)
@@ -0,0 +1,140 @@
+"""Streams schedules as CSV or iCalendar (RFC 5545) files.
+
+An export can cover one schedule, every schedule of a teacher or every active
+schedule, so it may run to many thousands of appointments. The rows are read
+with a single query following the service, student, schedule and teacher
+foreign keys, iterated in chunks rather than cached on the queryset, and each
+line is written out as soon as it is made, so memory use stays flat whatever
+the size of the export.
+
+In the calendar, each appointment becomes one weekly recurring event on its
+day, from the first such day on or after the schedule's start date until its
+end date. Times are written as floating local times, since appointments are
+set by the clock on the classroom wall.
+"""
+import csv
+import datetime
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from app.grid import DAYS
+from app.models import ServiceInstance
+
+FORMATS = ('csv', 'ics')
+CHUNK_SIZE = 2000   # rows fetched from the database at a time
+
+CSV_HEADER = ('schedule', 'teacher', 'schedule_start', 'schedule_end', 'active', 'last_name', 'first_name',
+              'subject', 'service_type', 'day', 'time_start', 'time_end', 'minutes')
+WEEKDAYS = {day: index for index, day in enumerate(DAYS)}  # DAYS starts on Monday, like date.weekday()
+BYDAY = ('MO', 'TU', 'WE', 'TH', 'FR')
+
+
+def get_rows(schedules):
+    """Yields every appointment on a queryset of schedules with everything an export shows, from one query"""
+    return (ServiceInstance.objects
+            .filter(scheduled_for__in=schedules)
+            .select_related('service__student', 'scheduled_for__teacher')
+            .order_by('scheduled_for_id', 'day', 'time_start', 'pk')
+            .iterator(chunk_size=CHUNK_SIZE))
+
+
+class Echo:
+    """A file-like object handing back what is written to it, so csv.writer can make lines one at a time"""
+
+    def write(self, value):
+        return value
+
+def iter_csv(serviceinstances):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for instance in serviceinstances:
+        schedule, service = instance.scheduled_for, instance.service
+        student = service.student if service else None
+        yield writer.writerow((
+            schedule.title,
+            schedule.teacher.get_username() if schedule.teacher else '',
+            schedule.start_date or '',
+            schedule.end_date or '',
+            schedule.active,
+            student.last_name if student else '',
+            student.first_name if student else '',
+            service.subject if service else '',
+            service.service_type if service else '',
+            instance.day,
+            instance.time_start.strftime('%H:%M') if instance.time_start else '',
+            instance.time_end.strftime('%H:%M') if instance.time_end else '',
+            instance.duration if instance.duration is not None else '',
+            ))
+
+
+def escape_text(text):
+    """Escapes a TEXT property value"""
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def content_line(name, value):
+    """Returns a content line, folded so no line is longer than 75 octets"""
+    line = f'{name}:{value}'.encode('utf-8')
+    parts = []
+    limit = 75
+    while len(line) > limit:
+        # Don't split a multi-byte character
+        cut = limit
+        while cut > 0 and (line[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+        limit = 74  # continuation lines start with a space
+    parts.append(line)
+    return b'\r\n '.join(parts).decode('utf-8') + '\r\n'
+
+def first_occurrence(start_date, day):
+    """Returns the first date falling on day (e.g. "Monday") on or after start_date"""
+    return start_date + datetime.timedelta(days=(WEEKDAYS[day] - start_date.weekday()) % 7)
+
+def iter_ics(serviceinstances, name):
+    stamp = timezone.now().strftime('%Y%m%dT%H%M%SZ')
+    yield content_line('BEGIN', 'VCALENDAR')
+    yield content_line('VERSION', '2.0')
+    yield content_line('PRODID', '-//RSPscheduler//Schedule export//EN')
+    yield content_line('CALSCALE', 'GREGORIAN')
+    yield content_line('X-WR-CALNAME', escape_text(name))
+    for instance in serviceinstances:
+        schedule, service = instance.scheduled_for, instance.service
+        # An appointment without a time, or whose schedule has no start date, can't go on a calendar
+        if not instance.duration or schedule.start_date is None or instance.day not in WEEKDAYS:
+            continue
+        first = first_occurrence(schedule.start_date, instance.day)
+        if schedule.end_date is not None and first > schedule.end_date:
+            continue
+        rule = f'FREQ=WEEKLY;BYDAY={BYDAY[WEEKDAYS[instance.day]]}'
+        if schedule.end_date is not None:
+            # DTSTART is a floating time, so UNTIL must be one too
+            rule += ';UNTIL=' + schedule.end_date.strftime('%Y%m%dT235959')
+        student = service.student if service else None
+        summary = ' '.join(part for part in (service.subject, service.service_type) if part) if service else 'Appointment'
+        if student:
+            summary += f': {student}'
+        yield content_line('BEGIN', 'VEVENT')
+        yield content_line('UID', f'serviceinstance-{instance.pk}@rspscheduler')
+        yield content_line('DTSTAMP', stamp)
+        yield content_line('DTSTART', datetime.datetime.combine(first, instance.time_start).strftime('%Y%m%dT%H%M%S'))
+        yield content_line('DTEND', datetime.datetime.combine(first, instance.time_end).strftime('%Y%m%dT%H%M%S'))
+        yield content_line('RRULE', rule)
+        yield content_line('SUMMARY', escape_text(summary))
+        yield content_line('DESCRIPTION', escape_text(schedule.title))
+        yield content_line('END', 'VEVENT')
+    yield content_line('END', 'VCALENDAR')
+
+
+def export_response(schedules, format, name):
+    """Returns a StreamingHttpResponse with every appointment on a queryset of schedules as a CSV or iCalendar file"""
+    rows = get_rows(schedules)
+    if format == 'csv':
+        response = StreamingHttpResponse(iter_csv(rows), content_type='text/csv; charset=utf-8')
+    else:
+        response = StreamingHttpResponse(iter_ics(rows, name), content_type='text/calendar; charset=utf-8')
+    filename = ''.join(character if character.isalnum() or character in '-_' else '_' for character in name)
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{format}"'
+    return response
@@ -1,13 +1,21 @@
 from django import forms
 from django.forms import ModelForm
 from django.core.exceptions import ValidationError
-from app.models import Student, Service, ServiceInstance, Schedule
+from app.models import Student, Service, ServiceInstance, Schedule, to_minutes
 from django.contrib.auth.models import User
+from app.grid import DAYS, format_minutes
+from app.solver import Block, SESSION_MINUTES, TIME_BUDGET
+from app.autocomplete import AutocompleteSelect
+from app.conflicts import find_conflict, get_kind
+from app.occupancy import OccupancyMap, find_free_slots
+from app.roster import STATUSES
+import datetime
 
 class CreateServiceForm(ModelForm):
     class Meta:
         model = Service
         fields = '__all__'
+        widgets = {'student': AutocompleteSelect('students')}
 
 class CreateScheduleForm(ModelForm):
     start_date = forms.DateField(widget=forms.SelectDateWidget)
@@ -22,6 +30,63 @@ class CreateServiceInstanceForm(ModelForm):
         model = ServiceInstance
         fields = '__all__'
         widgets = {'scheduled_for': forms.HiddenInput(),
+                   'service': AutocompleteSelect('services'),
+                   'time_start': forms.TimeInput(format="%H:%M"),
+                   'time_end': forms.TimeInput(format="%H:%M")}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The chosen service is labelled with its student, fetch it in the same query
+        self.fields['service'].queryset = self.fields['service'].queryset.select_related('student')
+
+    def clean(self):
+        # Makes sure the appointment doesn't overlap another one on the same schedule
+        cleaned_data = super().clean()
+        time_start, time_end = cleaned_data.get('time_start'), cleaned_data.get('time_end')
+        schedule, day = cleaned_data.get('scheduled_for'), cleaned_data.get('day')
+        if time_start and time_end:
+            if time_end <= time_start:
+                raise ValidationError('The appointment must end after it starts')
+            if schedule and day:
+                conflict = find_conflict(schedule, day, time_start, time_end, exclude=self.instance.pk)
+                if conflict:
+                    service = cleaned_data.get('service')
+                    if service and conflict.service and get_kind(ServiceInstance(service=service), conflict) == 'student':
+                        message = '{student} is already pulled out for {subject} from {start} to {end}'
+                    else:
+                        message = 'You already have {student} for {subject} from {start} to {end}'
+                    raise ValidationError(message.format(
+                        student=conflict.service.student if conflict.service else 'an appointment',
+                        subject=conflict.service.subject if conflict.service else 'a service',
+                        start=conflict.time_start.strftime("%I:%M"), end=conflict.time_end.strftime("%I:%M")))
+                self.clean_capacity(cleaned_data)
+        return cleaned_data
+
+    def clean_capacity(self, cleaned_data):
+        # Makes sure the room or staff has space, across every teacher's active schedule
+        service, resource = cleaned_data.get('service'), cleaned_data.get('resource')
+        if resource is None and service is not None and service.resource_id is not None:
+            resource = cleaned_data['resource'] = service.resource
+        day = cleaned_data['day']
+        if resource is None or day not in DAYS:
+            return
+        start, end = to_minutes(cleaned_data['time_start']), to_minutes(cleaned_data['time_end'])
+        occupancy = OccupancyMap.load([resource.pk], schedule=cleaned_data['scheduled_for'],
+                                      exclude=[self.instance.pk] if self.instance.pk else (), granularity=1)
+        if occupancy.fits(resource.pk, DAYS.index(day), start, end):
+            return
+        message = f'{resource} already has {resource.capacity} appointments at that time'
+        if service is not None and service.resource_id == resource.pk:
+            free = find_free_slots(cleaned_data['scheduled_for'], service, end - start, day=DAYS.index(day))
+            if free:
+                message += ', on {day} it is free at {times}'.format(
+                    day=day, times=', '.join(format_minutes(start) for index, start in free[:5]))
+        raise ValidationError(message)
+
+class UpdateServiceInstanceForm(CreateServiceInstanceForm):
+    class Meta(CreateServiceInstanceForm.Meta):
+        widgets = {'scheduled_for': AutocompleteSelect('schedules'),
+                   'service': AutocompleteSelect('services'),
                    'time_start': forms.TimeInput(format="%H:%M"),
                    'time_end': forms.TimeInput(format="%H:%M")}
 
@@ -31,3 +96,101 @@ class CreateStudentForm(ModelForm):
         fields = '__all__'
         widgets = {'teacher': forms.HiddenInput(),
                    'id': forms.HiddenInput()}
+
+def parse_blocked_periods(text):
+    """Turns each line, like "Monday 11:30-12:00" or "Every day 11:30-12:00", into a Block for the solver"""
+    blocks = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            day, times = line.rsplit(' ', 1)
+            start, end = (to_minutes(datetime.datetime.strptime(t, '%H:%M').time()) for t in times.split('-'))
+        except ValueError:
+            raise ValidationError(f'Could not read "{line}", use e.g. "Monday 11:30-12:00"')
+        if day.lower() == 'every day':
+            day = None
+        elif day.capitalize() in DAYS:
+            day = DAYS.index(day.capitalize())
+        else:
+            raise ValidationError(f'"{day}" is not a school day')
+        if end <= start:
+            raise ValidationError(f'"{line}" ends before it starts')
+        blocks.append(Block(day, start, end))
+    return blocks
+
+def format_blocked_periods(blocks):
+    """Turns Blocks back into the lines parse_blocked_periods reads"""
+    return '\n'.join('{day} {start:02d}:{start_minute:02d}-{end:02d}:{end_minute:02d}'.format(
+        day='Every day' if block.day is None else DAYS[block.day], start=block.start // 60, start_minute=block.start % 60,
+        end=block.end // 60, end_minute=block.end % 60) for block in blocks)
+
+class GenerateScheduleForm(forms.Form):
+    session_minutes = forms.TypedChoiceField(choices=[(minutes, f'{minutes} minutes') for minutes in (15, 30, 45, 60)],
+                                             coerce=int, initial=SESSION_MINUTES,
+                                             help_text='Longest appointment a service is split into')
+    day_start = forms.TimeField(initial=datetime.time(hour=7), widget=forms.TimeInput(format="%H:%M"),
+                                help_text='Earliest time you are available')
+    day_end = forms.TimeField(initial=datetime.time(hour=16), widget=forms.TimeInput(format="%H:%M"),
+                              help_text='Latest time you are available')
+    blocked_periods = forms.CharField(required=False, widget=forms.Textarea(attrs={'rows': 4}),
+                                      help_text='One per line, e.g. "Every day 11:30-12:00" or "Friday 13:00-15:00"')
+    time_budget = forms.IntegerField(min_value=1, max_value=60, initial=int(TIME_BUDGET),
+                                     help_text='Seconds to spend looking for a better schedule')
+
+    def clean_blocked_periods(self):
+        return parse_blocked_periods(self.cleaned_data['blocked_periods'])
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('day_start') and cleaned_data.get('day_end') and cleaned_data['day_end'] <= cleaned_data['day_start']:
+            raise ValidationError('Your day must end after it starts')
+        return cleaned_data
+
+class ImportRosterForm(forms.Form):
+    file = forms.FileField(help_text='CSV with a header row, or JSON Lines with one object per line')
+    format = forms.ChoiceField(choices=[('', 'Work out from the file name'), ('csv', 'CSV'), ('jsonl', 'JSON Lines')],
+                               required=False)
+
+class StudentSearchForm(forms.Form):
+    q = forms.CharField(max_length=40, required=False, label='Name',
+                        widget=forms.TextInput(attrs={'placeholder': 'Start of a first or last name'}))
+    status = forms.ChoiceField(choices=STATUSES, required=False)
+
+class CloneScheduleForm(forms.Form):
+    title = forms.CharField(max_length=200, help_text='Enter title for the new schedule')
+    start_date = forms.DateField(widget=forms.SelectDateWidget)
+    end_date = forms.DateField(widget=forms.SelectDateWidget)
+    skip_departed = forms.BooleanField(required=False, initial=True,
+                                       label='Leave out students who have left')
+    skip_satisfied = forms.BooleanField(required=False,
+                                        label='Leave out services that have all their time without this schedule')
+    activate = forms.BooleanField(required=False, label='Make the new schedule the active one')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('start_date') and cleaned_data.get('end_date') and cleaned_data['end_date'] < cleaned_data['start_date']:
+            raise ValidationError('The schedule must end after it starts')
+        return cleaned_data
+
+class RepairScheduleForm(forms.Form):
+    services = forms.ModelMultipleChoiceField(queryset=Service.objects.none(), required=False,
+                                              help_text='Services that were added or had their time changed')
+    blocked_periods = forms.CharField(required=False, widget=forms.Textarea(attrs={'rows': 4}),
+                                      help_text='Time you are no longer free, one per line, e.g. "Friday 13:00-15:00"')
+    preview = forms.BooleanField(required=False, initial=True, label='Only show what would change')
+
+    def __init__(self, *args, teacher=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Each choice is labelled with its student, fetch them all in the same query
+        self.fields['services'].queryset = Service.objects.filter(student__teacher=teacher).select_related('student')
+
+    def clean_blocked_periods(self):
+        return parse_blocked_periods(self.cleaned_data['blocked_periods'])
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('services') and not cleaned_data.get('blocked_periods') and not self.errors:
+            raise ValidationError('Choose the services that changed or enter the time you are no longer free')
+        return cleaned_data
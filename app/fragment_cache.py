@@ -0,0 +1,98 @@
+"""Caches the rendered parts of the schedule detail page.
+
+Schedules change rarely but are viewed all day, so the weekly grid and the
+students' satisfaction badges are kept rendered in the "schedules" cache. Each
+entry's key includes two version counters:
+
+* the schedule's, bumped whenever one of its appointments, or the schedule
+  itself, changes
+* the teacher's, bumped whenever one of their students or services changes or
+  one of their schedules is activated, since that can change what every one of
+  their schedules shows
+
+Bumping a counter makes every key built from the old value unreachable, so
+nothing has to be deleted; stale entries simply expire. Counters start from the
+current time in milliseconds, so one that is evicted from the cache restarts
+above any value it had before. The counters are bumped by the signal handlers
+in app.signals, and by code that changes rows in bulk.
+"""
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import caches
+from django.utils.safestring import mark_safe
+
+FRAGMENT_TIMEOUT = 24 * 60 * 60     # seconds a rendered fragment is kept
+
+
+def get_cache():
+    return caches['schedules']
+
+def new_version():
+    return int(time.time() * 1000)
+
+def get_version(kind, pk):
+    """Returns the current version counter for a schedule or teacher"""
+    return get_cache().get_or_set(f'version:{kind}:{pk}', new_version, None)
+
+def bump_version(kind, pk):
+    if pk is None:
+        return
+    cache = get_cache()
+    key = f'version:{kind}:{pk}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter was never read or has been evicted, either way starting it
+        # afresh moves it past every key cached so far
+        cache.add(key, new_version(), None)
+
+def invalidate_schedule(schedule_id):
+    """Invalidates everything cached for one schedule"""
+    bump_version('schedule', schedule_id)
+
+def invalidate_teacher(teacher_id):
+    """Invalidates everything cached for every schedule of a teacher"""
+    bump_version('teacher', teacher_id)
+
+
+class FragmentStats:
+    """Hit and miss counts of this process, per fragment"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def record(self, name, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            names = set(self.hits) | set(self.misses)
+            return {name: {'hits': self.hits[name], 'misses': self.misses[name],
+                           'hit_rate': self.hits[name] / ((self.hits[name] + self.misses[name]) or 1)}
+                    for name in sorted(names)}
+
+stats = FragmentStats()
+
+
+def get_fragment(name, schedule, render, variant=''):
+    """Returns the cached HTML of a fragment of schedule's page, rendering and caching it on a miss.
+
+    render is called with no arguments and must return the HTML. variant tells
+    apart different renderings of the same fragment, e.g. slot sizes.
+    """
+    cache = get_cache()
+    key = 'fragment:{name}:{schedule}:{schedule_version}:{teacher_version}:{variant}'.format(
+        name=name, schedule=schedule.pk, variant=variant,
+        schedule_version=get_version('schedule', schedule.pk),
+        teacher_version=get_version('teacher', schedule.teacher_id))
+    html = cache.get(key)
+    stats.record(name, html is not None)
+    if html is None:
+        html = str(render())
+        cache.set(key, html, FRAGMENT_TIMEOUT)
+    return mark_safe(html)
@@ -0,0 +1,74 @@
+"""Builds the weekly grid shown on the schedule detail page.
+
+Every service appointment of a schedule is fetched in one query, along with its
+service and student, and dropped straight into its day and time slot using
+precomputed indexes, so the cost of the grid grows with the number of
+appointments only.
+"""
+from app.models import ServiceInstance, to_minutes
+
+DAYS = [day for day, label in ServiceInstance.DAYS]
+
+SLOT_SIZES = (15, 30, 60)   # minutes per column the grid can be shown with
+DAY_START = 7 * 60          # the grid runs from 7:00 AM...
+DAY_END = 16 * 60           # ...up to 4:00 PM, in minutes since midnight
+
+
+def format_minutes(minutes):
+    """Returns minutes since midnight as a 12-hour clock label, e.g. 810 -> '1:30 PM'"""
+    hour, minute = divmod(minutes, 60)
+    return '{hour}:{minute:02d} {period}'.format(hour=hour % 12 or 12, minute=minute,
+                                                 period='AM' if hour < 12 else 'PM')
+
+class ScheduleGrid:
+    """The service appointments of a schedule bucketed by day and time slot"""
+
+    def __init__(self, schedule, slot_minutes=60, day_start=DAY_START, day_end=DAY_END):
+        if slot_minutes not in SLOT_SIZES:
+            raise ValueError(f'slot_minutes must be one of {SLOT_SIZES}')
+        self.schedule = schedule
+        self.slot_minutes = slot_minutes
+        self.day_start = day_start
+        self.slot_starts = list(range(day_start, day_end, slot_minutes))
+        self.day_index = {day: index for index, day in enumerate(DAYS)}
+        self.cells = [[[] for slot in self.slot_starts] for day in DAYS]
+        self.build()
+
+    def get_serviceinstances(self):
+        """Returns every appointment of the schedule with its service and student in one query"""
+        return (ServiceInstance.objects
+                .filter(scheduled_for=self.schedule)
+                .select_related('service__student')
+                .order_by('day', 'time_start'))
+
+    def get_slot(self, serviceinstance):
+        """Returns the (day, slot) position of an appointment, or None if it falls off the grid"""
+        day = self.day_index.get(serviceinstance.day)
+        if day is None or serviceinstance.time_start is None:
+            return None
+        minutes = to_minutes(serviceinstance.time_start)
+        slot = (minutes - self.day_start) // self.slot_minutes
+        if minutes < self.day_start or slot >= len(self.slot_starts):
+            return None
+        return day, slot
+
+    def build(self):
+        for serviceinstance in self.get_serviceinstances():
+            position = self.get_slot(serviceinstance)
+            if position is not None:
+                day, slot = position
+                self.cells[day][slot].append(serviceinstance)
+
+    @property
+    def headers(self):
+        return [format_minutes(minutes) for minutes in self.slot_starts]
+
+    @property
+    def column_width(self):
+        """Percentage width of each time slot column, leaving 5% for the day column"""
+        return 95 // len(self.slot_starts)
+
+    @property
+    def rows(self):
+        """Yields (day, list of appointments per time slot) for each day of the week"""
+        return zip(DAYS, self.cells)
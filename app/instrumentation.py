@@ -0,0 +1,246 @@
+"""Measures every request: time, SQL, templates, and optionally a cProfile.
+
+InstrumentationMiddleware wraps each request and records
+
+* wall time
+* the number of SQL queries and the time spent in them, through a database
+  execute wrapper
+* statements run several times with different parameters in one request, the
+  mark of an N+1; the SQL is already parameterised, so identical text is the
+  same statement
+* time spent rendering templates, through the InstrumentedTemplates backend
+
+and writes them as one JSON log line per request on the "app.instrumentation"
+logger, at WARNING for slow requests or ones with repeated statements. The
+totals also go into counters per URL name, served in the Prometheus text
+format by MetricsView. The counters belong to the process, so each worker is
+scraped on its own.
+
+A request can also be profiled with cProfile, either a random
+INSTRUMENTATION_PROFILE_RATE fraction of them or, when
+INSTRUMENTATION_PROFILE_HEADER is set, any a staff member sends with an
+"X-Profile: 1" header. The profile is written to INSTRUMENTATION_PROFILE_DIR
+and its path logged. Everything else costs a few dictionary updates per query,
+so the middleware can be left on.
+"""
+import contextlib
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # seconds
+
+
+class RequestStats:
+    """What one request has done so far"""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0     # so templates rendered inside others aren't counted twice
+        self.statements = Counter()
+
+    def get_duplicates(self, threshold):
+        """Returns (count, sql) for each statement run at least threshold times, most run first"""
+        return [(count, sql) for sql, count in self.statements.most_common() if count >= threshold]
+
+_local = threading.local()
+
+def get_current():
+    """Returns the RequestStats of the request being handled by this thread, or None"""
+    return getattr(_local, 'stats', None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper timing every query of the current request"""
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats = get_current()
+        if stats is not None:
+            stats.queries += 1
+            stats.sql_seconds += time.perf_counter() - started
+            stats.statements[sql] += 1
+
+
+class InstrumentedTemplate(Template):
+    def render(self, context=None, request=None):
+        stats = get_current()
+        if stats is None:
+            return super().render(context, request)
+        stats.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            stats.template_depth -= 1
+            if stats.template_depth == 0:
+                stats.template_seconds += time.perf_counter() - started
+
+class InstrumentedTemplates(DjangoTemplates):
+    """The Django template backend, timing how long templates take to render"""
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        # DjangoTemplates.get_template wraps the template and turns errors into the backend's
+        template = super().get_template(template_name)
+        return InstrumentedTemplate(template.template, self)
+
+
+class Metrics:
+    """Per-process counters and histograms, labelled by URL name, method and status"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.duration_sum = Counter()
+        self.duration_buckets = defaultdict(lambda: [0] * len(DURATION_BUCKETS))
+        self.queries = Counter()
+        self.sql_seconds = Counter()
+        self.template_seconds = Counter()
+        self.duplicate_requests = Counter()
+
+    def record(self, labels, seconds, stats, has_duplicates):
+        with self._lock:
+            self.requests[labels] += 1
+            self.duration_sum[labels] += seconds
+            buckets = self.duration_buckets[labels]
+            for position, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    buckets[position] += 1
+            self.queries[labels] += stats.queries
+            self.sql_seconds[labels] += stats.sql_seconds
+            self.template_seconds[labels] += stats.template_seconds
+            if has_duplicates:
+                self.duplicate_requests[labels] += 1
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        def format_labels(labels, **extra):
+            pairs = list(zip(('view', 'method', 'status'), labels)) + list(extra.items())
+            return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, value in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            def counter(name, help_text, values):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(values.items()):
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+
+            counter('rsp_requests_total', 'Requests handled.', self.requests)
+            lines.append('# HELP rsp_request_duration_seconds Time taken to handle requests.')
+            lines.append('# TYPE rsp_request_duration_seconds histogram')
+            for labels, buckets in sorted(self.duration_buckets.items()):
+                for bound, count in zip(DURATION_BUCKETS, buckets):
+                    lines.append(f'rsp_request_duration_seconds_bucket{format_labels(labels, le=bound)} {count}')
+                lines.append(f'rsp_request_duration_seconds_bucket{format_labels(labels, le="+Inf")} {self.requests[labels]}')
+                lines.append(f'rsp_request_duration_seconds_sum{format_labels(labels)} {self.duration_sum[labels]}')
+                lines.append(f'rsp_request_duration_seconds_count{format_labels(labels)} {self.requests[labels]}')
+            counter('rsp_db_queries_total', 'SQL queries run.', self.queries)
+            counter('rsp_db_seconds_total', 'Time spent in SQL queries.', self.sql_seconds)
+            counter('rsp_template_seconds_total', 'Time spent rendering templates.', self.template_seconds)
+            counter('rsp_duplicate_query_requests_total',
+                    'Requests that ran the same SQL statement repeatedly, likely N+1s.', self.duplicate_requests)
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+
+def should_profile(request):
+    if settings.INSTRUMENTATION_PROFILE_HEADER and request.META.get('HTTP_X_PROFILE') == '1':
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff:
+            return True
+    rate = settings.INSTRUMENTATION_PROFILE_RATE
+    return rate > 0 and random.random() < rate
+
+def save_profile(profile, request):
+    directory = settings.INSTRUMENTATION_PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    name = request.path.strip('/').replace('/', '_') or 'root'
+    path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{name}.prof')
+    profile.dump_stats(path)
+    return path
+
+
+class InstrumentationMiddleware:
+    """Records time, queries and template rendering of each request, see the module docstring"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = _local.stats = RequestStats()
+        profile = cProfile.Profile() if should_profile(request) else None
+        started = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(record_query))
+                if profile:
+                    profile.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profile:
+                        profile.disable()
+            seconds = time.perf_counter() - started
+            self.report(request, response, seconds, stats, profile)
+            return response
+        finally:
+            _local.stats = None
+
+    def report(self, request, response, seconds, stats, profile):
+        match = getattr(request, 'resolver_match', None)
+        # The URL name rather than the path, so there is one set of counters per page
+        view = (match.view_name if match else None) or 'unmatched'
+        duplicates = stats.get_duplicates(settings.INSTRUMENTATION_DUPLICATE_QUERIES)
+        metrics.record((view, request.method, response.status_code), seconds, stats, bool(duplicates))
+
+        record = {
+            'view': view,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(seconds * 1000, 2),
+            'queries': stats.queries,
+            'sql_ms': round(stats.sql_seconds * 1000, 2),
+            'template_ms': round(stats.template_seconds * 1000, 2),
+            }
+        if duplicates:
+            record['duplicate_queries'] = [{'count': count, 'sql': sql[:200]} for count, sql in duplicates[:5]]
+        if profile:
+            record['profile'] = save_profile(profile, request)
+        slow = seconds * 1000 >= settings.INSTRUMENTATION_SLOW_MS
+        logger.log(logging.WARNING if slow or duplicates else logging.INFO, json.dumps(record))
+
+
+def MetricsView(request):
+    """View function serving the request metrics to Prometheus, for staff or with the METRICS_TOKEN bearer token"""
+    token = settings.METRICS_TOKEN
+    user = getattr(request, 'user', None)
+    # Compared in constant time, so the token can't be guessed a character at a time
+    authorised = (user is not None and user.is_staff) or bool(
+        token and hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(), f'Bearer {token}'.encode()))
+    if not authorised:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from app import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Measures the queries, time and memory of every page at several numbers of students, '
+            'in a throwaway test database, and fails if a budget is exceeded')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', type=int, nargs='+', default=list(benchmarks.SCALES),
+                            help='Numbers of students to benchmark with (default %(default)s)')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='Times to time each page, the fastest is kept (default %(default)s)')
+        parser.add_argument('--max-ms', type=float, default=None, help='Fail if a page takes longer than this')
+        parser.add_argument('--max-peak-kb', type=int, default=None, help='Fail if a page allocates more than this')
+        parser.add_argument('--output', default=None, help='Write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        def progress(result):
+            self.stdout.write('{scale:>6} {case:<45} {status} {queries:>4} queries {ms:>10.2f} ms {peak_kb:>8} KB'.format(**result))
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=False)
+        try:
+            with override_settings(**benchmarks.SETTINGS):
+                results = benchmarks.run(options['scales'], repeat=options['repeat'], progress=progress)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        failures = benchmarks.check(results, max_ms=options['max_ms'], max_peak_kb=options['max_peak_kb'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'environment': benchmarks.get_environment(), 'results': results, 'failures': failures},
+                          output, indent=2)
+        if failures:
+            raise CommandError('Budgets exceeded:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS(f'{len(results)} pages benchmarked, all within budget'))
@@ -0,0 +1,71 @@
+import datetime
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from app.cloning import CloneError, clone_schedule
+from app.models import Schedule
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f'"{value}" is not a date like 2019-09-03')
+
+def parse_remap(value):
+    try:
+        old, new = value.split(':')
+        return int(old), int(new)
+    except ValueError:
+        raise CommandError(f'"{value}" is not a pair of service ids like 12:34')
+
+
+class Command(BaseCommand):
+    help = 'Copies a schedule and its appointments to a new schedule, e.g. for the next term'
+
+    def add_arguments(self, parser):
+        parser.add_argument('schedule_id', type=int)
+        parser.add_argument('--title', default=None,
+                            help='Title of the copy (default the title of the schedule with "(copy)")')
+        parser.add_argument('--start-date', default=None, help='First day of the copy, YYYY-MM-DD')
+        parser.add_argument('--end-date', default=None, help='Last day of the copy, YYYY-MM-DD')
+        parser.add_argument('--teacher', default=None,
+                            help='Username of the teacher the copy is for (default the schedule\'s teacher)')
+        parser.add_argument('--remap', action='append', default=[], metavar='OLD:NEW',
+                            help='Copy the appointments of service OLD to service NEW, can be given several times')
+        parser.add_argument('--keep-departed', action='store_true',
+                            help='Also copy appointments of students who have left or are on another caseload')
+        parser.add_argument('--skip-satisfied', action='store_true',
+                            help='Leave out appointments of services that have all their time without this schedule')
+        parser.add_argument('--activate', action='store_true', help='Make the copy the active schedule')
+
+    def handle(self, *args, **options):
+        try:
+            source = Schedule.objects.select_related('teacher').get(pk=options['schedule_id'])
+        except Schedule.DoesNotExist:
+            raise CommandError(f'Schedule {options["schedule_id"]} does not exist')
+        teacher = None
+        if options['teacher']:
+            try:
+                teacher = User.objects.get(username=options['teacher'])
+            except User.DoesNotExist:
+                raise CommandError(f'There is no teacher with username "{options["teacher"]}"')
+
+        started = time.perf_counter()
+        try:
+            report = clone_schedule(
+                source,
+                title=options['title'] or f'{source.title} (copy)',
+                start_date=parse_date(options['start_date']) if options['start_date'] else None,
+                end_date=parse_date(options['end_date']) if options['end_date'] else None,
+                teacher=teacher,
+                service_map=dict(parse_remap(value) for value in options['remap']),
+                skip_departed=not options['keep_departed'],
+                skip_satisfied=options['skip_satisfied'],
+                activate=options['activate'])
+        except CloneError as error:
+            raise CommandError(str(error))
+        self.stdout.write(self.style.SUCCESS(f'{report} in {time.perf_counter() - started:.2f}s'))
+        self.stdout.write(f'The copy is schedule {report.schedule.pk}')
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import setup_databases, teardown_databases
+
+from app import query_plans
+from app.benchmarks import Dataset
+
+
+class Command(BaseCommand):
+    help = ('Shows the query plans of the hot queries on a sample dataset in a throwaway test database, '
+            'and fails if one reads a whole table where the saved baseline did not. Without a baseline for '
+            'this database yet, saves the plans as one')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=1000,
+                            help='Students in the sample dataset (default %(default)s)')
+        parser.add_argument('--teachers', type=int, default=20,
+                            help='Teachers the students are shared between (default %(default)s)')
+        parser.add_argument('--save', action='store_true',
+                            help='Save the plans as the baseline for this database')
+        parser.add_argument('--strict', action='store_true',
+                            help='Fail on any difference from the baseline, not only new full table scans')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=False)
+        try:
+            with transaction.atomic():
+                # The queries are run for the first teacher, the others make the data look like a school's
+                teachers = max(options['teachers'], 1)
+                datasets = [Dataset(max(options['students'] // teachers, 1), number) for number in range(teachers)]
+                # Give the planner statistics, as a long-running database would have
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+                plans = query_plans.explain(datasets[0])
+                transaction.set_rollback(True)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        for name, steps in plans.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for step in steps:
+                self.stdout.write(f'    {step}')
+
+        if options['save']:
+            query_plans.save_baseline(plans)
+            self.stdout.write(self.style.SUCCESS(f'Saved the {connection.vendor} baseline to {query_plans.BASELINE_PATH}'))
+            return
+
+        baseline = query_plans.load_baseline()
+        if not baseline:
+            # Nothing to compare with on a database run for the first time, these plans become its baseline
+            query_plans.save_baseline(plans)
+            self.stdout.write(self.style.WARNING(f'There was no {connection.vendor} baseline yet, saved these plans '
+                                                 f'as the baseline to {query_plans.BASELINE_PATH}, commit it'))
+            return
+        regressions, changes = query_plans.compare(plans, baseline)
+        for change in changes:
+            self.stdout.write(self.style.WARNING(f'Changed plan, {change}'))
+        if regressions or (options['strict'] and changes):
+            raise CommandError('Query plans regressed:\n' + '\n'.join(regressions or changes))
+        self.stdout.write(self.style.SUCCESS('Query plans match the baseline' if not changes else
+                                             'No new full table scans'))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import Schedule
+from app.solver import Problem, SESSION_MINUTES, TIME_BUDGET, save_solution, solve_parallel
+
+
+class Command(BaseCommand):
+    help = 'Adds appointments to a schedule for every service of its teacher that still needs time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('schedule_id', type=int)
+        parser.add_argument('--budget', type=float, default=TIME_BUDGET,
+                            help='Wall-clock seconds to search for (default %(default)s)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes to search with (default one per CPU)')
+        parser.add_argument('--starts', type=int, default=None,
+                            help='Differently seeded searches to run (default one per worker)')
+        parser.add_argument('--good-enough', type=float, default=1.0,
+                            help='Stop once this fraction of the needed minutes is placed (default %(default)s)')
+        parser.add_argument('--session-minutes', type=int, default=SESSION_MINUTES,
+                            help='Longest appointment a service is split into (default %(default)s)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Show what would be scheduled without saving it')
+
+    def handle(self, *args, **options):
+        try:
+            schedule = Schedule.objects.get(pk=options['schedule_id'])
+        except Schedule.DoesNotExist:
+            raise CommandError(f'Schedule {options["schedule_id"]} does not exist')
+
+        problem = Problem.from_schedule(schedule, session_minutes=options['session_minutes'])
+        solution = solve_parallel(problem, time_budget=options['budget'], workers=options['workers'],
+                                  starts=options['starts'], good_enough=options['good_enough'])
+        self.stdout.write(str(solution))
+        for service_id, minutes in sorted(solution.unmet.items()):
+            self.stdout.write(f'  service {service_id} is {minutes} minutes short')
+
+        if options['dry_run']:
+            return
+        save_solution(schedule, solution)
+        self.stdout.write(self.style.SUCCESS(f'Added {len(solution.placements)} appointments to "{schedule.title}"'))
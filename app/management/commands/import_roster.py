@@ -0,0 +1,47 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from app.roster_import import BATCH_SIZE, RosterImporter, guess_format, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Imports students and services from a CSV or JSON Lines file, skipping rows already imported'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, - for standard input')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), default=None,
+                            help='File format (default worked out from the file name, csv for standard input)')
+        parser.add_argument('--teacher', default=None,
+                            help='Username of the teacher for rows without a teacher column')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Rows written per transaction (default %(default)s)')
+
+    def handle(self, *args, **options):
+        teacher = None
+        if options['teacher']:
+            try:
+                teacher = User.objects.get(username=options['teacher'])
+            except User.DoesNotExist:
+                raise CommandError(f'There is no teacher with username "{options["teacher"]}"')
+
+        path = options['path']
+        format = options['format'] or ('csv' if path == '-' else guess_format(path))
+
+        def report_error(line_number, message):
+            self.stderr.write(f'line {line_number}: {message}')
+
+        importer = RosterImporter(teacher=teacher, batch_size=options['batch_size'], on_error=report_error)
+        if path == '-':
+            report = importer.run(read_rows(sys.stdin, format))
+        else:
+            try:
+                stream = open(path, newline='', encoding='utf-8-sig')
+            except OSError as error:
+                raise CommandError(f'Could not open {path}: {error}')
+            with stream:
+                report = importer.run(read_rows(stream, format))
+
+        style = self.style.WARNING if report.error_count else self.style.SUCCESS
+        self.stdout.write(style(str(report)))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app.compliance import rebuild
+
+
+class Command(BaseCommand):
+    help = "Sums every teacher's services into the district compliance summary again, repairing rows that drifted"
+
+    def handle(self, *args, **options):
+        changed = rebuild()
+        if not changed:
+            self.stdout.write(self.style.SUCCESS('Every summary row is correct'))
+            return
+        self.stdout.write(self.style.WARNING(f'{changed} summary rows repaired'))
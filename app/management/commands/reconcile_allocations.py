@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from app.allocation import reconcile
+
+
+class Command(BaseCommand):
+    help = "Checks every service's allocated minutes and every student's serviced flag, repairing any that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the rows that drifted without changing them')
+
+    def handle(self, *args, **options):
+        services, students = reconcile(repair=not options['dry_run'])
+        if not services and not students:
+            self.stdout.write(self.style.SUCCESS('Every stored total is correct'))
+            return
+        verb = 'would be repaired' if options['dry_run'] else 'repaired'
+        for pk in services:
+            self.stdout.write(f'service {pk}: allocated minutes {verb}')
+        for pk in students:
+            self.stdout.write(f'student {pk}: serviced {verb}')
+        self.stdout.write(self.style.WARNING(f'{len(services)} services and {len(students)} students {verb}'))
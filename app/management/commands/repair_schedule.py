@@ -0,0 +1,58 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from app.forms import parse_blocked_periods
+from app.grid import DAYS
+from app.models import Schedule
+from app.repair import TIME_BUDGET, Changes, apply_repair, plan_repair
+from app.solver import SESSION_MINUTES
+
+
+def format_placement(placement):
+    return (f'service {placement.service_id} on {DAYS[placement.day]} '
+            f'{placement.start // 60:02}:{placement.start % 60:02}-{placement.end // 60:02}:{placement.end % 60:02}')
+
+
+class Command(BaseCommand):
+    help = 'Re-places only the appointments affected by changed services or newly blocked time, keeping the rest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('schedule_id', type=int)
+        parser.add_argument('--service', type=int, action='append', default=[], dest='services',
+                            help='Id of a service that was added, edited or removed, can be given several times')
+        parser.add_argument('--block', action='append', default=[], dest='blocked',
+                            help='Time no longer free, e.g. "Monday 11:30-12:00" or "Every day 11:30-12:00"')
+        parser.add_argument('--budget', type=float, default=TIME_BUDGET,
+                            help='Wall-clock seconds to search for (default %(default)s)')
+        parser.add_argument('--session-minutes', type=int, default=SESSION_MINUTES,
+                            help='Longest appointment a service is split into (default %(default)s)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Show what would change without saving it')
+
+    def handle(self, *args, **options):
+        try:
+            schedule = Schedule.objects.get(pk=options['schedule_id'])
+        except Schedule.DoesNotExist:
+            raise CommandError(f'Schedule {options["schedule_id"]} does not exist')
+        try:
+            blocked = parse_blocked_periods('\n'.join(options['blocked']))
+        except ValidationError as error:
+            raise CommandError(error.messages[0])
+        if not options['services'] and not blocked:
+            raise CommandError('Nothing changed, give at least one --service or --block')
+
+        diff = plan_repair(schedule, Changes(options['services'], blocked),
+                           time_budget=options['budget'], session_minutes=options['session_minutes'])
+        for placement in diff.created:
+            self.stdout.write(f'  create {format_placement(placement)}')
+        for pk, placement in diff.moved:
+            self.stdout.write(f'  move appointment {pk} to {format_placement(placement)}')
+        for pk in diff.deleted:
+            self.stdout.write(f'  delete appointment {pk}')
+        for service_id, minutes in sorted(diff.unmet.items()):
+            self.stdout.write(f'  service {service_id} is {minutes} minutes short')
+        self.stdout.write(f'{diff} ({diff.solution.elapsed:.2f}s)')
+
+        if options['dry_run'] or not diff:
+            return
+        apply_repair(diff)
@@ -0,0 +1,59 @@
+# Generated by Django 2.1.1 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+# Django 2.1 can't declare partial indexes, so this one is created with SQL on
+# the backends that support them. Besides keeping each teacher to one active
+# schedule, PostgreSQL uses it to find the active schedules. Django doesn't know
+# about it, so a later migration that makes SQLite rebuild app_schedule has to
+# create it again.
+ACTIVE_SCHEDULE_INDEX = 'schedule_one_active_per_teacher'
+PARTIAL_INDEX_VENDORS = ('postgresql', 'sqlite')
+
+
+def create_active_schedule_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in PARTIAL_INDEX_VENDORS:
+        return
+    # The index can't be created while a teacher has two active schedules, keep the latest
+    Schedule = apps.get_model('app', 'Schedule')
+    kept = set()
+    for schedule in Schedule.objects.filter(active=True).order_by('teacher_id', '-updated_at', '-pk'):
+        if schedule.teacher_id in kept:
+            Schedule.objects.filter(pk=schedule.pk).update(active=False)
+        kept.add(schedule.teacher_id)
+    quote = schema_editor.quote_name
+    schema_editor.execute('CREATE UNIQUE INDEX {index} ON {table} ({teacher}) WHERE {active}'.format(
+        index=quote(ACTIVE_SCHEDULE_INDEX), table=quote(Schedule._meta.db_table),
+        teacher=quote('teacher_id'), active=quote('active')))
+
+def drop_active_schedule_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in PARTIAL_INDEX_VENDORS:
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS {}'.format(schema_editor.quote_name(ACTIVE_SCHEDULE_INDEX)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['active', 'teacher'], name='schedule_active_teacher_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(fields=['student', 'subject', 'service_type'], name='service_student_subject_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceinstance',
+            index=models.Index(fields=['scheduled_for', 'day', 'time_start'], name='instance_schedule_day_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['teacher', 'last_name', 'first_name'], name='student_teacher_name_idx'),
+        ),
+        migrations.RunPython(create_active_schedule_index, drop_active_schedule_index),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.1.1 on 2026-10-18 16:02
+
+from django.db import migrations, models
+from django.db.models import Case, ExpressionWrapper, F, Sum, Value, When
+from django.db.models.functions import ExtractHour, ExtractMinute
+
+
+# Copies of app.models.minutes_expression and duration_expression as they were
+# when this migration was written, so changing those can't change it
+def minutes_expression(field):
+    return ExpressionWrapper(ExtractHour(field) * 60 + ExtractMinute(field), output_field=models.IntegerField())
+
+def duration_expression():
+    return Case(
+        When(time_end__gt=F('time_start'),
+             then=ExpressionWrapper(minutes_expression('time_end') - minutes_expression('time_start'),
+                                    output_field=models.IntegerField())),
+        default=Value(0),
+        output_field=models.IntegerField())
+
+
+def populate(apps, schema_editor):
+    """Works out every service's allocated minutes and every student's serviced flag"""
+    Service = apps.get_model('app', 'Service')
+    ServiceInstance = apps.get_model('app', 'ServiceInstance')
+    Student = apps.get_model('app', 'Student')
+    allocated_times = (ServiceInstance.objects
+                       .filter(service__isnull=False, scheduled_for__active=True)
+                       .order_by().values('service_id')
+                       .annotate(allocated_time=Sum(duration_expression())))
+    for row in allocated_times:
+        Service.objects.filter(pk=row['service_id']).update(allocated_minutes=row['allocated_time'] or 0)
+    unserviced = Service.objects.filter(allocated_minutes__lt=F('total_time_req')).values('student_id')
+    Student.objects.update(serviced=True)
+    Student.objects.filter(pk__in=unserviced).update(serviced=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='allocated_minutes',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='student',
+            name='serviced',
+            field=models.BooleanField(default=False, editable=False, help_text='Whether every service of this student has all its time'),
+        ),
+        migrations.RunPython(populate, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.1.1 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+# Django 2.1 can't declare indexes on expressions, so these are created with SQL
+# on the backends that support them, for the name search in app.roster. Like
+# the index in 0006, a later migration that makes SQLite rebuild app_student
+# has to create them again.
+NAME_INDEXES = {
+    'student_teacher_last_lower_idx': 'last_name',
+    'student_teacher_first_lower_idx': 'first_name',
+    }
+EXPRESSION_INDEX_VENDORS = ('postgresql', 'sqlite')
+
+
+def create_name_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in EXPRESSION_INDEX_VENDORS:
+        return
+    quote = schema_editor.quote_name
+    table = apps.get_model('app', 'Student')._meta.db_table
+    for index, column in NAME_INDEXES.items():
+        schema_editor.execute('CREATE INDEX {index} ON {table} ({teacher}, LOWER({column}))'.format(
+            index=quote(index), table=quote(table), teacher=quote('teacher_id'), column=quote(column)))
+
+def drop_name_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in EXPRESSION_INDEX_VENDORS:
+        return
+    for index in NAME_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(schema_editor.quote_name(index)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_allocated_minutes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='student',
+            name='student_teacher_name_idx',
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['teacher', 'last_name', 'first_name', 'id'], name='student_teacher_name_idx'),
+        ),
+        migrations.RunPython(create_name_indexes, drop_name_indexes),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.1.1 on 2026-10-18 18:20
+
+from django.db import migrations, models
+import django.core.validators
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_student_name_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Resource',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Enter the room or the person', max_length=100)),
+                ('kind', models.CharField(choices=[('Room', 'Room'), ('Staff', 'Staff')], default='Room', help_text='Kind of resource', max_length=5)),
+                ('capacity', models.PositiveSmallIntegerField(default=1, help_text='How many appointments it can take at once', validators=[django.core.validators.MinValueValidator(1)])),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='resource',
+            field=models.ForeignKey(blank=True, help_text='Room or staff its appointments use, e.g. the room Pull-Outs go to', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='services', to='app.Resource'),
+        ),
+        migrations.AddField(
+            model_name='serviceinstance',
+            name='resource',
+            field=models.ForeignKey(blank=True, help_text="Room or staff this appointment uses, the service's if left blank", null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='serviceinstances', to='app.Resource'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceinstance',
+            index=models.Index(fields=['resource', 'day'], name='instance_resource_day_idx'),
+        ),
+    ]
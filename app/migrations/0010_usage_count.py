@@ -0,0 +1,26 @@
+# Generated by Django 2.1.1 on 2026-10-18 14:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_resources'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('key', models.CharField(blank=True, max_length=100)),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='usagecount',
+            unique_together={('name', 'key')},
+        ),
+    ]
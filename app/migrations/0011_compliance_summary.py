@@ -0,0 +1,65 @@
+# Generated by Django 2.1.1 on 2026-10-18 14:17
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def populate(apps, schema_editor):
+    """Sums every teacher's services into their summary rows, as app.compliance.get_totals did then"""
+    ComplianceSummary = apps.get_model('app', 'ComplianceSummary')
+    Service = apps.get_model('app', 'Service')
+    short = Q(allocated_minutes__lt=F('total_time_req'))
+    # Renamed, some of the totals are also the names of Service fields
+    aggregates = {
+        'total_services': Count('pk'),
+        'total_unsatisfied_services': Count('pk', filter=short),
+        'total_students': Count('student', distinct=True),
+        'total_underserved_students': Count('student', distinct=True, filter=short),
+        'total_required_minutes': Sum('total_time_req'),
+        'total_allocated_minutes': Sum('allocated_minutes'),
+        'total_missing_minutes': Coalesce(Sum(F('total_time_req') - F('allocated_minutes'), filter=short), Value(0)),
+        }
+    rows = (Service.objects.filter(student__teacher__isnull=False)
+            .order_by()
+            .values('student__teacher_id', 'subject', 'service_type')
+            .annotate(**aggregates))
+    ComplianceSummary.objects.bulk_create([
+        ComplianceSummary(teacher_id=row['student__teacher_id'], subject=row['subject'], service_type=row['service_type'],
+                          **{name[len('total_'):]: row[name] or 0 for name in aggregates})
+        for row in rows], batch_size=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0010_usage_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComplianceSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(choices=[('MATH', 'Math'), ('ELA', 'ELA')], max_length=4)),
+                ('service_type', models.CharField(choices=[('Push-In', 'Push-In'), ('Pull-Out', 'Pull-Out')], max_length=8)),
+                ('services', models.IntegerField(default=0)),
+                ('unsatisfied_services', models.IntegerField(default=0)),
+                ('students', models.IntegerField(default=0)),
+                ('underserved_students', models.IntegerField(default=0)),
+                ('required_minutes', models.IntegerField(default=0)),
+                ('allocated_minutes', models.IntegerField(default=0)),
+                ('missing_minutes', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('teacher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compliance_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='compliancesummary',
+            unique_together={('teacher', 'subject', 'service_type')},
+        ),
+        migrations.RunPython(populate, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.1.1 on 2026-10-18 15:02
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_table(apps, schema_editor):
+    """Makes the table of the "schedules" cache when it is kept in the database, a no-op otherwise"""
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_compliance_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, migrations.RunPython.noop),
+    ]
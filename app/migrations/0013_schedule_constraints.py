@@ -0,0 +1,43 @@
+# Generated by Django 2.1.1 on 2026-10-18 17:40
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# Adding and removing the fields makes SQLite rebuild app_schedule, which loses
+# the partial unique index of migration 0006, so it is created again afterwards
+indexes = import_module('app.migrations.0006_indexes')
+
+
+def recreate_active_schedule_index(apps, schema_editor):
+    # Other backends alter the table in place and keep it
+    indexes.drop_active_schedule_index(apps, schema_editor)
+    indexes.create_active_schedule_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_schedule_cache_table'),
+    ]
+
+    operations = [
+        # Run last when the migration is reversed
+        migrations.RunPython(migrations.RunPython.noop, recreate_active_schedule_index),
+        migrations.AddField(
+            model_name='schedule',
+            name='blocked_periods',
+            field=models.TextField(blank=True, default='', editable=False, help_text='One per line, e.g. "Every day 11:30-12:00" or "Friday 13:00-15:00"'),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='day_end',
+            field=models.TimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='day_start',
+            field=models.TimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(recreate_active_schedule_index, migrations.RunPython.noop),
+    ]
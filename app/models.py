@@ -1,22 +1,77 @@
-from django.db import models
+from django.db import models, transaction
 import uuid # placeholder for student IDs
 from django.urls import reverse # Used to generate URLs by reversing the URL patterns
 from django.contrib.auth.models import User
+from django.core.validators import MinValueValidator
 from django.utils import timezone
-from datetime import timedelta
+from django.db.models import Case, ExpressionWrapper, F, Value, When
+from django.db.models.functions import ExtractHour, ExtractMinute
+import datetime
+
+# Times are worked with as whole minutes since midnight, e.g. 1:30 PM is 810,
+# which makes durations a subtraction and can be done by the database too
+def to_minutes(time):
+    """Returns a datetime.time as minutes since midnight"""
+    return time.hour * 60 + time.minute
+
+def to_time(minutes):
+    """Returns minutes since midnight as a datetime.time"""
+    return datetime.time(minutes // 60, minutes % 60)
+
+def get_duration(time_start, time_end):
+    """Returns the number of minutes between two times, or None if either is blank"""
+    if time_start != None and time_end != None:   # check because time_start and time_end can be blank
+        return max(to_minutes(time_end) - to_minutes(time_start), 0)
+
+def minutes_expression(field):
+    """Returns a database expression for a TimeField as minutes since midnight"""
+    return ExpressionWrapper(ExtractHour(field) * 60 + ExtractMinute(field), output_field=models.IntegerField())
+
+def duration_expression():
+    """Returns a database expression for the minutes a ServiceInstance lasts, so they can be summed in SQL"""
+    return Case(
+        When(time_end__gt=F('time_start'),
+             then=ExpressionWrapper(minutes_expression('time_end') - minutes_expression('time_start'),
+                                    output_field=models.IntegerField())),
+        default=Value(0),
+        output_field=models.IntegerField())
 
 # Create your models here.
+class Resource(models.Model):
+    """Model representing a room or a member of staff that appointments share"""
+    KINDS = (
+        ('Room', 'Room'),
+        ('Staff', 'Staff')
+        )
+
+    name = models.CharField(max_length=100, help_text='Enter the room or the person')
+    kind = models.CharField(max_length=5, choices=KINDS, default='Room', help_text='Kind of resource')
+    # Counted across every teacher's active schedule, see app.occupancy
+    capacity = models.PositiveSmallIntegerField(default=1, validators=[MinValueValidator(1)],
+                                                help_text='How many appointments it can take at once')
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        """String for representing the Model "Resource" object."""
+        return self.name
+
 class Student(models.Model):
     """Model representing a Student."""
     first_name = models.CharField(max_length=20, help_text='Enter First Name')
     middle_name = models.CharField(max_length=20, null=True, blank=True, help_text='Enter Middle Name')
     last_name = models.CharField(max_length=20, help_text='Enter Last Name')
     teacher = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
-    serviced = models.BooleanField(default=False, help_text='Check if the services for this student have been completed')
+    # Kept up to date by app.allocation: True once every service has all its minutes
+    serviced = models.BooleanField(default=False, editable=False, help_text='Whether every service of this student has all its time')
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, help_text='Unique ID for this student')
+    updated_at = models.DateTimeField(auto_now=True)   # when the row last changed, for conditional GETs in app.api
     
     class Meta:
         ordering = ['last_name', 'first_name']
+        # Students are listed per teacher in name order, and paged by keyset on it (app.roster)
+        indexes = [models.Index(fields=['teacher', 'last_name', 'first_name', 'id'], name='student_teacher_name_idx')]
 
     def __str__(self):
         """String for representing the Model "Student" object."""
@@ -25,14 +80,10 @@ class Student(models.Model):
     def get_absolute_url(self):
         """Returns the url to access a detail record for this student"""
         return reverse('student-detail', args=[str(self.id)])
-    # Checks all the services appointed to the student, will be True if all the
-    # services are met, false otherwise
+    # True if all the services appointed to the student are met, false otherwise
     @property
     def is_serviced(self):
-        for service in self.services.all():
-            if not service.is_satisfied:
-                return False
-        return True
+        return self.serviced
     
 class Service(models.Model):
     """Model representing a Time Service for a Student"""
@@ -64,6 +115,15 @@ class Service(models.Model):
     
     total_time_req = models.IntegerField(help_text='Enter total time required')
     satisfied = models.BooleanField(help_text='Check if this service has been satisfied')
+    resource = models.ForeignKey('Resource', related_name='services', on_delete=models.SET_NULL, null=True, blank=True,
+                                 help_text='Room or staff its appointments use, e.g. the room Pull-Outs go to')
+    # Minutes of this service's appointments on active schedules, kept up to date by app.allocation
+    allocated_minutes = models.IntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)   # when the row last changed, for conditional GETs in app.api
+
+    class Meta:
+        # A student's services are looked up by subject and type, e.g. by app.roster_import
+        indexes = [models.Index(fields=['student', 'subject', 'service_type'], name='service_student_subject_idx')]
         
     def __str__(self):
         """String for representing the Model "Service" object."""
@@ -73,17 +133,22 @@ class Service(models.Model):
         """Returns a URL for displaying all instances of this service"""
         return reverse('service-detail', args=[str(self.id)])
 
-    # Goes through all the service instances associated with this service
-    # If each service instance that belongs to an active calendar adds up to
-    # the time required, then the service is satisfied!
+    # The time of all the service instances of this service that belong to an active calendar
+    @property
+    def allocated_time(self):
+        return self.allocated_minutes
+
+    # If the allocated time adds up to the time required, then the service is satisfied!
     @property
     def is_satisfied(self):
-        allocated_time= 0
-        for serviceinstance in self.stud_serviceinstances.all():
-            if serviceinstance.scheduled_for.active:
-                if serviceinstance.duration:
-                    allocated_time += serviceinstance.duration
-        return allocated_time >= self.total_time_req
+        return self.allocated_time >= self.total_time_req
+
+class ServiceInstanceQuerySet(models.QuerySet):
+    def with_minutes(self):
+        """Annotates start_minute, end_minute and minutes (the duration) as computed by the database"""
+        return self.annotate(start_minute=minutes_expression('time_start'),
+                             end_minute=minutes_expression('time_end'),
+                             minutes=duration_expression())
 
 class ServiceInstance(models.Model):
     """Model representing a ServiceInstance"""
@@ -104,20 +169,21 @@ class ServiceInstance(models.Model):
     time_start = models.TimeField(default=timezone.now, blank=True)
     time_end = models.TimeField(default=timezone.now, blank=True)
     scheduled_for = models.ForeignKey('Schedule', related_name='sched_serviceinstances', on_delete=models.SET_NULL, null=True)
+    resource = models.ForeignKey('Resource', related_name='serviceinstances', on_delete=models.SET_NULL, null=True, blank=True,
+                                 help_text="Room or staff this appointment uses, the service's if left blank")
+    updated_at = models.DateTimeField(auto_now=True)   # when the row last changed, for conditional GETs in app.api
+
+    objects = ServiceInstanceQuerySet.as_manager()
+
+    class Meta:
+        # Appointments are read per schedule in day and time order, for the grid and conflict checks,
+        # and per resource, for its occupancy (app.occupancy)
+        indexes = [models.Index(fields=['scheduled_for', 'day', 'time_start'], name='instance_schedule_day_idx'),
+                   models.Index(fields=['resource', 'day'], name='instance_resource_day_idx')]
 
     @property
     def duration(self):
-        if self.time_start != None and self.time_end != None:   # check because time_start and time_end can be blank
-            start = timedelta(hours=self.time_start.hour, minutes=self.time_start.minute, seconds=self.time_start.second)
-            end = timedelta(hours=self.time_end.hour, minutes=self.time_end.minute, seconds=self.time_end.second)
-            # must reformat the timedelta if the hour is at or beyond 12 to fit 12-hour clock format
-            if start.seconds // 3600 >= 12:
-                start = timedelta(hours=((start.seconds//3600) - 12), minutes=((start.seconds%3600)//60), seconds=start.seconds%60)
-            if end.seconds // 3600 >= 12:
-                end = timedelta(hours=((end.seconds//3600) - 12), minutes=((end.seconds%3600)//60), seconds=end.seconds%60)
-            time = end - start
-            duration = abs(int(time.total_seconds() / 60))
-            return duration
+        return get_duration(self.time_start, self.time_end)
     
     def __str__(self):
         """String for representing the Model "ServiceInstance" object."""
@@ -135,17 +201,45 @@ class Schedule(models.Model):
     end_date = models.DateField(null=True, blank=True)
     teacher = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
     active = models.BooleanField(default=False)
+    # The teacher's day and the time they weren't free when it was generated, which repairs keep to
+    day_start = models.TimeField(null=True, blank=True, editable=False)
+    day_end = models.TimeField(null=True, blank=True, editable=False)
+    blocked_periods = models.TextField(blank=True, default='', editable=False,
+                                       help_text='One per line, e.g. "Every day 11:30-12:00" or "Friday 13:00-15:00"')
+    updated_at = models.DateTimeField(auto_now=True)   # when the row last changed, for conditional GETs in app.api
+
+    class Meta:
+        # Active schedules are looked up on their own and per teacher. Migration 0006
+        # also adds a partial unique index allowing each teacher one active schedule
+        indexes = [models.Index(fields=['active', 'teacher'], name='schedule_active_teacher_idx')]
 
-    # Function to represent the constraint of one model having the "active"
-    # field to be True
-    # This function was found at: https://stackoverflow.com/questions/44718872/django-model-where-only-one-row-can-have-active-true
+    # Each teacher has at most one active schedule, so saving an active one
+    # deactivates the teacher's others
+    # The idea came from: https://stackoverflow.com/questions/44718872/django-model-where-only-one-row-can-have-active-true
+    # It is all one transaction holding a lock on the teacher's row, so two
+    # activations for the same teacher, e.g. in different workers, run one after
+    # the other instead of both finding nothing to deactivate. The unique index
+    # from migration 0006 rejects anything that gets past this. app.signals
+    # refreshes the services' allocated minutes inside the same transaction.
     def save(self, *args, **kwargs):
-        if self.active:
-            queryset = type(self).objects.filter(active=True)
-            if self.pk:
-                queryset = queryset.exclude(pk=self.pk)
-            queryset.update(active=False)
-        super(Schedule, self).save(*args, **kwargs)
+        with transaction.atomic(using=kwargs.get('using')):
+            self._deactivated_ids = set()     # for app.signals
+            if self.active:
+                if self.teacher_id is not None:
+                    list(User.objects.select_for_update().filter(pk=self.teacher_id).values_list('pk'))
+                queryset = type(self).objects.filter(teacher_id=self.teacher_id, active=True)
+                if self.pk:
+                    queryset = queryset.exclude(pk=self.pk)
+                self._deactivated_ids = set(queryset.values_list('pk', flat=True))
+                if self._deactivated_ids:
+                    # update() skips auto_now
+                    type(self).objects.filter(pk__in=self._deactivated_ids).update(active=False, updated_at=timezone.now())
+            super(Schedule, self).save(*args, **kwargs)
+
+    def activate(self):
+        """Makes this the teacher's active schedule"""
+        self.active = True
+        self.save()
 
     def __str__(self):
         """String representing the Model "Schedule" object."""
@@ -154,3 +248,35 @@ class Schedule(models.Model):
     def get_absolute_url(self):
         """Returns the url to access a detail record for this student"""
         return reverse('schedule-detail', args=[str(self.id)])
+
+class ComplianceSummary(models.Model):
+    """Model representing the minutes a teacher's services of one subject and type require and have, kept by app.compliance"""
+    teacher = models.ForeignKey(User, related_name='compliance_summaries', on_delete=models.CASCADE)
+    subject = models.CharField(max_length=4, choices=Service.SUBJECTS)
+    service_type = models.CharField(max_length=8, choices=Service.SERVICES)
+    services = models.IntegerField(default=0)
+    unsatisfied_services = models.IntegerField(default=0)   # with fewer minutes than they require
+    students = models.IntegerField(default=0)
+    underserved_students = models.IntegerField(default=0)   # with one of those services
+    required_minutes = models.IntegerField(default=0)
+    allocated_minutes = models.IntegerField(default=0)
+    missing_minutes = models.IntegerField(default=0)        # the unsatisfied services' shortfall
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('teacher', 'subject', 'service_type')
+
+    def __str__(self):
+        return f'{self.teacher} {self.subject} {self.service_type}'
+
+class UsageCount(models.Model):
+    """Model representing a running count, e.g. a teacher's visits to the home page, written by app.counters"""
+    name = models.CharField(max_length=50)
+    key = models.CharField(max_length=100, blank=True)     # whose count, e.g. a user's id
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('name', 'key')
+
+    def __str__(self):
+        return f'{self.name} {self.key}: {self.count}'
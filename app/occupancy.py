@@ -0,0 +1,115 @@
+"""Keeps count of how many appointments use each room or member of staff, and when.
+
+A Resource can take up to its capacity appointments at once, counted over every
+teacher's active schedule, since rooms and specialists are shared. OccupancyMap
+holds, for each resource and day, the number of appointments in every slot of
+the day in an array, and next to it a bitmask of the slots where the resource
+is full, laid out like the solver's masks (app.solver). Whether an appointment
+fits is then one AND of two integers, and every start time a session fits at a
+few shifts, so the solver checks capacity at each step of its search, and
+forms check it, without going back to the database.
+
+A map is loaded with two queries: the resources' capacities, and the
+appointments using them on active schedules and on the schedule being worked
+on, which may not be active yet.
+"""
+from array import array
+
+from django.db.models import Q
+
+from app.grid import DAYS
+from app.models import Resource, Service, ServiceInstance
+from app.solver import GRANULARITY, Problem, fit_mask, iter_bits, span_mask
+
+MINUTES_PER_DAY = 24 * 60
+
+
+class OccupancyMap:
+    """Appointments per slot, and the slots at capacity, of each resource on each day"""
+
+    def __init__(self, capacities, granularity=GRANULARITY):
+        self.granularity = granularity
+        self.capacities = dict(capacities)  # resource id -> appointments it can take at once
+        slots = -(-MINUTES_PER_DAY // granularity)
+        self.counts = {pk: [array('H', bytes(2 * slots)) for day in DAYS] for pk in self.capacities}
+        self.full = {pk: [0] * len(DAYS) for pk in self.capacities}
+
+    def copy(self):
+        occupancy = OccupancyMap({}, self.granularity)
+        occupancy.capacities = self.capacities
+        occupancy.counts = {pk: [array('H', counts) for counts in days] for pk, days in self.counts.items()}
+        occupancy.full = {pk: list(masks) for pk, masks in self.full.items()}
+        return occupancy
+
+    def add(self, resource_id, day, start, end, count=1):
+        """Counts an appointment using a resource from start to end, in minutes, on day (an index into DAYS)"""
+        if resource_id not in self.capacities:
+            return
+        counts, full = self.counts[resource_id][day], self.full[resource_id]
+        capacity = self.capacities[resource_id]
+        for slot in range(start // self.granularity, -(-end // self.granularity)):
+            counts[slot] += count
+            if counts[slot] >= capacity:
+                full[day] |= 1 << slot
+            else:
+                full[day] &= ~(1 << slot)
+
+    def remove(self, resource_id, day, start, end):
+        self.add(resource_id, day, start, end, count=-1)
+
+    def full_mask(self, resource_id, day):
+        """Returns the mask of slots on day where the resource can't take another appointment"""
+        masks = self.full.get(resource_id)
+        return masks[day] if masks else 0
+
+    def fits(self, resource_id, day, start, end):
+        """Returns whether the resource has room for one more appointment from start to end"""
+        return not self.full_mask(resource_id, day) & span_mask(start, end, self.granularity)
+
+    @classmethod
+    def load(cls, resource_ids, schedule=None, exclude=(), granularity=GRANULARITY):
+        """Builds the map of the given resources from the appointments using them.
+
+        Appointments on active schedules and on schedule count, apart from those
+        whose pks are in exclude, e.g. one being edited. Takes two queries.
+        """
+        occupancy = cls(Resource.objects.filter(pk__in=set(resource_ids) - {None}).values_list('pk', 'capacity'),
+                        granularity=granularity)
+        if occupancy.capacities:
+            serviceinstances = get_serviceinstances(occupancy.capacities, schedule=schedule, exclude=exclude)
+            for resource_id, day, start, end in serviceinstances:
+                occupancy.add(resource_id, DAYS.index(day), start, end)
+        return occupancy
+
+
+def get_serviceinstances(resource_ids, schedule=None, exclude=()):
+    """Returns (resource id, day, start, end) of the appointments using the given resources"""
+    on_schedules = Q(scheduled_for__active=True)
+    if schedule is not None:
+        on_schedules |= Q(scheduled_for=schedule)
+    return (ServiceInstance.objects
+            .filter(on_schedules, resource__in=list(resource_ids), day__in=DAYS)
+            .exclude(pk__in=list(exclude))
+            .exclude(time_start=None).exclude(time_end=None)
+            .with_minutes()
+            .order_by()
+            .values_list('resource_id', 'day', 'start_minute', 'end_minute'))
+
+
+def find_free_slots(schedule, service, minutes, day=None):
+    """Returns every (day, start) a session of minutes could be added to schedule for service.
+
+    The teacher and the student have to be free, on schedule, and the service's
+    resource, if it has one, must have room. day, an index into DAYS, limits the
+    search to one day. Starts are in minutes, GRANULARITY apart.
+    """
+    problem = Problem.from_schedule(schedule, services=Service.objects.filter(pk=service.pk))
+    length = -(-minutes // problem.granularity)
+    student_busy = problem.student_busy.get(service.student_id, [0] * len(DAYS))
+    slots = []
+    for index in range(len(DAYS)) if day is None else [day]:
+        free = problem.available[index] & ~problem.teacher_busy[index] & ~student_busy[index]
+        if problem.occupancy is not None:
+            free &= ~problem.occupancy.full_mask(service.resource_id, index)
+        slots += [(index, start * problem.granularity) for start in iter_bits(fit_mask(free, length))]
+    return slots
@@ -0,0 +1,78 @@
+"""Keyset ("cursor") pagination.
+
+Paging with OFFSET makes the database read and throw away every row before the
+page, so later pages get slower and rows shift between pages when others are
+added or removed. Here a page instead starts after the last row of the page
+before: the cursor holds that row's values of the ordering fields, and the next
+page is the rows ordered after them. With an index on the ordering fields each
+page costs the same however deep it is.
+
+The ordering must end in a unique field, such as the primary key, so every row
+has a distinct position. Ordering fields must not be null.
+"""
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(values):
+    data = json.dumps([str(value) for value in values], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def decode_cursor(cursor, fields):
+    """Returns the values held in a cursor, converted to the types of fields"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor('cursor is not valid')
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise InvalidCursor('cursor is not valid')
+    try:
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except ValidationError:
+        raise InvalidCursor('cursor is not valid')
+
+def after(ordering, values):
+    """Returns a Q matching rows ordered after values, e.g. for (a, b):  a > x OR (a = x AND b > y)"""
+    condition = Q()
+    for position in range(len(ordering)):
+        term = Q(**{f'{ordering[position]}__gt': values[position]})
+        for name, value in zip(ordering[:position], values[:position]):
+            term &= Q(**{name: value})
+        condition |= term
+    return condition
+
+
+class KeysetPage:
+    """One page of rows and the cursor of the page after it, None on the last page"""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+def paginate(queryset, ordering, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """Returns the KeysetPage of queryset starting after cursor, ordered by the fields in ordering"""
+    fields = [queryset.model._meta.get_field(name) for name in ordering]
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        queryset = queryset.filter(after(ordering, decode_cursor(cursor, fields)))
+    # One row more than the page tells whether there is a next page
+    items = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = encode_cursor([field.value_from_object(last) for field in fields])
+    return KeysetPage(items, next_cursor)
@@ -0,0 +1,119 @@
+"""The app's hot queries and their query plans.
+
+HOT_QUERIES builds, for a benchmark Dataset, each query the busiest pages run.
+explain() asks the database how it would run each one, using QuerySet.explain,
+and reduces the plans to a comparable form: the steps and the tables and
+indexes they use, without costs or row estimates, which change with the data.
+compare() then reports where a plan differs from a saved baseline, and any
+query that now reads a whole table where it didn't before.
+
+Plans differ between databases, so baselines are kept per vendor in
+query_plan_baseline.json, written by "explain_queries --save", or by the
+first run of explain_queries on a database it has no baseline for.
+"""
+import datetime
+import json
+import os
+import re
+
+from django.db import connection
+from django.db.models import Sum
+
+from app import compliance, conflicts, occupancy, roster
+from app.models import Schedule, Service, ServiceInstance, Student, duration_expression
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'query_plan_baseline.json')
+
+HOT_QUERIES = {
+    # The roster import and the API
+    'students of teacher': lambda data: Student.objects.filter(teacher=data.teacher),
+    # StudentListView, a page of students with their badges, and searching it by name
+    'roster page': lambda data: (roster.with_status(Student.objects.filter(teacher=data.teacher))
+                                 .order_by(*roster.ORDERING)[:roster.PAGE_SIZE + 1]),
+    'roster search': lambda data: (roster.search(Student.objects.filter(teacher=data.teacher), data.student.last_name[:4])
+                                   .order_by(*roster.ORDERING)[:roster.PAGE_SIZE + 1]),
+    # ScheduleListView
+    'schedules of teacher': lambda data: Schedule.objects.filter(teacher=data.teacher),
+    # Schedule.save looking for the teacher's active schedule to deactivate
+    'active schedules': lambda data: (Schedule.objects.filter(teacher_id=data.teacher.pk, active=True)
+                                      .exclude(pk=data.schedule.pk).values_list('pk', flat=True)),
+    # ServiceListView and the solver
+    'services of teacher': lambda data: Service.objects.filter(student__teacher=data.teacher).select_related('student'),
+    # app.roster_import matching services by natural key
+    'services of students': lambda data: Service.objects.filter(student_id__in=[data.student.pk]),
+    # ScheduleGrid and get_conflicts
+    'schedule grid': lambda data: (ServiceInstance.objects.filter(scheduled_for=data.schedule)
+                                   .select_related('service__student').order_by('day', 'time_start')),
+    # find_conflict, run for every appointment form
+    'overlapping appointment': lambda data: (conflicts.get_overlapping(data.schedule, 'Monday', datetime.time(9),
+                                                                       datetime.time(10))
+                                             .select_related('service__student').order_by('time_start', 'pk')[:1]),
+    # OccupancyMap.load, for the solver and the appointment forms
+    'resource occupancy': lambda data: occupancy.get_serviceinstances([data.room.pk], schedule=data.schedule),
+    # app.allocation.get_allocated_times, refreshing services' allocated minutes
+    'allocated times': lambda data: (ServiceInstance.objects
+                                     .filter(service__in=Service.objects.filter(student__teacher=data.teacher),
+                                             scheduled_for__active=True)
+                                     .order_by().values('service_id')
+                                     .annotate(allocated_time=Sum(duration_expression()))),
+    # app.compliance.refresh_teachers, summing a teacher's services for the district report
+    'compliance totals': lambda data: compliance.summarise(Service.objects.filter(student__teacher_id__in=[data.teacher.pk])),
+    }
+
+
+def normalise(plan, vendor):
+    """Returns a plan as a list of steps, without costs, row counts or generated names"""
+    steps = []
+    for line in plan.splitlines():
+        if vendor == 'sqlite':
+            # Rows are "id parent notused detail", older SQLite also says "TABLE"
+            line = re.sub(r'^\d+ \d+ \d+ ', '', line.strip()).replace(' TABLE ', ' ')
+        elif vendor == 'postgresql':
+            if line.strip().startswith(('Filter:', 'Index Cond:', 'Hash Cond:', 'Join Filter:', 'Sort Key:',
+                                        'Group Key:', 'Recheck Cond:', 'Rows Removed', 'Planning', 'Execution')):
+                continue
+            line = re.sub(r'\s*\(cost=[^)]*\)', '', line).replace('->', '').strip()
+        else:
+            line = line.strip()
+        if line:
+            steps.append(line)
+    return steps
+
+def is_full_scan(step):
+    """Returns whether a plan step reads every row of a table"""
+    return bool(re.match(r'SCAN \w+$', step) or step.startswith('Seq Scan'))
+
+def explain(dataset):
+    """Returns a dict mapping the name of each hot query to its normalised plan"""
+    return {name: normalise(build(dataset).explain(), connection.vendor) for name, build in HOT_QUERIES.items()}
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline:
+        return json.load(baseline).get(connection.vendor, {})
+
+def save_baseline(plans, path=BASELINE_PATH):
+    """Saves plans as the baseline for this database vendor, keeping those of other vendors"""
+    baselines = {}
+    if os.path.exists(path):
+        with open(path) as baseline:
+            baselines = json.load(baseline)
+    baselines[connection.vendor] = plans
+    with open(path, 'w') as baseline:
+        json.dump(baselines, baseline, indent=2, sort_keys=True)
+        baseline.write('\n')
+
+def compare(plans, baseline):
+    """Returns (regressions, changes): full scans that are new, and other differences from the baseline"""
+    regressions, changes = [], []
+    for name, steps in plans.items():
+        if name not in baseline:
+            changes.append(f'{name}: no baseline')
+            continue
+        if steps == baseline[name]:
+            continue
+        new_scans = [step for step in steps if is_full_scan(step) and step not in baseline[name]]
+        message = f'{name}:\n    was: ' + '\n         '.join(baseline[name]) + '\n    now: ' + '\n         '.join(steps)
+        (regressions if new_scans else changes).append(message)
+    return regressions, changes
@@ -0,0 +1,192 @@
+"""Repairs a schedule after a few services or the teacher's free time change.
+
+Generating a schedule again to take in one student's new requirement throws
+away every appointment that was fine as it was. A repair instead keeps every
+appointment that the changes don't touch exactly where it is, and only works
+on the affected ones:
+
+* appointments of services that were removed, or are no longer on the
+  teacher's caseload, are deleted
+* appointments falling in newly blocked time are taken off the week, and
+  their services need that time placing again
+* a service given less time than it has loses whole appointments, smallest
+  first, as long as it keeps all the time it needs
+* a service given more time, or a new one, needs the difference placing
+
+The minutes still needed are then placed by the solver around the fixed
+appointments, which are bookings it can't move, within the teacher's day and
+outside the time they weren't free when the schedule was generated, which the
+schedule keeps. Newly blocked time is added to the schedule's once the repair
+is saved, so later repairs keep to it as well. Only the affected services
+are searched, so the work grows with the size of the change rather than the
+caseload. An appointment taken off the week and placed again becomes a move of
+the existing row, so the result is the smallest set of appointments created,
+moved and deleted.
+"""
+from collections import namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from app.allocation import refresh_services
+from app.forms import format_blocked_periods, parse_blocked_periods
+from app.fragment_cache import invalidate_schedule, invalidate_teacher
+from app.grid import DAYS
+from app.models import Schedule, Service, ServiceInstance, to_minutes, to_time
+from app.occupancy import OccupancyMap
+from app.schedule_events import publish_reload
+from app.solver import SESSION_MINUTES, Booking, Need, Problem, solve
+
+TIME_BUDGET = 1.0   # seconds, repairs search far fewer services than a full generation
+
+# An appointment on the schedule, in minutes since midnight; day is an index into DAYS
+Appointment = namedtuple('Appointment', 'pk service_id student_id day start end')
+
+
+class Changes:
+    """What changed since the schedule was made"""
+
+    def __init__(self, services=(), blocked=()):
+        self.service_ids = set(services)    # services added, edited or removed
+        self.blocked = list(blocked)        # Blocks of time the teacher is no longer free
+
+
+class Diff:
+    """The appointments a repair creates, moves and deletes"""
+
+    def __init__(self, schedule, blocked=()):
+        self.schedule = schedule
+        self.blocked = list(blocked)    # Blocks of newly blocked time, added to the schedule's
+        self.created = []       # Placements
+        self.moved = []         # (ServiceInstance pk, Placement it moves to)
+        self.deleted = []       # ServiceInstance pks
+        self.service_ids = set()  # every service whose appointments change
+        self.solution = None
+
+    @property
+    def unmet(self):
+        """Returns a dict mapping service id to the minutes the repair couldn't place"""
+        return self.solution.unmet if self.solution else {}
+
+    def __bool__(self):
+        return bool(self.created or self.moved or self.deleted or self.blocked)
+
+    def __str__(self):
+        return (f'{len(self.created)} appointments created, {len(self.moved)} moved, {len(self.deleted)} deleted, '
+                f'{sum(self.unmet.values())} minutes could not be placed')
+
+
+def overlaps(block, appointment):
+    return (block.day is None or block.day == appointment.day) and block.start < appointment.end and appointment.start < block.end
+
+def get_constraints(schedule):
+    """Returns the availability and Blocks the schedule was generated with, for the solver's Problem"""
+    availability = None
+    if schedule.day_start is not None and schedule.day_end is not None:
+        availability = [[(to_minutes(schedule.day_start), to_minutes(schedule.day_end))] for day in DAYS]
+    # Checked when they were saved
+    return availability, parse_blocked_periods(schedule.blocked_periods)
+
+def plan_repair(schedule, changes, time_budget=TIME_BUDGET, session_minutes=SESSION_MINUTES):
+    """Works out the Diff repairing schedule after changes, without saving anything"""
+    appointments = [
+        Appointment(pk, service_id, student_id, DAYS.index(day) if day in DAYS else None, start, end)
+        for pk, service_id, student_id, day, start, end in
+        ServiceInstance.objects.filter(scheduled_for=schedule)
+        .exclude(time_start=None).exclude(time_end=None)
+        .with_minutes()
+        .values_list('pk', 'service_id', 'service__student_id', 'day', 'start_minute', 'end_minute')]
+
+    # Services that were changed, and those with appointments in time that is now blocked
+    affected = set(changes.service_ids)
+    for appointment in appointments:
+        if appointment.day is not None and any(overlaps(block, appointment) for block in changes.blocked):
+            affected.add(appointment.service_id)
+    services = {service.pk: service for service in
+                Service.objects.filter(pk__in=affected - {None}, student__teacher=schedule.teacher_id)
+                .only('id', 'student_id', 'service_type', 'total_time_req', 'resource_id')}
+
+    diff = Diff(schedule, changes.blocked)
+    kept = {}           # pk -> appointment staying where it is
+    own = {}            # service id -> kept appointments of each affected service
+    displaced = {}      # service id -> appointments taken off the week, which may be moved back on
+    for appointment in appointments:
+        if appointment.service_id is None or (appointment.service_id in affected and appointment.service_id not in services):
+            # The service was deleted, or isn't the teacher's any more
+            diff.deleted.append(appointment.pk)
+        elif appointment.day is not None and any(overlaps(block, appointment) for block in changes.blocked):
+            displaced.setdefault(appointment.service_id, []).append(appointment)
+        else:
+            kept[appointment.pk] = appointment
+            if appointment.service_id in services:
+                own.setdefault(appointment.service_id, []).append(appointment)
+
+    needs = []
+    for service in services.values():
+        placed = sum(appointment.end - appointment.start for appointment in own.get(service.pk, ()))
+        for appointment in sorted(own.get(service.pk, ()), key=lambda appointment: appointment.end - appointment.start):
+            if placed - (appointment.end - appointment.start) < service.total_time_req:
+                break
+            # More time than the service needs, even without this one
+            placed -= appointment.end - appointment.start
+            del kept[appointment.pk]
+            diff.deleted.append(appointment.pk)
+        needs.append(Need(service.pk, service.student_id, service.service_type, service.total_time_req - placed))
+
+    # Rooms and staff the services use, as full as they are without the appointments being taken off
+    resources = {service.pk: service.resource_id for service in services.values() if service.resource_id is not None}
+    occupancy = None
+    if resources:
+        occupancy = OccupancyMap.load(resources.values(), schedule=schedule,
+                                      exclude=diff.deleted + [appointment.pk for appointments in displaced.values()
+                                                              for appointment in appointments])
+    availability, blocked = get_constraints(schedule)
+    problem = Problem(needs, availability=availability, blocked=blocked + changes.blocked, session_minutes=session_minutes,
+                      bookings=[Booking(appointment.student_id, appointment.day, appointment.start, appointment.end)
+                                for appointment in kept.values() if appointment.day is not None],
+                      resources=resources, occupancy=occupancy)
+    diff.solution = solve(problem, time_budget=time_budget)
+    for placement in diff.solution.placements:
+        if displaced.get(placement.service_id):
+            diff.moved.append((displaced[placement.service_id].pop().pk, placement))
+        else:
+            diff.created.append(placement)
+    diff.deleted += [appointment.pk for appointments in displaced.values() for appointment in appointments]
+    diff.service_ids = (affected | set(services)) - {None}
+    return diff
+
+def apply_repair(diff):
+    """Saves the appointments of a Diff, all at once"""
+    schedule = diff.schedule
+    resources = diff.solution.problem.resources if diff.solution else {}
+    now = timezone.now()
+    with transaction.atomic():
+        ServiceInstance.objects.filter(pk__in=diff.deleted).delete()
+        for pk, placement in diff.moved:
+            # update() skips auto_now
+            ServiceInstance.objects.filter(pk=pk).update(day=DAYS[placement.day], time_start=to_time(placement.start),
+                                                        time_end=to_time(placement.end),
+                                                        resource_id=resources.get(placement.service_id), updated_at=now)
+        ServiceInstance.objects.bulk_create([
+            ServiceInstance(service_id=placement.service_id, day=DAYS[placement.day],
+                            time_start=to_time(placement.start), time_end=to_time(placement.end),
+                            scheduled_for=schedule, resource_id=resources.get(placement.service_id))
+            for placement in diff.created])
+        if diff.blocked:
+            blocked = parse_blocked_periods(Schedule.objects.select_for_update().get(pk=schedule.pk).blocked_periods)
+            Schedule.objects.filter(pk=schedule.pk).update(blocked_periods=format_blocked_periods(
+                blocked + [block for block in diff.blocked if block not in blocked]),
+                                                           updated_at=now)
+        # Moves and bulk_create don't send signals, so the services' minutes are refreshed here
+        refresh_services(diff.service_ids)
+    # and the cached pages are invalidated, and reloaded where they are open
+    invalidate_schedule(schedule.pk)
+    invalidate_teacher(schedule.teacher_id)
+    publish_reload(schedule.pk)
+
+def repair_schedule(schedule, changes, time_budget=TIME_BUDGET, session_minutes=SESSION_MINUTES):
+    """Repairs schedule after changes and returns the Diff saved"""
+    diff = plan_repair(schedule, changes, time_budget=time_budget, session_minutes=session_minutes)
+    if diff:
+        apply_repair(diff)
+    return diff
@@ -0,0 +1,62 @@
+"""Searching and filtering a teacher's students for the roster page.
+
+Names are searched by prefix: every word typed has to be the start of the
+student's first or last name, ignoring case, so "smi jo" finds Jo Smith. Each
+word becomes a range on the lowercased name, lower(last_name) >= 'smi' and
+< 'smj', which the expression indexes created by migration 0008 answer
+directly, so a search costs the same on a caseload of ten or ten thousand.
+Prefix ranges are used rather than LIKE because SQLite only uses an index for
+LIKE on a case-insensitive column, and PostgreSQL only with a pattern index.
+
+The satisfaction filters read Student.serviced, which app.allocation keeps up
+to date, and whether the student has any services, an indexed lookup per row.
+"""
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Lower
+
+from app.models import Service
+
+# Order of the roster, ending in the primary key so it can be paged by keyset
+ORDERING = ('last_name', 'first_name', 'id')
+PAGE_SIZE = 50
+
+STATUSES = (
+    ('', 'All students'),
+    ('satisfied', 'Satisfied'),
+    ('unsatisfied', 'Not satisfied'),
+    ('none', 'No services added'),
+    )
+
+
+def get_prefix_range(prefix):
+    """Returns (low, high) such that the strings starting with prefix are those >= low and < high"""
+    prefix = prefix.lower()
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def search(queryset, query):
+    """Returns the students of queryset whose first or last name starts with every word of query"""
+    words = query.split()
+    if not words:
+        return queryset
+    queryset = queryset.annotate(last_name_lower=Lower('last_name'), first_name_lower=Lower('first_name'))
+    for word in words:
+        low, high = get_prefix_range(word)
+        queryset = queryset.filter(Q(last_name_lower__gte=low, last_name_lower__lt=high) |
+                                   Q(first_name_lower__gte=low, first_name_lower__lt=high))
+    return queryset
+
+def with_status(queryset):
+    """Annotates has_services on students, which with serviced decides their badge"""
+    return queryset.annotate(has_services=Exists(Service.objects.filter(student=OuterRef('pk'))))
+
+def filter_status(queryset, status):
+    """Returns the students of queryset with the given status, one of STATUSES; annotated by with_status"""
+    queryset = with_status(queryset)
+    if status == 'satisfied':
+        return queryset.filter(has_services=True, serviced=True)
+    if status == 'unsatisfied':
+        # A student without services counts as serviced, so this needs no has_services check
+        return queryset.filter(serviced=False)
+    if status == 'none':
+        return queryset.filter(has_services=False)
+    return queryset
@@ -0,0 +1,247 @@
+"""Imports students and their services from CSV or JSON Lines files.
+
+Each row describes a student and, optionally, one of their services:
+
+    teacher, first_name, middle_name, last_name, subject, service_type, total_time_req
+
+teacher is a username and may be left out when a default teacher is given.
+Rows are read one at a time and handled in batches: each batch is validated,
+matched against what is already in the database by natural key, and written
+with bulk_create in its own transaction, so memory use doesn't grow with the
+file. A student is identified by teacher and full name, and a service by
+student, subject and service type, so importing the same file twice changes
+nothing the second time; a service whose total_time_req differs is updated.
+Rows that fail validation are reported and skipped without stopping the run.
+"""
+import csv
+import json
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from app.allocation import refresh_students
+from app.compliance import refresh_teachers
+from app.fragment_cache import invalidate_teacher
+from app.models import Service, Student
+
+BATCH_SIZE = 500
+MAX_ERRORS_KEPT = 1000  # errors beyond this are counted but not kept
+
+
+def choice_lookup(choices):
+    """Maps both the stored values and the labels of choices, lowercased, to the stored value"""
+    lookup = {label.lower(): value for value, label in choices}
+    lookup.update({value.lower(): value for value, label in choices})
+    return lookup
+
+SUBJECTS = choice_lookup(Service.SUBJECTS)
+SERVICE_TYPES = choice_lookup(Service.SERVICES)
+NAME_LENGTH = Student._meta.get_field('first_name').max_length
+
+
+class RowError(Exception):
+    pass
+
+
+def read_rows(stream, format):
+    """Yields (line number, row dict) for each row of a CSV or JSON Lines text stream"""
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                row = RowError(f'not valid JSON ({error})')
+            else:
+                if not isinstance(row, dict):
+                    row = RowError('each line must be a JSON object')
+            yield line_number, row
+    else:
+        raise ValueError(f'Unknown format "{format}", use csv or jsonl')
+
+def guess_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+class ImportReport:
+    """What an import did, and the rows it skipped"""
+
+    def __init__(self):
+        self.rows = 0
+        self.students_created = 0
+        self.services_created = 0
+        self.services_updated = 0
+        self.error_count = 0
+        self.errors = []    # (line number, message), the first MAX_ERRORS_KEPT only
+
+    def add_error(self, line_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS_KEPT:
+            self.errors.append((line_number, message))
+
+    def __str__(self):
+        return (f'{self.rows} rows read: {self.students_created} students created, '
+                f'{self.services_created} services created, {self.services_updated} services updated, '
+                f'{self.error_count} rows skipped')
+
+
+class RosterImporter:
+    """Streams rows into Students and Services in batches"""
+
+    def __init__(self, teacher=None, batch_size=BATCH_SIZE, allow_teacher_column=True, on_error=None):
+        self.default_teacher = teacher
+        self.batch_size = batch_size
+        self.allow_teacher_column = allow_teacher_column
+        self.on_error = on_error    # called with (line number, message) as errors happen
+        self.teachers = {}          # username -> User, so each teacher is looked up once
+        self.touched_teacher_ids = set()
+        self.report = ImportReport()
+
+    def run(self, rows):
+        """Imports (line number, row) pairs, e.g. from read_rows, and returns the ImportReport"""
+        batch = []
+        for line_number, row in rows:
+            self.report.rows += 1
+            try:
+                batch.append((line_number, self.clean(row)))
+            except RowError as error:
+                self.error(line_number, str(error))
+            if len(batch) >= self.batch_size:
+                self.save_batch(batch)
+                batch = []
+        if batch:
+            self.save_batch(batch)
+        # bulk_create doesn't send signals, so cached schedule pages are invalidated here
+        for teacher_id in self.touched_teacher_ids:
+            invalidate_teacher(teacher_id)
+        refresh_teachers(self.touched_teacher_ids)
+        return self.report
+
+    def error(self, line_number, message):
+        self.report.add_error(line_number, message)
+        if self.on_error:
+            self.on_error(line_number, message)
+
+    def get_teacher(self, username):
+        if not username or not self.allow_teacher_column:
+            if self.default_teacher is None:
+                raise RowError('no teacher given')
+            return self.default_teacher
+        if username not in self.teachers:
+            self.teachers[username] = User.objects.filter(username=username).first()
+        if self.teachers[username] is None:
+            raise RowError(f'there is no teacher with username "{username}"')
+        return self.teachers[username]
+
+    def clean(self, row):
+        """Returns a validated row as a dict, or raises RowError"""
+        if isinstance(row, RowError):
+            raise row
+
+        def value(name):
+            field = row.get(name)
+            return '' if field is None else str(field).strip()
+
+        cleaned = {'teacher': self.get_teacher(value('teacher'))}
+        for name in ('first_name', 'middle_name', 'last_name'):
+            cleaned[name] = value(name)
+            if len(cleaned[name]) > NAME_LENGTH:
+                raise RowError(f'{name} is longer than {NAME_LENGTH} characters')
+        for name in ('first_name', 'last_name'):
+            if not cleaned[name]:
+                raise RowError(f'{name} is required')
+
+        service_fields = [value('subject'), value('service_type'), value('total_time_req')]
+        if not any(service_fields):
+            cleaned['service'] = None
+            return cleaned
+        subject, service_type, total_time_req = service_fields
+        if subject.lower() not in SUBJECTS:
+            raise RowError(f'unknown subject "{subject}"')
+        if service_type.lower() not in SERVICE_TYPES:
+            raise RowError(f'unknown service type "{service_type}"')
+        try:
+            total_time_req = int(total_time_req)
+        except ValueError:
+            raise RowError(f'total_time_req "{total_time_req}" is not a whole number of minutes')
+        if total_time_req <= 0:
+            raise RowError('total_time_req must be more than 0')
+        cleaned['service'] = (SUBJECTS[subject.lower()], SERVICE_TYPES[service_type.lower()], total_time_req)
+        return cleaned
+
+    @staticmethod
+    def student_key(teacher_id, first_name, middle_name, last_name):
+        return (teacher_id, last_name, first_name, middle_name or '')
+
+    def save_batch(self, batch):
+        with transaction.atomic():
+            students = self.save_students(batch)
+            self.save_services(batch, students)
+            # New services and changed requirements decide whether a student is serviced
+            refresh_students(student.pk for student in students.values())
+
+    def save_students(self, batch):
+        """Creates the batch's new students, returns a dict of every student in it by natural key"""
+        wanted = {}
+        for line_number, row in batch:
+            key = self.student_key(row['teacher'].pk, row['first_name'], row['middle_name'], row['last_name'])
+            wanted.setdefault(key, row)
+            self.touched_teacher_ids.add(row['teacher'].pk)
+
+        students = {}
+        existing = Student.objects.filter(teacher_id__in={key[0] for key in wanted},
+                                          last_name__in={key[1] for key in wanted})
+        for student in existing.only('id', 'teacher_id', 'first_name', 'middle_name', 'last_name'):
+            key = self.student_key(student.teacher_id, student.first_name, student.middle_name, student.last_name)
+            if key in wanted:
+                students[key] = student
+
+        new_students = [Student(teacher=row['teacher'], first_name=row['first_name'],
+                                middle_name=row['middle_name'] or None, last_name=row['last_name'])
+                        for key, row in wanted.items() if key not in students]
+        # Student ids are UUIDs made in Python, so bulk_create leaves them set
+        Student.objects.bulk_create(new_students, batch_size=self.batch_size)
+        self.report.students_created += len(new_students)
+        for student in new_students:
+            students[self.student_key(student.teacher_id, student.first_name, student.middle_name, student.last_name)] = student
+        return students
+
+    def save_services(self, batch, students):
+        wanted = {}
+        for line_number, row in batch:
+            if row['service'] is None:
+                continue
+            student = students[self.student_key(row['teacher'].pk, row['first_name'], row['middle_name'], row['last_name'])]
+            subject, service_type, total_time_req = row['service']
+            wanted[(student.pk, subject, service_type)] = total_time_req
+        if not wanted:
+            return
+
+        existing = {}
+        for service in (Service.objects
+                        .filter(student_id__in={key[0] for key in wanted})
+                        .only('id', 'student_id', 'subject', 'service_type', 'total_time_req')):
+            existing[(service.student_id, service.subject, service.service_type)] = service
+
+        new_services = []
+        updates = defaultdict(list)     # total_time_req -> ids of services to change to it
+        for (student_id, subject, service_type), total_time_req in wanted.items():
+            service = existing.get((student_id, subject, service_type))
+            if service is None:
+                new_services.append(Service(student_id=student_id, subject=subject, service_type=service_type,
+                                            total_time_req=total_time_req, satisfied=False))
+            elif service.total_time_req != total_time_req:
+                updates[total_time_req].append(service.pk)
+        Service.objects.bulk_create(new_services, batch_size=self.batch_size)
+        self.report.services_created += len(new_services)
+        # One UPDATE per distinct requirement rather than one per service
+        for total_time_req, service_ids in updates.items():
+            self.report.services_updated += Service.objects.filter(pk__in=service_ids).update(
+                total_time_req=total_time_req, updated_at=timezone.now())
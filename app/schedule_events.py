@@ -0,0 +1,105 @@
+"""Publishes the changes to a schedule's appointments to the pages showing it.
+
+Each schedule has a log of numbered events in the "schedules" cache: an
+appointment saved, with where it now goes on the grid, an appointment deleted,
+or, after a change too big to describe one appointment at a time, a reload of
+the whole page. The signal handlers in app.signals publish an event for every
+appointment saved or deleted, and code changing rows in bulk publishes a
+reload.
+
+RSPscheduler.asgi streams the log of a schedule to its open pages as
+server-sent events, and the page patches its grid in place. The log is kept in
+the cache, rather than in the memory of the process serving the stream, so
+changes made by any worker reach every page. Only the last EVENT_LOG_LENGTH
+events are kept, for EVENT_TIMEOUT; a page further behind than that reloads.
+Like the version counters in app.fragment_cache, event numbers start from the
+current time in milliseconds, so a log that is evicted restarts above any
+number a page has seen and every page following it reloads.
+"""
+from django.db import transaction
+from django.urls import reverse
+
+from app.fragment_cache import get_cache, new_version
+from app.grid import DAYS
+from app.models import to_minutes
+
+EVENT_LOG_LENGTH = 100      # events kept per schedule
+EVENT_TIMEOUT = 60 * 60     # seconds an event is kept
+
+
+def get_events_url(schedule_id):
+    """Returns the path of a schedule's event stream, served by RSPscheduler.asgi rather than app.urls"""
+    return reverse('schedule-detail', args=[schedule_id]) + '/events'
+
+def get_latest(schedule_id):
+    """Returns the number of the last event published for a schedule"""
+    return get_cache().get_or_set(f'events:{schedule_id}', new_version, None)
+
+def get_latest_many(schedule_ids):
+    """Returns a dict mapping each of schedule_ids to the number of its last event, with one cache lookup"""
+    keys = {f'events:{schedule_id}': schedule_id for schedule_id in schedule_ids}
+    found = get_cache().get_many(list(keys))
+    # A log that was evicted starts again, as get_latest would
+    return {schedule_id: found[key] if key in found else get_latest(schedule_id) for key, schedule_id in keys.items()}
+
+def publish(schedule_id, event):
+    """Adds event, a dict with a "type", to the log of a schedule and returns its number"""
+    if schedule_id is None:
+        return None
+    cache = get_cache()
+    key = f'events:{schedule_id}'
+    # incr is atomic on every backend app.checks allows, so no two events get the same number
+    try:
+        number = cache.incr(key)
+    except ValueError:
+        number = new_version()
+        if not cache.add(key, number, None):
+            number = cache.incr(key)
+    cache.set(f'{key}:{number}', event, EVENT_TIMEOUT)
+    return number
+
+def get_events(schedule_id, after):
+    """Returns (latest, events): the number of the last event, and the (number, event) pairs after `after`.
+
+    events is None when some of them are no longer kept, and the page has to reload.
+    """
+    latest = get_latest(schedule_id)
+    if after >= latest:
+        return latest, []
+    if latest - after > EVENT_LOG_LENGTH:
+        return latest, None
+    keys = {number: f'events:{schedule_id}:{number}' for number in range(after + 1, latest + 1)}
+    found = get_cache().get_many(list(keys.values()))
+    if len(found) < len(keys):
+        return latest, None
+    return latest, [(number, found[key]) for number, key in keys.items()]
+
+
+def appointment_event(serviceinstance):
+    """Returns the event for an appointment saved, or deleted when it isn't on the grid"""
+    if serviceinstance.day not in DAYS or serviceinstance.time_start is None or serviceinstance.time_end is None:
+        return {'type': 'deleted', 'id': serviceinstance.pk}
+    return {
+        'type': 'saved',
+        'id': serviceinstance.pk,
+        'day': serviceinstance.day,
+        'start': to_minutes(serviceinstance.time_start),
+        'end': to_minutes(serviceinstance.time_end),
+        'label': str(serviceinstance),
+        'url': serviceinstance.get_absolute_url(),
+        }
+
+def publish_appointment(serviceinstance, previous_schedule_id=None, deleted=False):
+    """Publishes an appointment saved or deleted once the transaction saving it commits"""
+    schedule_id = serviceinstance.scheduled_for_id
+    events = {}
+    if previous_schedule_id is not None and previous_schedule_id != schedule_id:
+        # It moved to another schedule, so it leaves the page of the old one
+        events[previous_schedule_id] = {'type': 'deleted', 'id': serviceinstance.pk}
+    if schedule_id is not None:
+        events[schedule_id] = {'type': 'deleted', 'id': serviceinstance.pk} if deleted else appointment_event(serviceinstance)
+    transaction.on_commit(lambda: [publish(pk, event) for pk, event in events.items()])
+
+def publish_reload(schedule_id):
+    """Tells the pages of a schedule to reload, after changes made in bulk"""
+    transaction.on_commit(lambda: publish(schedule_id, {'type': 'reload'}))
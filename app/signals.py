@@ -0,0 +1,131 @@
+"""Signal handlers keeping derived data in step with the models.
+
+They invalidate cached pages (app.fragment_cache), refresh the stored
+satisfaction totals (app.allocation) and the district summary
+(app.compliance), and tell open schedule pages what changed
+(app.schedule_events). Connected in AppConfig.ready. Rows
+changed with bulk_create or update() don't send these signals, so code doing
+that invalidates and refreshes what it changes itself.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from app.allocation import get_service_ids, refresh_schedules, refresh_services, refresh_students
+from app.compliance import refresh_teachers
+from app.fragment_cache import invalidate_schedule, invalidate_teacher
+from app.models import Schedule, Service, ServiceInstance, Student
+from app.schedule_events import publish_appointment, publish_reload
+
+
+def get_teacher_id(schedule_id):
+    return Schedule.objects.filter(pk=schedule_id).values_list('teacher_id', flat=True).first()
+
+def get_previous(instance, *fields):
+    """Returns the saved values of fields of an instance about to be saved, or None if it is new"""
+    if instance.pk is None or instance._state.adding:
+        return None
+    return type(instance).objects.filter(pk=instance.pk).values(*fields).first()
+
+
+@receiver(pre_save, sender=ServiceInstance)
+def remember_serviceinstance(sender, instance, **kwargs):
+    # An appointment moved to another schedule or service changes that one too
+    instance._previous = get_previous(instance, 'scheduled_for_id', 'service_id')
+
+@receiver(post_save, sender=ServiceInstance)
+@receiver(post_delete, sender=ServiceInstance)
+def serviceinstance_changed(sender, instance, **kwargs):
+    schedule_ids = {instance.scheduled_for_id}
+    service_ids = {instance.service_id}
+    previous = getattr(instance, '_previous', None)
+    if previous:
+        schedule_ids.add(previous['scheduled_for_id'])
+        service_ids.add(previous['service_id'])
+    refresh_services(service_ids)
+    for schedule_id in schedule_ids - {None}:
+        invalidate_schedule(schedule_id)
+        # Satisfaction is shown on all of the teacher's schedules
+        invalidate_teacher(get_teacher_id(schedule_id))
+    publish_appointment(instance, previous['scheduled_for_id'] if previous else None,
+                        deleted=kwargs['signal'] is post_delete)
+
+
+@receiver(pre_save, sender=Service)
+def remember_service(sender, instance, **kwargs):
+    instance._previous = get_previous(instance, 'student__teacher_id', 'student_id')
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def service_changed(sender, instance, **kwargs):
+    teacher_ids = {Student.objects.filter(pk=instance.student_id).values_list('teacher_id', flat=True).first()}
+    previous = getattr(instance, '_previous', None)
+    if previous:
+        teacher_ids.add(previous['student__teacher_id'])
+        refresh_students([previous['student_id']])
+    if kwargs['signal'] is post_delete:
+        refresh_students([instance.student_id])
+    else:
+        # Also covers a changed total_time_req
+        refresh_services([instance.pk])
+    # Its requirement, subject or type may have changed too
+    refresh_teachers(teacher_ids)
+    for teacher_id in teacher_ids - {None}:
+        invalidate_teacher(teacher_id)
+
+
+@receiver(pre_save, sender=Student)
+def remember_student(sender, instance, **kwargs):
+    instance._previous = get_previous(instance, 'teacher_id')
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def student_changed(sender, instance, **kwargs):
+    teacher_ids = {instance.teacher_id}
+    previous = getattr(instance, '_previous', None)
+    if previous:
+        teacher_ids.add(previous['teacher_id'])
+    if kwargs.get('created'):
+        # A student without services has nothing left to schedule
+        refresh_students([instance.pk])
+    elif len(teacher_ids) > 1 or kwargs['signal'] is post_delete:
+        # Their services moved to another teacher, or lost their student
+        refresh_teachers(teacher_ids)
+    for teacher_id in teacher_ids - {None}:
+        invalidate_teacher(teacher_id)
+
+
+@receiver(pre_save, sender=Schedule)
+def remember_schedule(sender, instance, **kwargs):
+    instance._previous = get_previous(instance, 'teacher_id', 'active')
+
+@receiver(pre_delete, sender=Schedule)
+def remember_deleted_schedule(sender, instance, **kwargs):
+    # Its appointments lose their schedule without signals, so note whose time they counted for
+    instance._service_ids = get_service_ids([instance.pk]) if instance.active else set()
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def schedule_changed(sender, instance, **kwargs):
+    teacher_ids = {instance.teacher_id}
+    previous = getattr(instance, '_previous', None)
+    if previous:
+        teacher_ids.add(previous['teacher_id'])
+    if kwargs['signal'] is post_delete:
+        refresh_services(getattr(instance, '_service_ids', ()))
+    else:
+        # Schedule.save notes which of the teacher's schedules it deactivated
+        changed_ids = set(getattr(instance, '_deactivated_ids', set()))
+        if instance.active != (previous['active'] if previous else False):
+            changed_ids.add(instance.pk)
+        refresh_schedules(changed_ids)
+
+    def invalidate():
+        invalidate_schedule(instance.pk)
+        for teacher_id in teacher_ids - {None}:
+            invalidate_teacher(teacher_id)
+    invalidate()
+    publish_reload(instance.pk)
+    # Schedule.save runs in a transaction, and pages other requests render before
+    # it commits still show the old active schedule, so they're dropped again after
+    transaction.on_commit(invalidate)
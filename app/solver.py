@@ -0,0 +1,516 @@
+"""Generates service appointments for a schedule automatically.
+
+The teacher's services are turned into sessions (blocks of time to place), and
+the sessions are placed on the week with a depth-first branch and bound search:
+
+* The week is a set of bitmasks, one per day for the teacher and one per day for
+  each student, with a bit for every slot of GRANULARITY minutes. Checking
+  whether a session fits, or finding every start time it fits at, is a handful
+  of integer operations. Services using a room or member of staff also need it
+  to have room, which an OccupancyMap (app.occupancy) answers with masks too.
+* At every step the service whose next session has the fewest places left is
+  placed first (most constrained variable), and the places are tried best
+  first: least loaded day, then next to something already booked so the free
+  time stays in large blocks.
+* A branch is given up as soon as the minutes it could still place, bounded by
+  both the sessions that still fit and the teacher's free time, can't beat the
+  best plan found so far.
+* The search is run as limited discrepancy search, so the first dive is a good
+  greedy plan and later passes explore the alternatives closest to it first.
+
+Search stops when every required minute is placed, the whole tree has been
+searched or the time budget runs out, and returns the best plan found. It is
+reported optimal only when it places every minute or the whole tree was searched;
+a search stopped early at a lower target may have missed a better plan.
+Problems are plain data so they can be sent to other processes, which
+solve_parallel uses to run several differently seeded searches at once.
+"""
+import logging
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from app.allocation import refresh_services
+from app.fragment_cache import get_cache, invalidate_schedule, invalidate_teacher
+from app.grid import DAYS, DAY_START, DAY_END
+from app.models import Schedule, Service, ServiceInstance, to_time
+from app.schedule_events import publish_reload
+
+logger = logging.getLogger(__name__)
+
+# Generations started from views are run here, one at a time per process. Their
+# status is kept in the "schedules" cache, which every worker process shares
+_background = ThreadPoolExecutor(max_workers=1)
+STATUS_TIMEOUT = 60 * 60    # seconds the status of a finished generation is kept
+STALE_AFTER = 5 * 60        # seconds past its budget a running generation is taken to have died
+
+GRANULARITY = 15        # minutes per slot
+SESSION_MINUTES = 30    # the longest session a service is split into
+TIME_BUDGET = 5.0       # seconds
+
+
+# A service still needing time, with minutes already on the schedule taken off
+Need = namedtuple('Need', 'service_id student_id service_type minutes')
+# A period the teacher is not available, day is an index into DAYS or None for every day
+Block = namedtuple('Block', 'day start end')
+# An appointment the solver has placed, in minutes since midnight
+Placement = namedtuple('Placement', 'service_id day start end')
+# An appointment already on the schedule
+Booking = namedtuple('Booking', 'student_id day start end')
+
+
+def span_mask(start, end, granularity=GRANULARITY):
+    """Returns a bitmask of every slot that start..end (in minutes) touches"""
+    first = start // granularity
+    last = -(-end // granularity)
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+def count_bits(mask):
+    return bin(mask).count('1')
+
+def fit_mask(free, length):
+    """Returns a mask with bit i set when slots i..i+length-1 are all free"""
+    starts = free
+    for shift in range(1, length):
+        starts &= free >> shift
+    return starts
+
+def iter_bits(mask):
+    """Yields the index of each set bit, lowest first"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class Problem:
+    """Everything the search needs to know, detached from the database"""
+
+    def __init__(self, needs, availability=None, blocked=(), bookings=(),
+                 session_minutes=SESSION_MINUTES, granularity=GRANULARITY, resources=None, occupancy=None):
+        self.needs = [need for need in needs if need.minutes > 0]
+        self.granularity = granularity
+        self.session_minutes = session_minutes
+        # The resource each service's appointments use, by service id, and how full
+        # the resources already are, an OccupancyMap with the same granularity
+        self.resources = dict(resources or {})
+        self.occupancy = occupancy
+        self.resource_ids = [self.resources.get(need.service_id) for need in self.needs]
+
+        # The slots the teacher can use on each day
+        if availability is None:
+            availability = [[(DAY_START, DAY_END)] for day in DAYS]
+        self.available = []
+        for day, windows in enumerate(availability):
+            mask = 0
+            for start, end in windows:
+                mask |= span_mask(start, end, granularity)
+            for block in blocked:
+                if block.day is None or block.day == day:
+                    mask &= ~span_mask(block.start, block.end, granularity)
+            self.available.append(mask)
+
+        # The slots already taken on the schedule, for the teacher and each student
+        self.teacher_busy = [0] * len(DAYS)
+        self.student_busy = {}
+        for booking in bookings:
+            mask = span_mask(booking.start, booking.end, granularity)
+            self.teacher_busy[booking.day] |= mask
+            if booking.student_id is not None:
+                busy = self.student_busy.setdefault(booking.student_id, [0] * len(DAYS))
+                busy[booking.day] |= mask
+
+        # Each need is split into sessions of at most session_minutes, in slots
+        self.sessions = []
+        for need in self.needs:
+            lengths = []
+            minutes = need.minutes
+            while minutes > 0:
+                length = -(-min(minutes, session_minutes) // granularity)
+                lengths.append(length)
+                minutes -= length * granularity
+            self.sessions.append(lengths)
+
+    @property
+    def needed_minutes(self):
+        return sum(need.minutes for need in self.needs)
+
+    @classmethod
+    def from_schedule(cls, schedule, services=None, **kwargs):
+        """Builds the problem of filling a schedule with its teacher's services.
+
+        Time already booked on the schedule counts towards each service and blocks
+        the teacher and the student at that time. Takes two queries, and two more
+        for the occupancy of the resources the services use, if any.
+        """
+        from app.occupancy import OccupancyMap     # which builds on this module
+
+        if services is None:
+            services = Service.objects.filter(student__teacher=schedule.teacher)
+        placed = {}
+        bookings = []
+        serviceinstances = (ServiceInstance.objects
+                            .filter(scheduled_for=schedule)
+                            .exclude(time_start=None).exclude(time_end=None)
+                            .with_minutes()
+                            .values_list('service_id', 'service__student_id', 'day', 'start_minute', 'end_minute', 'minutes'))
+        for service_id, student_id, day, start, end, minutes in serviceinstances:
+            if day in DAYS:
+                bookings.append(Booking(student_id, DAYS.index(day), start, end))
+            placed[service_id] = placed.get(service_id, 0) + minutes
+        needs = []
+        resources = {}
+        for service in services.only('id', 'student_id', 'service_type', 'total_time_req', 'resource_id'):
+            needs.append(Need(service.id, service.student_id, service.service_type,
+                              service.total_time_req - placed.get(service.id, 0)))
+            if service.resource_id is not None:
+                resources[service.id] = service.resource_id
+        if resources:
+            kwargs['occupancy'] = OccupancyMap.load(resources.values(), schedule=schedule,
+                                                    granularity=kwargs.get('granularity', GRANULARITY))
+        return cls(needs, bookings=bookings, resources=resources, **kwargs)
+
+
+class Solution:
+    """The best plan a search found"""
+
+    def __init__(self, problem, placements, optimal, nodes, elapsed):
+        self.problem = problem
+        self.placements = placements
+        self.optimal = optimal      # True if no better plan exists
+        self.nodes = nodes
+        self.elapsed = elapsed
+
+    @property
+    def placed_minutes(self):
+        return sum(placement.end - placement.start for placement in self.placements)
+
+    @property
+    def unmet(self):
+        """Returns a dict mapping service id to the minutes still not placed"""
+        placed = {}
+        for placement in self.placements:
+            placed[placement.service_id] = placed.get(placement.service_id, 0) + placement.end - placement.start
+        return {need.service_id: need.minutes - placed.get(need.service_id, 0)
+                for need in self.problem.needs
+                if need.minutes > placed.get(need.service_id, 0)}
+
+    def __str__(self):
+        return '{placed} of {needed} minutes placed in {count} appointments ({state}, {nodes} nodes, {elapsed:.2f}s)'.format(
+            placed=self.placed_minutes, needed=self.problem.needed_minutes, count=len(self.placements),
+            state='optimal' if self.optimal else 'best found', nodes=self.nodes, elapsed=self.elapsed)
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+class Solver:
+    """Depth-first branch and bound search over session placements"""
+
+    def __init__(self, problem, time_budget=TIME_BUDGET, seed=None, target=None, incumbent=None):
+        self.problem = problem
+        self.time_budget = time_budget
+        self.random = random.Random(seed)
+        self.seed = seed
+        # Stop as soon as a plan placing this many minutes is found
+        self.target = problem.needed_minutes if target is None else target
+        # Best score shared with searches running in other processes, if any
+        self.incumbent = incumbent
+
+    def solve(self):
+        problem = self.problem
+        self.started = time.monotonic()
+        self.deadline = self.started + self.time_budget
+        self.nodes = 0
+        self.best_score = -1
+        self.bound_score = -1   # the best score known anywhere, which branches must beat
+        self.best = []
+        self.exhausted = False
+
+        # Search state, updated in place as sessions are placed and undone
+        self.teacher = list(problem.teacher_busy)
+        self.students = {need.student_id: list(problem.student_busy.get(need.student_id, [0] * len(DAYS)))
+                         for need in problem.needs}
+        self.occupancy = problem.occupancy.copy() if problem.occupancy is not None else None
+        self.next_session = [0] * len(problem.needs)
+        self.used_days = [0] * len(problem.needs)   # bitmask of days each service already has a session on
+        self.placements = []
+        # Random tie-breaks, so differently seeded searches explore differently
+        if self.seed is None:
+            self.noise = [[0] * len(DAYS) for need in problem.needs]
+        else:
+            self.noise = [[self.random.random() * 4 for day in DAYS] for need in problem.needs]
+        # Each level of the search places or leaves out one session
+        depth = sum(len(sessions) for sessions in problem.sessions) + 100
+        if sys.getrecursionlimit() < depth:
+            sys.setrecursionlimit(depth)
+
+        try:
+            discrepancies = 0
+            while True:
+                self.complete = True
+                self.search(0, discrepancies)
+                if self.best_score >= self.target:
+                    # Branches were left unsearched once the target was reached
+                    break
+                if self.complete:
+                    # No branch was cut by the discrepancy limit, so the whole tree was searched
+                    self.exhausted = True
+                    break
+                discrepancies += 1
+        except _OutOfTime:
+            pass
+        if self.incumbent is not None and self.exhausted:
+            # Nothing beats the best score known anywhere, so the other searches can stop
+            self.incumbent.stop.set()
+
+        return Solution(problem, self.best, self.exhausted or self.best_score >= problem.needed_minutes,
+                        self.nodes, time.monotonic() - self.started)
+
+    def get_values(self, index):
+        """Returns every (day, start slot) the next session of need index fits at"""
+        problem = self.problem
+        need = problem.needs[index]
+        length = problem.sessions[index][self.next_session[index]]
+        student = self.students[need.student_id]
+        resource_id = problem.resource_ids[index]
+        # Spread sessions of a service over different days while there are days to spare
+        spread = len(problem.sessions[index]) <= len(DAYS)
+        values = []
+        for day in range(len(DAYS)):
+            if spread and self.used_days[index] >> day & 1:
+                continue
+            free = problem.available[day] & ~self.teacher[day] & ~student[day]
+            if resource_id is not None and self.occupancy is not None:
+                free &= ~self.occupancy.full_mask(resource_id, day)
+            starts = fit_mask(free, length)
+            for start in iter_bits(starts):
+                values.append((day, start))
+        return values
+
+    def order_values(self, index, values):
+        """Sorts places best first: least loaded day, then snug against booked time, then earliest"""
+        length = self.problem.sessions[index][self.next_session[index]]
+        teacher = self.teacher
+        loads = [count_bits(mask) for mask in teacher]
+        noise = self.noise[index]
+
+        def key(value):
+            day, start = value
+            busy = teacher[day]
+            snug = (start == 0 or busy >> (start - 1) & 1) + (busy >> (start + length) & 1)
+            return (loads[day] + noise[day], -snug, start)
+        values.sort(key=key)
+        return values
+
+    def search(self, score, discrepancies):
+        self.nodes += 1
+        if self.nodes & 63 == 0:
+            if time.monotonic() > self.deadline:
+                raise _OutOfTime()
+            if self.incumbent is not None:
+                if self.incumbent.stop.is_set():
+                    raise _OutOfTime()
+                self.bound_score = max(self.bound_score, self.incumbent.score.value)
+        problem = self.problem
+        granularity = problem.granularity
+
+        if score > self.best_score:
+            self.best_score = score
+            self.bound_score = max(self.bound_score, score)
+            self.best = list(self.placements)
+            if self.incumbent is not None:
+                self.incumbent.offer(score, self.target)
+            if score >= self.target:
+                return
+
+        # Pick the service whose next session has the fewest places left, and
+        # bound what can still be placed from here
+        chosen = None
+        chosen_values = None
+        reachable = 0
+        for index in range(len(problem.needs)):
+            sessions = problem.sessions[index]
+            if self.next_session[index] >= len(sessions):
+                continue
+            values = self.get_values(index)
+            if not values:
+                continue
+            days = len({day for day, start in values})
+            remaining = sessions[self.next_session[index]:]
+            if len(sessions) <= len(DAYS):
+                remaining = remaining[:days]
+            reachable += sum(remaining)
+            if chosen is None or (len(values), -remaining[0]) < (len(chosen_values), -problem.sessions[chosen][self.next_session[chosen]]):
+                chosen = index
+                chosen_values = values
+
+        if chosen is None:
+            return
+        free = sum(count_bits(problem.available[day] & ~self.teacher[day]) for day in range(len(DAYS)))
+        if score + min(reachable, free) * granularity <= self.bound_score:
+            return
+
+        need = problem.needs[chosen]
+        length = problem.sessions[chosen][self.next_session[chosen]]
+        student = self.students[need.student_id]
+        resource_id = problem.resource_ids[chosen] if self.occupancy is not None else None
+        self.order_values(chosen, chosen_values)
+
+        # Try each place for the session, best first, then leaving it out
+        for rank, (day, start) in enumerate(chosen_values):
+            if rank > discrepancies:
+                self.complete = False
+                return
+            mask = ((1 << length) - 1) << start
+            self.teacher[day] |= mask
+            student[day] |= mask
+            self.used_days[chosen] |= 1 << day
+            self.next_session[chosen] += 1
+            placement = Placement(need.service_id, day, start * granularity, (start + length) * granularity)
+            self.placements.append(placement)
+            if resource_id is not None:
+                self.occupancy.add(resource_id, day, placement.start, placement.end)
+
+            self.search(score + length * granularity, discrepancies - rank)
+
+            if resource_id is not None:
+                self.occupancy.remove(resource_id, day, placement.start, placement.end)
+            self.placements.pop()
+            self.next_session[chosen] -= 1
+            self.used_days[chosen] &= ~(1 << day)
+            student[day] &= ~mask
+            self.teacher[day] &= ~mask
+            if self.best_score >= self.target:
+                return
+
+        if len(chosen_values) > discrepancies:
+            self.complete = False
+            return
+        self.next_session[chosen] += 1
+        self.search(score, discrepancies - len(chosen_values))
+        self.next_session[chosen] -= 1
+
+
+def solve(problem, time_budget=TIME_BUDGET, seed=None):
+    """Returns the best Solution found for problem within time_budget seconds"""
+    return Solver(problem, time_budget=time_budget, seed=seed).solve()
+
+
+class SharedIncumbent:
+    """The best score found so far and a stop flag, shared by searches in several processes"""
+
+    def __init__(self, manager):
+        self.score = manager.Value('i', -1)
+        self.lock = manager.Lock()
+        self.stop = manager.Event()
+
+    def offer(self, score, target):
+        with self.lock:
+            if score > self.score.value:
+                self.score.value = score
+        if score >= target:
+            self.stop.set()
+
+def _solve_worker(problem, deadline, seed, target, incumbent):
+    time_budget = max(deadline - time.time(), 0)
+    return Solver(problem, time_budget=time_budget, seed=seed, target=target, incumbent=incumbent).solve()
+
+def solve_parallel(problem, time_budget=TIME_BUDGET, workers=None, starts=None, good_enough=1.0):
+    """Returns the best Solution of several differently seeded searches run in a process pool.
+
+    The searches share the best score found so far to prune with, and all stop
+    once one of them places good_enough (a fraction) of the needed minutes or
+    proves its plan optimal. Should not be called while handling a request; see
+    start_generation.
+    """
+    workers = workers or getattr(settings, 'SCHEDULE_SOLVER_WORKERS', None) or os.cpu_count() or 1
+    starts = starts or workers
+    target = math.ceil(problem.needed_minutes * good_enough)
+    started = time.monotonic()
+    # Searches queued behind others only get what is left of the budget
+    deadline = time.time() + time_budget
+    # The first search is unseeded, so a parallel solve is never worse than solve()
+    seeds = [None] + list(range(1, starts))
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+        incumbent = SharedIncumbent(manager)
+        futures = [executor.submit(_solve_worker, problem, deadline, seed, target, incumbent)
+                   for seed in seeds]
+        solutions = [future.result() for future in futures]
+    best = max(solutions, key=lambda solution: (solution.placed_minutes, solution.optimal))
+    best.optimal = any(solution.optimal for solution in solutions)
+    best.nodes = sum(solution.nodes for solution in solutions)
+    best.elapsed = time.monotonic() - started
+    return best
+
+def get_generation_key(schedule_id):
+    return f'schedule-generation-{schedule_id}'
+
+def get_generation_status(schedule_id):
+    """Returns the status of the last generation started for a schedule, or None"""
+    status = get_cache().get(get_generation_key(schedule_id))
+    if status is not None and status['state'] == 'running' and time.time() > status['deadline']:
+        # The process running it stopped before it finished
+        return {'state': 'failed'}
+    return status
+
+def start_generation(schedule, problem, time_budget=TIME_BUDGET, workers=None):
+    """Solves problem in the background and saves the appointments on schedule.
+
+    Returns straight away; the search runs on a background thread in a process
+    pool so the request thread is free. Progress can be followed with
+    get_generation_status, from any worker process.
+    """
+    status = {'state': 'running', 'deadline': time.time() + time_budget + STALE_AFTER}
+    get_cache().set(get_generation_key(schedule.pk), status, STATUS_TIMEOUT)
+    _background.submit(_generate, schedule.pk, problem, time_budget, workers)
+
+def _generate(schedule_id, problem, time_budget, workers):
+    try:
+        try:
+            solution = solve_parallel(problem, time_budget=time_budget, workers=workers)
+            save_solution(Schedule.objects.get(pk=schedule_id), solution)
+            logger.info('Generated schedule %s: %s', schedule_id, solution)
+            status = {
+                'state': 'done',
+                'placed_minutes': solution.placed_minutes,
+                'needed_minutes': problem.needed_minutes,
+                'appointments': len(solution.placements),
+                'unmet': list(solution.unmet),
+            }
+        except Exception:
+            logger.exception('Generating schedule %s failed', schedule_id)
+            status = {'state': 'failed'}
+        # Before the connection is closed, as the cache may be kept in the database
+        get_cache().set(get_generation_key(schedule_id), status, STATUS_TIMEOUT)
+    finally:
+        connection.close()  # threads don't get their connection closed at the end of a request
+
+def save_solution(schedule, solution):
+    """Creates the appointments of a solution on schedule, all at once"""
+    serviceinstances = [
+        ServiceInstance(service_id=placement.service_id, day=DAYS[placement.day],
+                        time_start=to_time(placement.start), time_end=to_time(placement.end),
+                        scheduled_for=schedule, resource_id=solution.problem.resources.get(placement.service_id))
+        for placement in solution.placements
+    ]
+    with transaction.atomic():
+        serviceinstances = ServiceInstance.objects.bulk_create(serviceinstances)
+        # bulk_create doesn't send signals, so the services' minutes are refreshed here
+        refresh_services({placement.service_id for placement in solution.placements})
+    # and the cached page is invalidated, and reloaded where it is open
+    invalidate_schedule(schedule.pk)
+    invalidate_teacher(schedule.teacher_id)
+    publish_reload(schedule.pk)
+    return serviceinstances
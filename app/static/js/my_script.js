@@ -3,12 +3,140 @@ window.onload = function() {
     var confirm_dialog = document.getElementById("confirm_delete");
 
     // "Delete student" button opens up the <dialog> modal
-    delete_button.addEventListener('click', function onOpen() {
-        if (typeof confirm_dialog.showModal == "function") {
-            confirm_dialog.showModal();
+    if (delete_button) {
+        delete_button.addEventListener('click', function onOpen() {
+            if (typeof confirm_dialog.showModal == "function") {
+                confirm_dialog.showModal();
+            }
+            else {
+                alert("The dialog API is not supported by this browser");
+            }
+        })
+    }
+
+    // Selects marked by AutocompleteSelect (app/autocomplete.py) are searched as you type
+    var autocomplete_selects = document.querySelectorAll("select[data-autocomplete-url]");
+    for (var index = 0; index < autocomplete_selects.length; index++) {
+        autocomplete(autocomplete_selects[index]);
+    }
+
+    // The schedule page keeps its grid up to date as appointments change
+    var schedule_grid = document.getElementById("schedule-grid");
+    if (schedule_grid && typeof EventSource == "function") {
+        followSchedule(schedule_grid);
+    }
+}
+
+// Puts a search box in front of the select and fills the select with what it finds
+function autocomplete(select) {
+    var search = document.createElement("input");
+    search.type = "search";
+    search.placeholder = "Type to search";
+    select.parentNode.insertBefore(search, select);
+    var timer = null;
+    var latest = 0;
+
+    function load() {
+        var request = ++latest;
+        fetch(select.dataset.autocompleteUrl + "?q=" + encodeURIComponent(search.value), {credentials: "same-origin"})
+            .then(function(response) {
+                return response.json();
+            })
+            .then(function(data) {
+                if (request != latest) {
+                    return;     // the answer to an older search
+                }
+                // Keep the empty choice and the chosen one, replace the others
+                for (var index = select.options.length - 1; index >= 0; index--) {
+                    if (select.options[index].value && !select.options[index].selected) {
+                        select.remove(index);
+                    }
+                }
+                data.results.forEach(function(result) {
+                    if (select.value != result.id) {
+                        select.add(new Option(result.text, result.id));
+                    }
+                });
+            });
+    }
+
+    search.addEventListener("input", function() {
+        clearTimeout(timer);
+        timer = setTimeout(load, 200);
+    });
+    // Offer the first few straight away
+    select.addEventListener("focus", function() {
+        if (!search.value && select.options.length <= 2) {
+            load();
+        }
+    });
+}
+
+// Patches the grid with the events of app/schedule_events.py, streamed by RSPscheduler/asgi.py
+function followSchedule(schedule_grid) {
+    var table = document.getElementById("schedule-table2");
+    var day_start = parseInt(table.dataset.dayStart);
+    var slot_minutes = parseInt(table.dataset.slotMinutes);
+    var source = new EventSource(schedule_grid.dataset.eventsUrl);
+
+    function pad(number) {
+        return (number < 10 ? "0" : "") + number;
+    }
+
+    function removeAppointment(id) {
+        var item = table.querySelector('li[data-serviceinstance="' + id + '"]');
+        if (item) {
+            item.parentNode.removeChild(item);
         }
-        else {
-            alert("The dialog API is not supported by this browser");
+    }
+
+    // Same as {{serviceinstance|linebreaks}}: one paragraph, a line break between lines
+    function makeAppointment(appointment) {
+        var item = document.createElement("li");
+        item.dataset.serviceinstance = appointment.id;
+        item.dataset.start = pad(Math.floor(appointment.start / 60)) + ":" + pad(appointment.start % 60);
+        var link = document.createElement("a");
+        link.className = "schedule-services";
+        link.href = appointment.url;
+        var paragraph = document.createElement("p");
+        appointment.label.split("\n").forEach(function(line, index) {
+            if (index > 0) {
+                paragraph.appendChild(document.createElement("br"));
+            }
+            paragraph.appendChild(document.createTextNode(line));
+        });
+        link.appendChild(paragraph);
+        item.appendChild(link);
+        return item;
+    }
+
+    source.addEventListener("saved", function(message) {
+        var appointment = JSON.parse(message.data);
+        removeAppointment(appointment.id);
+        // The same day and time slot as ScheduleGrid.get_slot, appointments off the grid aren't shown
+        var slot = Math.floor((appointment.start - day_start) / slot_minutes);
+        var cell = table.querySelector('tr[data-day="' + appointment.day + '"] td[data-slot="' + slot + '"] ul');
+        if (!cell || appointment.start < day_start) {
+            return;
         }
-    })
-}
\ No newline at end of file
+        var item = makeAppointment(appointment);
+        var next = null;
+        for (var index = 0; index < cell.children.length; index++) {
+            if (cell.children[index].dataset.start > item.dataset.start) {
+                next = cell.children[index];
+                break;
+            }
+        }
+        cell.insertBefore(item, next);
+    });
+
+    source.addEventListener("deleted", function(message) {
+        removeAppointment(JSON.parse(message.data).id);
+    });
+
+    // Sent after changes too big to patch in, or when the page has missed some
+    source.addEventListener("reload", function() {
+        source.close();
+        window.location.reload();
+    });
+}
@@ -1,3 +1,490 @@
-from django.test import TestCase
+import io
+import random
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from app import benchmarks, compliance, counters, what_if
+from app.allocation import reconcile
+from app.checks import check_schedule_cache
+from app.cloning import CloneError, clone_schedule
+from app.conflicts import find_conflict, get_conflicts
+from app.fragment_cache import get_cache, invalidate_teacher
+from app.grid import DAYS
+from app.models import ComplianceSummary, Schedule, Service, ServiceInstance, Student, to_minutes, to_time
+from app.repair import Changes, plan_repair, repair_schedule
+from app.roster_import import RosterImporter, read_rows
+from app.solver import Block, Booking, Need, Problem, Solver, solve
 
 # Create your tests here.
+
+@override_settings(**benchmarks.SETTINGS)
+class BenchmarkTests(TestCase):
+    """Runs the page benchmarks at small scales, failing on any query budget exceeded or N+1"""
+
+    def tearDown(self):
+        # The home page counts visits, which would otherwise be written when the
+        # process exits, after the test database is gone, to the real one
+        counters.buffer.take()
+
+    def test_every_url_is_benchmarked(self):
+        # Raises LookupError for a URL that takes arguments the benchmark doesn't know
+        cases = benchmarks.get_cases(benchmarks.Dataset(2))
+        self.assertTrue(cases)
+
+    def test_query_budgets(self):
+        results = benchmarks.run(scales=(5, 25))
+        self.assertEqual(benchmarks.check(results), [])
+
+
+def add_appointment(service, schedule, day, start, end):
+    """Books service on schedule, with start and end in minutes since midnight"""
+    return ServiceInstance.objects.create(service=service, scheduled_for=schedule, day=day,
+                                          time_start=to_time(start), time_end=to_time(end))
+
+
+class WhatIfTests(TestCase):
+    """Previews of moves keep the same totals as the schedule would have if they were saved"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+        self.schedule = Schedule.objects.create(title='Week', teacher=self.teacher)
+        students = [Student.objects.create(first_name=f'First{i}', last_name=f'Last{i}', teacher=self.teacher)
+                    for i in range(4)]
+        self.services = [Service.objects.create(student=student, subject=subject, service_type=service_type,
+                                                total_time_req=60, satisfied=False)
+                         for student in students for subject, service_type in (('MATH', 'Pull-Out'), ('ELA', 'Push-In'))]
+        generator = random.Random(1)
+        for i in range(30):
+            start = generator.randrange(8 * 60, 14 * 60, 15)
+            add_appointment(generator.choice(self.services), self.schedule, generator.choice(DAYS), start, start + 30)
+
+    def get_totals(self, snapshot):
+        """Returns the totals of a snapshot loaded afresh from where its appointments are now"""
+        rows = [(appointment.pk,
+                 snapshot.service_ids[appointment.service] if appointment.service >= 0 else None,
+                 appointment.student_id, 'Pull-Out' if appointment.pull_out else 'Push-In',
+                 snapshot.required[appointment.service], DAYS[appointment.day], appointment.start, appointment.end)
+                for appointment in snapshot.appointments.values()]
+        return what_if.ScheduleSnapshot(snapshot.schedule_id, snapshot.teacher_id, rows).get_totals()
+
+    def test_conflicts_match_the_database(self):
+        snapshot = what_if.get_snapshot(self.schedule.pk)
+        conflicts = get_conflicts(self.schedule)
+        self.assertEqual(snapshot.conflicts, len(conflicts))
+        self.assertEqual(snapshot.student_conflicts, sum(conflict.kind == 'student' for conflict in conflicts))
+
+    def test_moves_and_rollback(self):
+        snapshot = what_if.get_snapshot(self.schedule.pk)
+        before = snapshot.get_totals()
+        generator = random.Random(2)
+        pks = sorted(snapshot.appointments)
+        for i in range(200):
+            start = generator.randrange(8 * 60, 14 * 60, 5)
+            snapshot.move(generator.choice(pks), generator.randrange(len(DAYS)), start, start + generator.choice((0, 15, 30, 45)))
+            self.assertEqual(snapshot.get_totals(), self.get_totals(snapshot))
+        snapshot.rollback()
+        self.assertEqual(snapshot.get_totals(), before)
+
+    def test_preview_leaves_the_snapshot_as_it_was(self):
+        snapshot = what_if.get_snapshot(self.schedule.pk)
+        before = snapshot.get_totals()
+        first, second = sorted(snapshot.appointments)[:2]
+        moves = [(first, 4, 7 * 60, None), (second, 4, 7 * 60 + 15, 8 * 60)]
+        for move in moves:
+            snapshot.move(*move)
+        after = self.get_totals(snapshot)
+        snapshot.rollback()
+
+        preview = snapshot.preview(moves)
+        self.assertEqual(preview['before'], before)
+        self.assertEqual(preview['after'], after)
+        # Both were moved before every other appointment, so they only overlap each other
+        self.assertEqual([(conflict['appointment'], conflict['with']) for conflict in preview['conflicts']], [(first, second)])
+        self.assertEqual(snapshot.get_totals(), before)
+        with self.assertRaises(ValueError):
+            snapshot.preview([(first, 0, 9 * 60, 8 * 60)])
+        self.assertEqual(snapshot.get_totals(), before)
+
+    def test_changes_load_the_snapshot_again(self):
+        snapshot = what_if.get_snapshot(self.schedule.pk)
+        # The version counters of the schedule and its teacher, in the "schedules" cache
+        with self.assertNumQueries(2):
+            self.assertIs(what_if.get_snapshot(self.schedule.pk), snapshot)
+
+        # update() doesn't send signals, so code changing rows in bulk bumps the versions itself
+        Service.objects.filter(pk=self.services[0].pk).update(total_time_req=90, updated_at=timezone.now())
+        self.assertIs(what_if.get_snapshot(self.schedule.pk), snapshot)
+        invalidate_teacher(self.teacher.pk)
+        changed = what_if.get_snapshot(self.schedule.pk)
+        self.assertIsNot(changed, snapshot)
+        ServiceInstance.objects.filter(pk=min(changed.appointments)).delete()
+        self.assertIsNot(what_if.get_snapshot(self.schedule.pk), changed)
+        self.assertIsNone(what_if.get_snapshot(0))
+
+
+class SolverTests(TestCase):
+    """The solver places sessions without overlaps, and only calls a plan optimal when it is"""
+
+    def assertNoOverlaps(self, solution, bookings=()):
+        days = {}
+        for placement in solution.placements:
+            days.setdefault(placement.day, []).append((placement.start, placement.end))
+        for booking in bookings:
+            days.setdefault(booking.day, []).append((booking.start, booking.end))
+        for spans in days.values():
+            spans.sort()
+            for (start, end), (next_start, next_end) in zip(spans, spans[1:]):
+                self.assertLessEqual(end, next_start)
+
+    def test_every_minute_placed(self):
+        needs = [Need(service_id, service_id // 2, 'Pull-Out', 90) for service_id in range(8)]
+        bookings = [Booking(0, 0, 9 * 60, 10 * 60)]
+        solution = solve(Problem(needs, blocked=[Block(None, 12 * 60, 13 * 60)], bookings=bookings), time_budget=5)
+        self.assertTrue(solution.optimal)
+        self.assertEqual(solution.placed_minutes, 8 * 90)
+        self.assertEqual(solution.unmet, {})
+        self.assertNoOverlaps(solution, bookings)
+        for placement in solution.placements:
+            self.assertFalse(placement.start < 13 * 60 and placement.end > 12 * 60)
+
+    def test_whole_tree_searched(self):
+        # Only an hour on Monday for two hours of sessions
+        availability = [[(8 * 60, 9 * 60)]] + [[] for day in DAYS[1:]]
+        needs = [Need(1, 1, 'Pull-Out', 60), Need(2, 2, 'Pull-Out', 60)]
+        solution = solve(Problem(needs, availability=availability), time_budget=5)
+        self.assertTrue(solution.optimal)
+        self.assertEqual(solution.placed_minutes, 60)
+        self.assertNoOverlaps(solution)
+
+    def test_stopped_at_target_is_not_optimal(self):
+        availability = [[(8 * 60, 9 * 60)]] + [[] for day in DAYS[1:]]
+        problem = Problem([Need(1, 1, 'Pull-Out', 60), Need(2, 2, 'Pull-Out', 60)], availability=availability)
+        solution = Solver(problem, time_budget=5, target=30).solve()
+        self.assertGreaterEqual(solution.placed_minutes, 30)
+        self.assertFalse(solution.optimal)
+
+
+class ConflictTests(TestCase):
+    """Overlapping appointments are found, and those only touching end to end are not"""
+
+    def setUp(self):
+        teacher = User.objects.create_user('teacher', password='password')
+        self.schedule = Schedule.objects.create(title='Week', teacher=teacher)
+        student = Student.objects.create(first_name='First', last_name='Last', teacher=teacher)
+        self.pull_out = Service.objects.create(student=student, subject='MATH', service_type='Pull-Out',
+                                               total_time_req=60, satisfied=False)
+        self.other = Service.objects.create(student=student, subject='ELA', service_type='Pull-Out',
+                                            total_time_req=60, satisfied=False)
+        self.push_in = Service.objects.create(student=student, subject='SCIENCE', service_type='Push-In',
+                                              total_time_req=60, satisfied=False)
+        self.first = add_appointment(self.pull_out, self.schedule, 'Monday', 9 * 60, 10 * 60)
+
+    def test_find_conflict(self):
+        self.assertEqual(find_conflict(self.schedule, 'Monday', to_time(9 * 60 + 30), to_time(10 * 60 + 30)), self.first)
+        self.assertIsNone(find_conflict(self.schedule, 'Monday', to_time(10 * 60), to_time(11 * 60)))
+        self.assertIsNone(find_conflict(self.schedule, 'Tuesday', to_time(9 * 60), to_time(10 * 60)))
+        self.assertIsNone(find_conflict(self.schedule, 'Monday', to_time(9 * 60), to_time(10 * 60), exclude=self.first.pk))
+
+    def test_get_conflicts(self):
+        second = add_appointment(self.other, self.schedule, 'Monday', 9 * 60 + 45, 10 * 60 + 15)
+        third = add_appointment(self.push_in, self.schedule, 'Monday', 9 * 60 + 30, 9 * 60 + 50)
+        add_appointment(self.push_in, self.schedule, 'Monday', 10 * 60 + 15, 11 * 60)
+        add_appointment(self.pull_out, self.schedule, 'Tuesday', 9 * 60, 10 * 60)
+        found = {(conflict.kind, frozenset((conflict.first.pk, conflict.second.pk)))
+                 for conflict in get_conflicts(self.schedule)}
+        self.assertEqual(found, {('student', frozenset((self.first.pk, second.pk))),
+                                 ('teacher', frozenset((self.first.pk, third.pk))),
+                                 ('teacher', frozenset((second.pk, third.pk)))})
+
+
+class AllocationTests(TestCase):
+    """Allocated minutes and serviced follow the appointments on each teacher's active schedule"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+        self.schedule = Schedule.objects.create(title='Week', teacher=self.teacher, active=True)
+        self.student = Student.objects.create(first_name='First', last_name='Last', teacher=self.teacher)
+        self.service = Service.objects.create(student=self.student, subject='MATH', service_type='Pull-Out',
+                                              total_time_req=30, satisfied=False)
+
+    def assertAllocated(self, minutes, serviced):
+        self.assertEqual(Service.objects.get(pk=self.service.pk).allocated_minutes, minutes)
+        self.assertEqual(Student.objects.get(pk=self.student.pk).serviced, serviced)
+        self.assertEqual(reconcile(repair=False), ([], []))
+
+    def test_appointments(self):
+        self.assertAllocated(0, False)
+        appointment = add_appointment(self.service, self.schedule, 'Friday', 9 * 60, 9 * 60 + 30)
+        self.assertAllocated(30, True)
+        appointment.time_end = to_time(9 * 60 + 15)
+        appointment.save()
+        self.assertAllocated(15, False)
+        self.service.total_time_req = 15
+        self.service.save()
+        self.assertAllocated(15, True)
+        appointment.delete()
+        self.assertAllocated(0, False)
+
+    def test_active_schedule_only(self):
+        add_appointment(self.service, self.schedule, 'Friday', 9 * 60, 9 * 60 + 30)
+        Schedule.objects.create(title='Next week', teacher=self.teacher, active=True)
+        self.assertAllocated(0, False)
+        self.schedule.refresh_from_db()
+        self.schedule.activate()
+        self.assertAllocated(30, True)
+
+    def test_reconcile_repairs(self):
+        add_appointment(self.service, self.schedule, 'Friday', 9 * 60, 9 * 60 + 30)
+        Service.objects.filter(pk=self.service.pk).update(allocated_minutes=0)
+        self.assertTrue(reconcile(repair=False)[0])
+        reconcile()
+        self.assertAllocated(30, True)
+
+
+class RosterImportTests(TestCase):
+    """Imports create each student and service once, update minutes, and skip bad rows"""
+
+    CSV = ('first_name,middle_name,last_name,subject,service_type,total_time_req\n'
+           'Ann,,Lee,Math,Pull-Out,60\n'
+           'Ann,,Lee,ELA,push-in,30\n'
+           'Bob,,Ray,Math,Pull-Out,45\n'
+           'Bad,,,Math,Pull-Out,30\n'
+           'Bob,,Ray,Math,Pull-Out,abc\n')
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+
+    def run_import(self, data, format='csv', **kwargs):
+        return RosterImporter(teacher=self.teacher, **kwargs).run(read_rows(io.StringIO(data), format))
+
+    def test_csv(self):
+        report = self.run_import(self.CSV, batch_size=2)
+        self.assertEqual((report.rows, report.students_created, report.services_created, report.error_count), (5, 2, 3, 2))
+        self.assertEqual([line_number for line_number, message in report.errors], [5, 6])
+        self.assertEqual(Service.objects.get(student__first_name='Ann', subject='ELA').service_type, 'Push-In')
+        self.assertEqual(ComplianceSummary.objects.filter(teacher=self.teacher).count(), 2)
+
+        report = self.run_import(self.CSV)
+        self.assertEqual((report.students_created, report.services_created, report.services_updated), (0, 0, 0))
+        report = self.run_import(self.CSV.replace('Pull-Out,45', 'Pull-Out,90'))
+        self.assertEqual(report.services_updated, 1)
+        self.assertEqual(Service.objects.get(student__first_name='Bob').total_time_req, 90)
+
+    def test_jsonl(self):
+        data = ('{"teacher": "teacher", "first_name": "Ann", "last_name": "Lee", "subject": "ELA", '
+                '"service_type": "Pull-Out", "total_time_req": 45}\n[1]\n{bad\n'
+                '{"teacher": "nobody", "first_name": "Bob", "last_name": "Ray", "subject": "ELA", '
+                '"service_type": "Pull-Out", "total_time_req": 45}\n')
+        report = RosterImporter().run(read_rows(io.StringIO(data), 'jsonl'))
+        self.assertEqual((report.services_created, report.error_count), (1, 3))
+        self.assertEqual(Student.objects.get().teacher, self.teacher)
+
+
+class CloningTests(TestCase):
+    """Clones copy a schedule's appointments, leaving out departed students and remapping services"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+        self.schedule = Schedule.objects.create(title='Week', teacher=self.teacher, active=True,
+                                                day_start=to_time(9 * 60), blocked_periods='Every day 12:00-12:30')
+        self.services = []
+        for i in range(3):
+            student = Student.objects.create(first_name=f'First{i}', last_name=f'Last{i}', teacher=self.teacher)
+            service = Service.objects.create(student=student, subject='MATH', service_type='Pull-Out',
+                                             total_time_req=60, satisfied=False)
+            add_appointment(service, self.schedule, 'Monday', (9 + i) * 60, (9 + i) * 60 + 30)
+            add_appointment(service, self.schedule, 'Tuesday', (9 + i) * 60, (9 + i) * 60 + 30)
+            self.services.append(service)
+
+    def get_appointments(self, schedule):
+        return sorted(ServiceInstance.objects.filter(scheduled_for=schedule)
+                      .values_list('service_id', 'day', 'time_start', 'time_end'))
+
+    def test_clone(self):
+        report = clone_schedule(self.schedule, 'Next week')
+        self.assertEqual((report.copied, report.skipped_departed), (6, 0))
+        self.assertEqual(self.get_appointments(report.schedule), self.get_appointments(self.schedule))
+        self.assertFalse(report.schedule.active)
+        self.assertEqual((report.schedule.day_start, report.schedule.blocked_periods),
+                         (self.schedule.day_start, self.schedule.blocked_periods))
+
+    def test_departed_and_remapped(self):
+        student = self.services[0].student
+        student.teacher = User.objects.create_user('other', password='password')
+        student.save()
+        report = clone_schedule(self.schedule, 'Next week', service_map={self.services[1].pk: self.services[2].pk},
+                                activate=True)
+        self.assertEqual((report.copied, report.remapped, report.skipped_departed), (4, 2, 2))
+        self.assertEqual({service_id for service_id, day, start, end in self.get_appointments(report.schedule)},
+                         {self.services[2].pk})
+        self.assertTrue(Schedule.objects.get(pk=report.schedule.pk).active)
+        self.assertFalse(Schedule.objects.get(pk=self.schedule.pk).active)
+        self.assertEqual(reconcile(repair=False), ([], []))
+        with self.assertRaises(CloneError):
+            clone_schedule(self.schedule, 'Broken', service_map={self.services[1].pk: 0})
+
+
+class ActiveScheduleTests(TestCase):
+    """The partial unique index of migration 0006 survives later migrations and keeps one active schedule per teacher"""
+
+    def test_index_after_migrating(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Schedule._meta.db_table)
+        self.assertIn('schedule_one_active_per_teacher', constraints)
+
+        teacher = User.objects.create_user('teacher', password='password')
+        Schedule.objects.create(title='Week', teacher=teacher, active=True)
+        other = Schedule.objects.create(title='Next week', teacher=teacher)
+        # update() gets past Schedule.save, which deactivates the others
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Schedule.objects.filter(pk=other.pk).update(active=True)
+
+class RepairTests(TestCase):
+    """Repairs change only the affected services' appointments, within the schedule's constraints"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+        self.schedule = Schedule.objects.create(title='Week', teacher=self.teacher, active=True,
+                                                day_start=to_time(9 * 60), day_end=to_time(12 * 60),
+                                                blocked_periods='Every day 10:00-10:30')
+        self.services = []
+        for i in range(4):
+            student = Student.objects.create(first_name=f'First{i}', last_name=f'Last{i}', teacher=self.teacher)
+            service = Service.objects.create(student=student, subject='MATH', service_type='Pull-Out',
+                                             total_time_req=60, satisfied=False)
+            add_appointment(service, self.schedule, DAYS[i], 9 * 60, 9 * 60 + 30)
+            add_appointment(service, self.schedule, DAYS[i], 11 * 60, 11 * 60 + 30)
+            self.services.append(service)
+
+    def get_appointments(self):
+        return {serviceinstance.pk: (serviceinstance.service_id, serviceinstance.day,
+                                     to_minutes(serviceinstance.time_start), to_minutes(serviceinstance.time_end))
+                for serviceinstance in ServiceInstance.objects.filter(scheduled_for=self.schedule)}
+
+    def assertWithinConstraints(self, appointments):
+        for service_id, day, start, end in appointments.values():
+            self.assertTrue(9 * 60 <= start and end <= 12 * 60)
+            self.assertFalse(start < 10 * 60 + 30 and end > 10 * 60)
+
+    def test_grown_service(self):
+        before = self.get_appointments()
+        service = self.services[0]
+        service.total_time_req = 120
+        service.save()
+        diff = repair_schedule(self.schedule, Changes([service.pk]))
+        self.assertEqual((len(diff.moved), diff.deleted), (0, []))
+        after = self.get_appointments()
+        self.assertTrue(all(after[pk] == appointment for pk, appointment in before.items()))
+        self.assertEqual(Service.objects.get(pk=service.pk).allocated_minutes, 120)
+        self.assertWithinConstraints(after)
+        self.assertEqual(reconcile(repair=False), ([], []))
+
+    def test_shrunk_and_removed_services(self):
+        self.services[0].total_time_req = 30
+        self.services[0].save()
+        removed = self.services[1].pk
+        self.services[1].delete()
+        diff = plan_repair(self.schedule, Changes([self.services[0].pk, removed]))
+        # One of the shrunk service's appointments, and both of the removed one's
+        self.assertEqual((diff.created, diff.moved, len(diff.deleted)), ([], [], 3))
+
+    def test_blocked_time(self):
+        before = self.get_appointments()
+        diff = repair_schedule(self.schedule, Changes(blocked=[Block(0, 9 * 60, 10 * 60)]))
+        self.assertEqual(len(diff.moved), 1)
+        after = self.get_appointments()
+        self.assertFalse(any(day == 'Monday' and start < 10 * 60 for service_id, day, start, end in after.values()))
+        self.assertTrue(all(after[pk] == appointment for pk, appointment in before.items()
+                            if appointment[0] != self.services[0].pk))
+        self.assertWithinConstraints(after)
+        self.schedule.refresh_from_db()
+        self.assertEqual(self.schedule.blocked_periods, 'Every day 10:00-10:30\nMonday 09:00-10:00')
+
+
+class ComplianceTests(TestCase):
+    """Each teacher's summary rows follow their services, and rebuild() puts wrong rows right"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+        self.other = User.objects.create_user('other', password='password')
+        self.schedule = Schedule.objects.create(title='Week', teacher=self.teacher, active=True)
+        self.first = Student.objects.create(first_name='First', last_name='One', teacher=self.teacher)
+        self.second = Student.objects.create(first_name='Second', last_name='Two', teacher=self.teacher)
+        self.math = Service.objects.create(student=self.first, subject='MATH', service_type='Pull-Out',
+                                           total_time_req=60, satisfied=False)
+        self.second_math = Service.objects.create(student=self.second, subject='MATH', service_type='Pull-Out',
+                                                  total_time_req=30, satisfied=False)
+        self.ela = Service.objects.create(student=self.second, subject='ELA', service_type='Push-In',
+                                          total_time_req=30, satisfied=False)
+
+    def get_rows(self):
+        return {(row.teacher_id, row.subject, row.service_type): tuple(getattr(row, name) for name in compliance.FIELDS)
+                for row in ComplianceSummary.objects.all()}
+
+    def test_refresh(self):
+        self.assertEqual(self.get_rows(), {(self.teacher.pk, 'MATH', 'Pull-Out'): (2, 2, 2, 2, 90, 0, 90),
+                                           (self.teacher.pk, 'ELA', 'Push-In'): (1, 1, 1, 1, 30, 0, 30)})
+        add_appointment(self.second_math, self.schedule, 'Monday', 9 * 60, 9 * 60 + 30)
+        self.assertEqual(self.get_rows()[self.teacher.pk, 'MATH', 'Pull-Out'], (2, 1, 2, 1, 90, 30, 60))
+
+        self.second.teacher = self.other
+        self.second.save()
+        self.assertEqual(self.get_rows(), {(self.teacher.pk, 'MATH', 'Pull-Out'): (1, 1, 1, 1, 60, 0, 60),
+                                           (self.other.pk, 'MATH', 'Pull-Out'): (1, 0, 1, 0, 30, 30, 0),
+                                           (self.other.pk, 'ELA', 'Push-In'): (1, 1, 1, 1, 30, 0, 30)})
+        self.ela.delete()
+        self.first.delete()
+        self.assertEqual(list(self.get_rows()), [(self.other.pk, 'MATH', 'Pull-Out')])
+
+    def test_rebuild(self):
+        before = self.get_rows()
+        self.assertEqual(compliance.rebuild(), 0)
+        ComplianceSummary.objects.update(missing_minutes=999)
+        ComplianceSummary.objects.create(teacher=self.other, subject='MATH', service_type='Push-In',
+                                         **{name: 1 for name in compliance.FIELDS})
+        self.assertEqual(compliance.rebuild(), len(before) + 1)
+        self.assertEqual(self.get_rows(), before)
+        self.assertEqual(compliance.refresh_teachers([self.teacher.pk]), 0)
+
+
+class ScheduleAccessTests(TestCase):
+    """A teacher's schedule pages are only shown to that teacher"""
+
+    def setUp(self):
+        teacher = User.objects.create_user('teacher', password='password', is_staff=True)
+        User.objects.create_user('other', password='password', is_staff=True)
+        self.schedule = Schedule.objects.create(title='Week', teacher=teacher)
+
+    def get(self, username, name, **kwargs):
+        self.client.login(username=username, password='password')
+        return self.client.get(reverse(name, kwargs=dict(pk=self.schedule.pk, **kwargs)))
+
+    def test_export(self):
+        self.assertEqual(self.get('teacher', 'export-schedule', format='csv').status_code, 200)
+        self.assertEqual(self.get('other', 'export-schedule', format='csv').status_code, 403)
+
+    def test_conflicts(self):
+        self.assertEqual(self.get('teacher', 'schedule-conflicts').status_code, 200)
+        self.assertEqual(self.get('other', 'schedule-conflicts').status_code, 403)
+
+
+class ScheduleCacheTests(TestCase):
+    """The "schedules" cache hands out each number once, and the check refuses a backend that can't"""
+
+    def test_incr(self):
+        cache = get_cache()
+        cache.set('counter', 1, 60)
+        self.assertEqual(cache.incr('counter', 2), 3)
+        self.assertEqual(cache.get_many(['counter', 'missing']), {'counter': 3})
+        with self.assertRaises(ValueError):
+            cache.incr('missing')
+
+    def test_check(self):
+        self.assertEqual(check_schedule_cache(None), [])
+        with override_settings(CACHES={'schedules': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                                     'LOCATION': 'schedule_cache'}}):
+            self.assertEqual([error.id for error in check_schedule_cache(None)], ['app.E002'])
@@ -1,5 +1,5 @@
 from django.urls import path
-from app import views
+from app import api, autocomplete, views
 from django.contrib.admin.views.decorators import staff_member_required
 # staff_member_required is a decorator enforcing the permission that only staff members have access to the url
 
@@ -8,6 +8,7 @@ urlpatterns = [
     # Student URLS
     path('studentlist/', staff_member_required(views.StudentListView.as_view()), name='student-list'), 
     path('studentlist/createstudent', staff_member_required(views.StudentCreate), name='create-student'), 
+    path('studentlist/importstudents', staff_member_required(views.StudentImport), name='import-students'),
     path('student/<uuid:pk>', staff_member_required(views.StudentDetailView.as_view()), name='student-detail'),
     path('student/<uuid:pk>/updatestudent', staff_member_required(views.StudentUpdate.as_view()), name='update-student'),
     path('student/<uuid:pk>/deletestudent', staff_member_required(views.StudentDelete), name='delete-student'),
@@ -17,6 +18,17 @@ urlpatterns = [
     path('schedule/<int:pk>', staff_member_required(views.ScheduleDetailView), name='schedule-detail'),
     path('schedule/<int:pk>/updateschedule', staff_member_required(views.ScheduleUpdate.as_view()), name='update-schedule'),
     path('schedule/<int:pk>/deleteschedule', staff_member_required(views.ScheduleDelete.as_view()), name='delete-schedule'),
+    path('schedule/<int:pk>/generateschedule', staff_member_required(views.ScheduleGenerate), name='generate-schedule'),
+    path('schedule/<int:pk>/repair', staff_member_required(views.ScheduleRepair), name='repair-schedule'),
+    path('schedule/<int:pk>/clone', staff_member_required(views.ScheduleClone), name='clone-schedule'),
+    path('schedule/<int:pk>/conflicts', staff_member_required(views.ScheduleConflictsView), name='schedule-conflicts'),
+    path('schedule/<int:pk>/preview', staff_member_required(views.SchedulePreview), name='preview-schedule'),
+    path('schedule/<int:pk>/export/<str:format>', staff_member_required(views.ScheduleExport), name='export-schedule'),
+    path('schedulelist/export/<str:format>', staff_member_required(views.TeacherScheduleExport), name='export-my-schedules'),
+    path('schedulelist/exportactive/<str:format>', staff_member_required(views.ActiveScheduleExport), name='export-active-schedules'),
+    path('compliance/', staff_member_required(views.ComplianceReportView), name='compliance-report'),
+    path('compliance/export', staff_member_required(views.ComplianceExport), name='export-compliance'),
+    path('schedule/cachestats', staff_member_required(views.CacheStatsView), name='schedule-cache-stats'),
     # Service URLS
     path('servicelist/', staff_member_required(views.ServiceListView.as_view()), name='service-list'),
     path('servicedetail/<int:pk>', staff_member_required(views.ServiceDetailView.as_view()), name='service-detail'),
@@ -28,4 +40,9 @@ urlpatterns = [
     path('serviceinstance/<int:pk>/updateserviceappt', staff_member_required(views.ServiceInstanceUpdate.as_view()), name='update-serviceinstance'),
     path('serviceinstance/<int:pk>/deleteserviceappt', staff_member_required(views.ServiceInstanceDelete.as_view()), name='delete-serviceinstance'),
     path('serviceinstance/<int:pk>', staff_member_required(views.ServiceInstanceDetailView.as_view()), name='serviceinstance-detail'),
+    # Search-as-you-type for forms
+    path('autocomplete/<str:source>', staff_member_required(autocomplete.AutocompleteView), name='autocomplete'),
+    # JSON API
+    path('api/v1/<str:resource>/', staff_member_required(api.ResourceListView), name='api-list'),
+    path('api/v1/<str:resource>/<str:pk>', staff_member_required(api.ResourceDetailView), name='api-detail'),
 ]
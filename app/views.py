@@ -1,5 +1,6 @@
 from django.shortcuts import render
-from app.models import Student, Service, ServiceInstance, Schedule
+from django.template.loader import render_to_string
+from app.models import Student, Service, ServiceInstance, Schedule, to_minutes, to_time
 from django.views import generic
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 
@@ -11,13 +12,32 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404  # finds a specific object using the primary key, or returns 404 if not found
 from django.urls import reverse_lazy # reverses the url for redirection
 
-from app.forms import CreateServiceForm, CreateScheduleForm, CreateServiceInstanceForm, CreateStudentForm  # custom forms
+from app.forms import CloneScheduleForm, CreateServiceForm, CreateScheduleForm, CreateServiceInstanceForm, CreateStudentForm, GenerateScheduleForm, ImportRosterForm, RepairScheduleForm, StudentSearchForm, UpdateServiceInstanceForm  # custom forms
+from app.forms import format_blocked_periods  # kept on the schedule for repairs
+from app.grid import ScheduleGrid, SLOT_SIZES, DAYS  # weekly grid for the schedule detail view
+from app.solver import Problem, start_generation, get_generation_status  # automatic schedule generation
+from app.conflicts import get_conflicts  # overlapping appointments
+from app.workload import ScheduleLoad  # minutes booked per day
+from app.fragment_cache import get_fragment, stats as fragment_stats  # cached parts of the schedule page
+from app.roster_import import RosterImporter, guess_format, read_rows  # bulk student import
+from app.exports import FORMATS, export_response  # CSV and calendar downloads
+from app.cloning import clone_schedule  # copying a schedule for the next term
+from app.repair import Changes, apply_repair, plan_repair  # re-placing only what changed
+from app.pagination import InvalidCursor, paginate  # paging by keyset
+from app import roster  # searching the student list
+from app.schedule_events import get_events_url, get_latest  # live updates of the schedule page
+from app.counters import get_count, get_student_count, increment  # buffered visit counts
+from app.what_if import get_snapshot, parse_moves  # previewing moves
+from app import compliance  # the district's under-served students
 
 # Following 2 imports are for redirecting after form submission
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect, HttpResponseForbidden, JsonResponse
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
 
-import datetime # for creating time objects in the schedule detail view
+import csv
+import io
 import pprint # for debugging
 import logging
 
@@ -28,17 +48,13 @@ logger = logging.getLogger(__name__)
 def index(request):
     """View function for home page of site"""
 
-    # Generate counts of students
-    num_students = Student.objects.count()
-
-    # Number of visits to this view, as counted in the session variable.
-    num_visits = request.session.get('num_visits', 0)
-    request.session['num_visits'] = num_visits + 1
-    
-    context = {
-        'num_students' : num_students,
-        'num_visits' : num_visits
-        }
+    # The teacher's students and visits to this view, counted without touching
+    # the database on most visits, see app/counters.py
+    context = {}
+    if request.user.is_authenticated:
+        context['num_students'] = get_student_count(request.user.pk)
+        context['num_visits'] = get_count('visits', request.user.pk)
+        increment('visits', request.user.pk)
 
     return render(request, 'index.html', context=context)
 
@@ -51,9 +67,42 @@ class StudentDetailView(LoginRequiredMixin, generic.DetailView):
 class StudentListView(LoginRequiredMixin, generic.ListView):
     login_url = '/accounts/login/'
     model = Student
+    context_object_name = 'student_list'    # needed because the page is handed over as a list,
+    template_name = 'app/student_list.html' # so neither can be worked out from it
 
+    # The students are searched with ?q= and filtered with ?status=, see app/roster.py,
+    # and shown a page at a time, each page linking to the next with ?cursor=
     def get_queryset(self):
-        return Student.objects.filter(teacher=self.request.user)
+        self.search_form = StudentSearchForm(self.request.GET)
+        queryset = Student.objects.filter(teacher=self.request.user)
+        if self.search_form.is_valid():
+            queryset = roster.search(queryset, self.search_form.cleaned_data['q'])
+            queryset = roster.filter_status(queryset, self.search_form.cleaned_data['status'])
+        else:
+            queryset = roster.with_status(queryset)
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        try:
+            page = paginate(self.object_list.prefetch_related('services'), roster.ORDERING,
+                            self.request.GET.get('cursor'), roster.PAGE_SIZE)
+        except InvalidCursor:
+            raise Http404('That page of students does not exist')
+        next_url = None
+        if page.next_cursor:
+            parameters = self.request.GET.copy()
+            parameters['cursor'] = page.next_cursor
+            next_url = f'{self.request.path}?{urlencode(sorted(parameters.items()))}'
+        parameters = self.request.GET.copy()
+        parameters.pop('cursor', None)
+        context = super().get_context_data(object_list=page.items, **kwargs)
+        context.update({
+            'search_form': self.search_form,
+            'total_students': get_student_count(self.request.user.pk),
+            'next_url': next_url,
+            'first_url': f'{self.request.path}?{urlencode(sorted(parameters.items()))}' if 'cursor' in self.request.GET else None,
+            })
+        return context
 
 class ScheduleListView(LoginRequiredMixin, generic.ListView):
     login_url = '/accounts/login/'
@@ -66,59 +115,54 @@ class ScheduleListView(LoginRequiredMixin, generic.ListView):
 def ScheduleDetailView(request, pk):
     """View function for displaying a Schedule model"""
     schedule = get_object_or_404(Schedule, pk=pk)
-    students = Student.objects.all()
-    html = ""
-
-    def get_time_slot():
-        # Returns a time_slot dict
-        time_slot = {
-            (datetime.time(hour=7), "AM"): [],
-            (datetime.time(hour=8), "AM"): [],
-            (datetime.time(hour=9), "AM"): [],
-            (datetime.time(hour=10), "AM"): [],
-            (datetime.time(hour=11), "AM"): [],
-            (datetime.time(hour=12), "PM"): [],
-            (datetime.time(hour=1), "PM"): [],
-            (datetime.time(hour=2), "PM"): [],
-            (datetime.time(hour=3), "PM"): [],
-        }
-        return time_slot
-    
-    # Construct a dict of dicts to map all of the service appointments to their days and time slots
-    # For example, a Monday service at 10AM would go to the Monday dict, and then into the 10AM dict
-    # I use a datetime object because it's easier to reference the hours, minutes, etc.
-
-    appts = {
-        "Monday": get_time_slot(),
-        "Tuesday": get_time_slot(),
-        "Wednesday": get_time_slot(),
-        "Thursday": get_time_slot(),
-        "Friday": get_time_slot(),
-        }
 
-    # Goes through every service instance and maps it into the appts dict
-    # with the appropriate service day and time
-    for serviceinstance in schedule.sched_serviceinstances.all():   # using the related_name of the model to backtrace its one-to-many relationship
-        for day_slot in appts.keys():
-            if day_slot == serviceinstance.day:
-                for time_slot in appts[day_slot].keys():
-                    if serviceinstance.time_start and serviceinstance.time_start.hour == time_slot[0].hour:  # make sure the service instance has a time_start field to begin with,
-                        appts[day_slot][time_slot].append(serviceinstance)                                   # then check if the service instance start hour can be mapped to a time slot,
-                                                                                                             # if so, add the service to that day, and to the correct time slot!
-    #pprint.pprint(appts)  
+    # Map all of the service appointments to their days and time slots
+    # For example, a Monday service at 10AM goes in the Monday row, 10AM column
+    # The slot size can be picked with ?slot=15, 30 or 60 (minutes)
+    slot_minutes = request.GET.get('slot', '')
+    slot_minutes = int(slot_minutes) if slot_minutes.isdigit() and int(slot_minutes) in SLOT_SIZES else 60
+
+    # The grid and the students' badges are rendered once and cached until
+    # something they show changes, see app/fragment_cache.py
+    def render_grid():
+        load = ScheduleLoad.for_schedule(schedule)
+        return render_to_string("app/includes/schedule_grid.html", {
+            "schedule": schedule,
+            "grid": ScheduleGrid(schedule, slot_minutes=slot_minutes),
+            "day_totals": zip(DAYS, load.day_totals),
+            "total_minutes": load.total,
+            })
+
+    def render_badges():
+        return render_to_string("app/includes/student_badges.html", {
+            "student_list": Student.objects.filter(teacher=schedule.teacher).prefetch_related('services'),
+            })
+
+    # The page follows changes made after this, see app/schedule_events.py; read
+    # before the grid, so any change the grid misses is sent again
+    last_event = get_latest(schedule.pk)
+
     context = {
         "schedule": schedule,
-        "student_list": students,
-        "appts": appts,
+        "slot_sizes": SLOT_SIZES,
+        "slot_minutes": slot_minutes,
+        "events_url": get_events_url(schedule.pk) + '?' + urlencode({'after': last_event}),
+        "grid_html": get_fragment("grid", schedule, render_grid, variant=slot_minutes),
+        "badges_html": get_fragment("badges", schedule, render_badges),
         }
     return render(request, "app/schedule_detail.html", context)
 
+@login_required
+def CacheStatsView(request):
+    """View function reporting the schedule page cache's hits and misses in this process"""
+    return JsonResponse({'fragments': fragment_stats.as_dict()})
+
 class ServiceListView(LoginRequiredMixin, generic.ListView):
     login_url = '/accounts/login/'
     model = Service
 
     def get_queryset(self):
-        return Service.objects.filter(student__teacher=self.request.user)   # double underscore allows us to find objects that span several relationships
+        return Service.objects.filter(student__teacher=self.request.user).select_related('student')   # double underscore allows us to find objects that span several relationships
 
 class ServiceDetailView(LoginRequiredMixin, generic.DetailView):
     login_url = '/accounts/login/'
@@ -150,6 +194,37 @@ def StudentCreate(request):
     
     return render(request, 'app/student_form.html', context)
 
+@login_required
+def StudentImport(request):
+    """View function for adding students and services from a CSV or JSON Lines file"""
+    report = None
+
+    if request.method == 'POST':
+        import_form = ImportRosterForm(request.POST, request.FILES)
+
+        if import_form.is_valid():
+            upload = import_form.cleaned_data['file']
+            format = import_form.cleaned_data['format'] or guess_format(upload.name)
+            # Read straight from the upload, large ones are already spooled to disk
+            stream = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+            # Everyone imports onto their own caseload only
+            importer = RosterImporter(teacher=request.user, allow_teacher_column=False)
+            try:
+                report = importer.run(read_rows(stream, format))
+            except UnicodeDecodeError:
+                import_form.add_error('file', 'The file must be UTF-8 text')
+            except csv.Error as error:
+                import_form.add_error('file', f'The file could not be read as CSV: {error}')
+    else:
+        import_form = ImportRosterForm()
+
+    context = {
+        'form': import_form,
+        'report': report,
+        }
+
+    return render(request, 'app/student_import.html', context)
+
 class StudentUpdate(LoginRequiredMixin, UpdateView):
     login_url = '/accounts/login/'
     model = Student
@@ -199,7 +274,7 @@ def ServiceCreate(request, pk):
 class ServiceUpdate(LoginRequiredMixin, UpdateView):
     login_url = '/accounts/login/'
     model = Service
-    fields = '__all__'
+    form_class = CreateServiceForm  # picks the student with a search rather than a list of every student
 
 class ServiceDelete(LoginRequiredMixin, DeleteView):
     login_url = '/accounts/login/'
@@ -227,6 +302,188 @@ def ScheduleCreate(request):
     
     return render(request, 'app/schedule_form.html', context)
 
+@login_required
+def ScheduleConflictsView(request, pk):
+    """View function listing every pair of overlapping appointments in a schedule"""
+    schedule = get_object_or_404(Schedule, pk=pk)
+
+    if schedule.teacher != request.user:
+        return HttpResponseForbidden()
+
+    context = {
+        'schedule': schedule,
+        'conflicts': get_conflicts(schedule),
+        }
+
+    return render(request, 'app/schedule_conflicts.html', context)
+
+@login_required
+def SchedulePreview(request, pk):
+    """View function returning, as JSON, what the ?move= moves of appointments would change, see app/what_if.py"""
+    try:
+        moves = parse_moves(request.GET.getlist('move'))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    # Answered from a snapshot held in memory, only loaded again when the schedule's version counters moved on
+    snapshot = get_snapshot(pk)
+    if snapshot is None:
+        raise Http404
+    if snapshot.teacher_id != request.user.pk:
+        return HttpResponseForbidden()
+    try:
+        return JsonResponse(snapshot.preview(moves))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+@login_required
+def ScheduleExport(request, pk, format):
+    """View function downloading a schedule as a CSV or iCalendar file"""
+    schedule = get_object_or_404(Schedule, pk=pk)
+    if format not in FORMATS:
+        raise Http404
+
+    if schedule.teacher != request.user:
+        return HttpResponseForbidden()
+
+    return export_response(Schedule.objects.filter(pk=pk), format, schedule.title)
+
+@login_required
+def TeacherScheduleExport(request, format):
+    """View function downloading all of the user's schedules as a CSV or iCalendar file"""
+    if format not in FORMATS:
+        raise Http404
+
+    return export_response(Schedule.objects.filter(teacher=request.user), format, f'{request.user.get_username()} schedules')
+
+@login_required
+def ActiveScheduleExport(request, format):
+    """View function downloading every active schedule as a CSV or iCalendar file"""
+    if format not in FORMATS:
+        raise Http404
+
+    return export_response(Schedule.objects.filter(active=True), format, 'Active schedules')
+
+@login_required
+def ComplianceReportView(request):
+    """View function for the district's services and students short of minutes, by subject and service type"""
+    totals, grand_total = compliance.get_district_totals()
+    context = {
+        'totals': totals,
+        'grand_total': grand_total,
+        'underserved': compliance.get_underserved()[:compliance.REPORT_ROWS],
+        }
+    return render(request, 'app/compliance_report.html', context)
+
+@login_required
+def ComplianceExport(request):
+    """View function downloading every teacher's summary rows as a CSV file"""
+    return compliance.export_response()
+
+@login_required
+def ScheduleGenerate(request, pk):
+    """View function for filling a schedule with appointments for the services that still need time"""
+    schedule = get_object_or_404(Schedule, pk=pk)
+
+    if schedule.teacher != request.user:
+        return HttpResponseForbidden()
+
+    # The search runs in the background, this page then shows how it is going
+    if request.method == 'POST':
+        generate_form = GenerateScheduleForm(request.POST)
+
+        if generate_form.is_valid():
+            data = generate_form.cleaned_data
+            window = (to_minutes(data['day_start']), to_minutes(data['day_end']))
+            problem = Problem.from_schedule(schedule,
+                                            availability=[[window] for day in DAYS],
+                                            blocked=data['blocked_periods'],
+                                            session_minutes=data['session_minutes'])
+            # Kept for repairs, which place appointments within the same day and around the same blocks
+            Schedule.objects.filter(pk=schedule.pk).update(
+                day_start=data['day_start'], day_end=data['day_end'],
+                blocked_periods=format_blocked_periods(data['blocked_periods']), updated_at=timezone.now())
+            start_generation(schedule, problem, time_budget=data['time_budget'])
+            return HttpResponseRedirect(reverse('generate-schedule', kwargs={'pk': pk}))
+    else:
+        generate_form = GenerateScheduleForm()
+
+    status = get_generation_status(pk)
+    context = {
+        'form': generate_form,
+        'schedule': schedule,
+        'status': status,
+        'unmet': Service.objects.filter(pk__in=status['unmet']).select_related('student') if status and status.get('unmet') else None,
+        }
+
+    return render(request, 'app/schedule_generate.html', context)
+
+@login_required
+def ScheduleRepair(request, pk):
+    """View function for re-placing only the appointments affected by changed services or blocked time"""
+    schedule = get_object_or_404(Schedule, pk=pk)
+
+    if schedule.teacher != request.user:
+        return HttpResponseForbidden()
+
+    context = {'schedule': schedule}
+    if request.method == 'POST':
+        repair_form = RepairScheduleForm(request.POST, teacher=request.user)
+
+        if repair_form.is_valid():
+            data = repair_form.cleaned_data
+            diff = plan_repair(schedule, Changes([service.pk for service in data['services']], data['blocked_periods']))
+            # The appointments are described with their students before any are deleted, in two queries
+            services = Service.objects.select_related('student').in_bulk(
+                [placement.service_id for placement in diff.created] + list(diff.unmet))
+            serviceinstances = (ServiceInstance.objects.select_related('service__student')
+                                .in_bulk([pk for pk, placement in diff.moved] + diff.deleted))
+            context.update({
+                'diff': diff,
+                'created': [(services.get(placement.service_id), DAYS[placement.day], to_time(placement.start), to_time(placement.end))
+                            for placement in diff.created],
+                'moved': [(serviceinstances[pk], DAYS[placement.day], to_time(placement.start), to_time(placement.end))
+                          for pk, placement in diff.moved],
+                'deleted': [serviceinstances[pk] for pk in diff.deleted],
+                'unmet': [(services.get(service_id), minutes) for service_id, minutes in diff.unmet.items()],
+                'applied': not data['preview'] and bool(diff),
+                })
+            if context['applied']:
+                apply_repair(diff)
+    else:
+        repair_form = RepairScheduleForm(teacher=request.user)
+    context['form'] = repair_form
+
+    return render(request, 'app/schedule_repair.html', context)
+
+@login_required
+def ScheduleClone(request, pk):
+    """View function for copying a schedule and its appointments to a new schedule"""
+    schedule = get_object_or_404(Schedule, pk=pk)
+
+    if schedule.teacher != request.user:
+        return HttpResponseForbidden()
+
+    report = None
+    if request.method == 'POST':
+        clone_form = CloneScheduleForm(request.POST)
+
+        if clone_form.is_valid():
+            data = clone_form.cleaned_data
+            report = clone_schedule(schedule, data['title'], data['start_date'], data['end_date'],
+                                    skip_departed=data['skip_departed'], skip_satisfied=data['skip_satisfied'],
+                                    activate=data['activate'])
+    else:
+        clone_form = CloneScheduleForm(initial={'title': f'{schedule.title} (copy)',
+                                                'start_date': schedule.start_date, 'end_date': schedule.end_date})
+
+    context = {
+        'form': clone_form,
+        'schedule': schedule,
+        'report': report,
+        }
+
+    return render(request, 'app/schedule_clone.html', context)
+
 class ScheduleUpdate(LoginRequiredMixin, UpdateView):
     login_url = '/accounts/login/'
     model = Schedule
@@ -263,7 +520,7 @@ def ServiceInstanceCreate(request, pk):
 class ServiceInstanceUpdate(LoginRequiredMixin, UpdateView):
     login_url = '/accounts/login/'
     model = ServiceInstance
-    fields = '__all__'
+    form_class = UpdateServiceInstanceForm  # checks the new time doesn't overlap another appointment
     
 class ServiceInstanceDelete(LoginRequiredMixin, DeleteView):
     login_url = '/accounts/login/'
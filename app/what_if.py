@@ -0,0 +1,322 @@
+"""Previews what moving appointments would do, without saving anything.
+
+Before a teacher drops an appointment somewhere else on the grid, the page asks
+how that changes each service's minutes, each student's satisfaction and the
+conflicts (app.conflicts). Saving the move and asking again would write, fire
+every signal handler and re-read the schedule. Instead a ScheduleSnapshot holds
+the schedule's appointments, the services they are for and the minutes those
+require, loaded with one query, and keeps running totals:
+
+* the minutes booked for each service, in an array, and how many services have
+  all their minutes
+* how many of each student's services are short, and how many students have
+  none short
+* how many pairs of appointments overlap, and how many of those double-book a
+  student
+
+Each day's appointments are kept sorted by start, so the ones a moved
+appointment overlaps are found with a binary search, and every total is
+updated by what the move changes rather than worked out again.
+Moves go on an undo log, so a preview applies its moves, reads the totals and
+rolls them back, leaving the snapshot as it was for the next one.
+
+As on the solver's problem (app.solver), a service's minutes are those booked
+on this schedule, whether or not it is active. Snapshots are kept in this
+process, up to SNAPSHOT_CACHE_SIZE of them. Before one is used, its stamp is
+checked: the version counters of the schedule and its teacher that the cached
+parts of the schedule page are keyed on (app.fragment_cache). The signal
+handlers, and the code changing rows in bulk, bump them for every change to an
+appointment, service or student a snapshot holds, so a change saved by any
+worker process moves the stamp on and the snapshot is loaded again. Otherwise
+the preview is answered from memory and two lookups in the "schedules" cache,
+however many appointments the schedule has.
+"""
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from app.fragment_cache import get_version
+from app.grid import DAYS
+from app.models import Schedule, ServiceInstance
+
+SNAPSHOT_CACHE_SIZE = 32    # schedules whose snapshots this process keeps
+MAX_MOVES = 20              # moves one preview may make
+
+
+class Appointment:
+    """An appointment of a snapshot, where it is now"""
+    __slots__ = ('pk', 'service', 'student_id', 'pull_out', 'day', 'start', 'end')
+
+    def __init__(self, pk, service, student_id, pull_out, day, start, end):
+        self.pk = pk
+        self.service = service          # index into the snapshot's service arrays, -1 if none
+        self.student_id = student_id
+        self.pull_out = pull_out
+        self.day = day                  # index into DAYS, -1 if it isn't on the grid
+        self.start = start              # minutes since midnight
+        self.end = end
+
+    @property
+    def minutes(self):
+        return max(self.end - self.start, 0)
+
+
+def get_kind(first, second):
+    """The same as app.conflicts.get_kind, for snapshot appointments"""
+    if first.student_id is not None and first.student_id == second.student_id and first.pull_out and second.pull_out:
+        return 'student'
+    return 'teacher'
+
+
+class ScheduleSnapshot:
+    """A schedule's appointments and their services' minutes, with moves that can be undone"""
+
+    def __init__(self, schedule_id, teacher_id, rows, stamp=None):
+        # rows are (pk, service id, student id, service type, minutes required, day, start, end)
+        self.schedule_id = schedule_id
+        self.teacher_id = teacher_id
+        self.stamp = stamp              # the schedule's stamp when it was loaded, see get_stamp
+        self.lock = threading.Lock()    # a preview moves appointments and moves them back
+        self.service_ids = []
+        self.service_students = []
+        self.minutes = array('l')
+        self.required = array('l')
+        self.short_services = {}        # student id -> how many of their services are short
+        self.appointments = {}
+        self.days = [[] for day in DAYS]    # (start, end, pk) of each day's appointments, sorted
+        self.longest = 0                # minutes of the longest appointment on the grid
+        self.undo_log = []
+        self.satisfied_services = 0
+        self.satisfied_students = 0
+        self.conflicts = 0
+        self.student_conflicts = 0
+
+        service_index = {}
+        for pk, service_id, student_id, service_type, required, day, start, end in rows:
+            service = -1
+            if service_id is not None:
+                if service_id not in service_index:
+                    service_index[service_id] = len(self.service_ids)
+                    self.add_service(service_id, student_id, required)
+                service = service_index[service_id]
+            appointment = Appointment(pk, service, student_id, service_type == 'Pull-Out',
+                                      DAYS.index(day) if day in DAYS else -1, start, end)
+            self.appointments[pk] = appointment
+            self.change_minutes(service, appointment.minutes)
+            self.place(appointment)
+
+    def add_service(self, service_id, student_id, required):
+        self.service_ids.append(service_id)
+        self.service_students.append(student_id)
+        self.minutes.append(0)
+        self.required.append(required)
+        short = required > 0
+        self.satisfied_services += not short
+        if student_id is not None:
+            if student_id not in self.short_services:
+                self.short_services[student_id] = 0
+                self.satisfied_students += 1
+            self.change_short(student_id, short)
+
+    def change_short(self, student_id, change):
+        """Adds change to the number of a student's services that are short"""
+        if student_id is None or not change:
+            return
+        before = self.short_services[student_id]
+        self.short_services[student_id] = before + change
+        if before == 0:
+            self.satisfied_students -= 1
+        elif before + change == 0:
+            self.satisfied_students += 1
+
+    def is_satisfied(self, service):
+        return self.minutes[service] >= self.required[service]
+
+    def change_minutes(self, service, change):
+        if service < 0 or not change:
+            return
+        before = self.is_satisfied(service)
+        self.minutes[service] += change
+        after = self.is_satisfied(service)
+        if before != after:
+            self.satisfied_services += 1 if after else -1
+            self.change_short(self.service_students[service], -1 if after else 1)
+
+    def find_overlaps(self, appointment):
+        """Returns the other appointments on the grid overlapping appointment, those of no length overlap nothing"""
+        if appointment.day < 0 or appointment.end <= appointment.start:
+            return []
+        intervals = self.days[appointment.day]
+        # Only intervals starting after start - longest can reach start
+        first = bisect_left(intervals, (appointment.start - self.longest,))
+        last = bisect_left(intervals, (appointment.end,))
+        return [self.appointments[pk] for start, end, pk in intervals[first:last]
+                if end > appointment.start and end > start and pk != appointment.pk]
+
+    def count_conflicts(self, appointment, sign):
+        for other in self.find_overlaps(appointment):
+            self.conflicts += sign
+            if get_kind(appointment, other) == 'student':
+                self.student_conflicts += sign
+
+    def place(self, appointment):
+        if appointment.day < 0:
+            return
+        self.count_conflicts(appointment, 1)
+        insort(self.days[appointment.day], (appointment.start, appointment.end, appointment.pk))
+        self.longest = max(self.longest, appointment.minutes)
+
+    def unplace(self, appointment):
+        if appointment.day < 0:
+            return
+        intervals = self.days[appointment.day]
+        del intervals[bisect_left(intervals, (appointment.start, appointment.end, appointment.pk))]
+        self.count_conflicts(appointment, -1)
+
+    def set_time(self, appointment, day, start, end):
+        self.unplace(appointment)
+        before = appointment.minutes
+        appointment.day, appointment.start, appointment.end = day, start, end
+        self.change_minutes(appointment.service, appointment.minutes - before)
+        self.place(appointment)
+
+    def move(self, pk, day, start, end=None):
+        """Moves an appointment to start on day (an index into DAYS), ending at end or keeping its length"""
+        appointment = self.appointments.get(pk)
+        if appointment is None:
+            raise ValueError(f'No appointment {pk} on this schedule')
+        if not 0 <= day < len(DAYS):
+            raise ValueError(f'No day {day}')
+        if end is None:
+            end = start + appointment.minutes
+        if not 0 <= start <= end <= 24 * 60:
+            raise ValueError('An appointment has to start before it ends, within the day')
+        self.undo_log.append((appointment, appointment.day, appointment.start, appointment.end))
+        self.set_time(appointment, day, start, end)
+
+    def undo(self):
+        """Takes back the last move"""
+        self.set_time(*self.undo_log.pop())
+
+    def rollback(self, length=0):
+        """Takes back moves until length of them are left"""
+        while len(self.undo_log) > length:
+            self.undo()
+
+    def get_totals(self):
+        return {
+            'services': len(self.service_ids),
+            'satisfied_services': self.satisfied_services,
+            'students': len(self.short_services),
+            'satisfied_students': self.satisfied_students,
+            'conflicts': self.conflicts,
+            'student_conflicts': self.student_conflicts,
+            }
+
+    def preview(self, moves):
+        """Returns what making moves, (pk, day, start, end) tuples, would change, and takes them back.
+
+        Raises ValueError for a move that can't be made.
+        """
+        with self.lock:
+            before = self.get_totals()
+            services = {}   # index -> minutes before
+            length = len(self.undo_log)
+            try:
+                for pk, day, start, end in moves:
+                    service = self.appointments[pk].service if pk in self.appointments else -1
+                    if service >= 0:
+                        services.setdefault(service, self.minutes[service])
+                    self.move(pk, day, start, end)
+                moved = {pk for pk, day, start, end in moves}
+                conflicts = [{'kind': get_kind(self.appointments[pk], other), 'appointment': pk, 'with': other.pk}
+                             for pk in sorted(moved) for other in self.find_overlaps(self.appointments[pk])
+                             if other.pk not in moved or other.pk > pk]
+                changes = [{
+                    'service': self.service_ids[service],
+                    'student': str(self.service_students[service]) if self.service_students[service] else None,
+                    'required': self.required[service],
+                    'minutes_before': minutes,
+                    'minutes_after': self.minutes[service],
+                    'satisfied_before': minutes >= self.required[service],
+                    'satisfied_after': self.is_satisfied(service),
+                    } for service, minutes in services.items() if minutes != self.minutes[service]]
+                return {'schedule': self.schedule_id, 'before': before, 'after': self.get_totals(),
+                        'services': changes, 'conflicts': conflicts}
+            finally:
+                self.rollback(length)
+
+    @classmethod
+    def load(cls, schedule_id, stamp=None):
+        """Loads a schedule's snapshot with one query, or two when it has no appointments. None if it doesn't exist"""
+        rows = list(ServiceInstance.objects
+                    .filter(scheduled_for_id=schedule_id)
+                    .exclude(time_start=None).exclude(time_end=None)
+                    .with_minutes()
+                    .order_by('pk')
+                    .values_list('pk', 'service_id', 'service__student_id', 'service__service_type',
+                                 'service__total_time_req', 'day', 'start_minute', 'end_minute',
+                                 'scheduled_for__teacher_id'))
+        if rows:
+            teacher_id = rows[0][-1]
+        else:
+            teacher_ids = Schedule.objects.filter(pk=schedule_id).values_list('teacher_id', flat=True)
+            if not teacher_ids:
+                return None
+            teacher_id = teacher_ids[0]
+        return cls(schedule_id, teacher_id, [row[:-1] for row in rows], stamp=stamp)
+
+
+_snapshots = OrderedDict()     # schedule id -> ScheduleSnapshot, least recently used first
+_snapshots_lock = threading.Lock()
+
+def get_stamp(schedule_id, teacher_id):
+    """Returns the version counters of a schedule and its teacher, which move on whenever its snapshot would change"""
+    return get_version('schedule', schedule_id), get_version('teacher', teacher_id)
+
+def get_snapshot(schedule_id):
+    """Returns the current snapshot of a schedule, loading it if it changed since. None if it doesn't exist"""
+    with _snapshots_lock:
+        snapshot = _snapshots.get(schedule_id)
+    if snapshot is not None and snapshot.stamp == get_stamp(schedule_id, snapshot.teacher_id):
+        with _snapshots_lock:
+            if schedule_id in _snapshots:
+                _snapshots.move_to_end(schedule_id)
+        return snapshot
+
+    # Giving the schedule to another teacher bumps its version too
+    teacher_ids = list(Schedule.objects.filter(pk=schedule_id).values_list('teacher_id', flat=True))
+    if not teacher_ids:
+        return None
+    # The stamp is read before loading, so a change made meanwhile loads it again next time
+    snapshot = ScheduleSnapshot.load(schedule_id, stamp=get_stamp(schedule_id, teacher_ids[0]))
+    if snapshot is None:
+        return None
+    with _snapshots_lock:
+        _snapshots[schedule_id] = snapshot
+        _snapshots.move_to_end(schedule_id)
+        while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+            _snapshots.popitem(last=False)
+    return snapshot
+
+def parse_time(value):
+    hours, minutes = value.split(':')
+    if not (hours.isdigit() and minutes.isdigit() and int(minutes) < 60):
+        raise ValueError
+    return int(hours) * 60 + int(minutes)
+
+def parse_moves(values):
+    """Parses ?move= values, "<appointment id>,<day>,<start HH:MM>[,<end HH:MM>]", into move tuples"""
+    if len(values) > MAX_MOVES:
+        raise ValueError(f'At most {MAX_MOVES} moves at once')
+    moves = []
+    for value in values:
+        try:
+            pk, day, start, *end = value.split(',')
+            if len(end) > 1 or day not in DAYS:
+                raise ValueError
+            moves.append((int(pk), DAYS.index(day), parse_time(start), parse_time(end[0]) if end else None))
+        except ValueError:
+            raise ValueError(f'Bad move "{value}", expected <appointment id>,<day>,<HH:MM>[,<HH:MM>]')
+    return moves